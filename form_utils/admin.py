@@ -1,16 +1,101 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import django
 from django.contrib import admin
+try:
+    from django.contrib.admin.utils import flatten_fieldsets
+except ImportError: # Django < 1.7 compatibility
+    from django.contrib.admin.util import flatten_fieldsets
+from django.db import models
 from django import forms
 
+from .cleanup import queue_replaced_files
 from .fields import ClearableFileField
+from .forms import SUPPORTS_UPDATE_FIELDS, changed_model_fields
+from .uploads import discard_stashed_uploads
+
+# maximum number of form classes cached by each ``ClearableFileFieldsAdmin``
+FORM_CACHE_SIZE = 256
 
 
 class ClearableFileFieldsAdmin(admin.ModelAdmin):
+    # see ``BetterModelForm.save_changed_only``
+    save_changed_only = False
+    # see ``BetterModelForm.delete_replaced_files``
+    delete_replaced_files = False
+    # If True, the ModelForm classes built by ``get_form`` are cached, per
+    # user (the admin's related-field widgets depend on permissions), object
+    # and fields, readonly fields and other arguments. Forms with model
+    # choice fields are never cached, as their querysets (and
+    # ``limit_choices_to``) are only evaluated when the class is built.
+    cache_forms = False
+
+    def save_model(self, request, obj, form, change):
+        if not (change and self.save_changed_only and SUPPORTS_UPDATE_FIELDS):
+            super(ClearableFileFieldsAdmin, self).save_model(
+                request, obj, form, change)
+        else:
+            update_fields = changed_model_fields(form, obj)
+            if update_fields:
+                obj.save(update_fields=update_fields)
+        discard_stashed_uploads(form.cleaned_data)
+        if change and self.delete_replaced_files:
+            queue_replaced_files(form, obj)
+
     def formfield_for_dbfield(self, db_field, **kwargs):
+        # The wrapped fields of model FileFields only depend on the field
+        # and formfield_overrides, so they are built once and shared by
+        # all the forms of this admin (form instances get their own
+        # copies anyway).
+        cacheable = (isinstance(db_field, models.FileField) and
+                     set(kwargs) <= set(['request']))
+        if cacheable:
+            try:
+                return self._clearable_fields[db_field]
+            except (AttributeError, KeyError):
+                pass
         field = super(ClearableFileFieldsAdmin, self).formfield_for_dbfield(
             db_field, **kwargs)
         if isinstance(field, forms.FileField):
             field = ClearableFileField(field)
+        if cacheable:
+            self.__dict__.setdefault('_clearable_fields', {})[db_field] = field
         return field
+
+    def get_form(self, request, obj=None, **kwargs):
+        if not self.cache_forms:
+            return super(ClearableFileFieldsAdmin, self).get_form(
+                request, obj, **kwargs)
+        if 'fields' not in kwargs:
+            if django.VERSION < (1, 6):
+                # Django < 1.6 compatibility: get_fieldsets() calls get_form()
+                # without fields, and get_form() only uses the declared ones
+                kwargs['fields'] = (flatten_fieldsets(self.declared_fieldsets)
+                                    if self.declared_fieldsets else None)
+            else:
+                kwargs['fields'] = flatten_fieldsets(
+                    self.get_fieldsets(request, obj))
+        key = (getattr(getattr(request, 'user', None), 'pk', None),
+               getattr(obj, 'pk', None),
+               tuple(self.get_readonly_fields(request, obj)),
+               tuple(sorted((name, tuple(value) if isinstance(value, list)
+                             else value)
+                            for name, value in kwargs.items())))
+        cache = self.__dict__.setdefault('_form_cache', {})
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        except TypeError: # unhashable argument
+            return super(ClearableFileFieldsAdmin, self).get_form(
+                request, obj, **kwargs)
+        form = super(ClearableFileFieldsAdmin, self).get_form(
+            request, obj, **kwargs)
+        if any(isinstance(field, forms.ModelChoiceField)
+               for field in form.base_fields.values()):
+            return form
+        if len(cache) >= FORM_CACHE_SIZE:
+            cache.clear()
+        cache[key] = form
+        return form
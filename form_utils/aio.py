@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio support for django-form-utils
+
+This module requires Python 3.5 or later. It is imported lazily by
+``BetterBaseForm.arender`` and ``BetterBaseForm.ais_valid``, so the rest
+of ``form_utils`` stays importable on Python 2.
+
+Only the database-bound parts of form handling (evaluating choice
+querysets, validation) are run in a worker thread; template rendering
+happens on the event loop. If `asgiref`_ is installed its
+``sync_to_async`` is used, otherwise a minimal executor-based fallback.
+
+.. _asgiref: https://pypi.python.org/pypi/asgiref
+
+"""
+from __future__ import unicode_literals
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.exceptions import ValidationError
+
+from .utils import evaluate_choices
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    # A single worker thread keeps all database access on one connection,
+    # like asgiref's thread-sensitive mode.
+    _executor = ThreadPoolExecutor(max_workers=1)
+
+    def sync_to_async(func, thread_sensitive=True):
+        executor = _executor if thread_sensitive else None
+
+        @functools.wraps(func)
+        async def inner(*args, **kwargs):
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                executor, functools.partial(func, *args, **kwargs))
+        return inner
+
+
+async def aevaluate_choices(form, thread_sensitive=True):
+    """Evaluate the choice querysets of ``form`` in a worker thread."""
+    await sync_to_async(evaluate_choices,
+                        thread_sensitive=thread_sensitive)(form)
+
+
+async def arender(form, template_name=None, thread_sensitive=True):
+    """
+    Render ``form`` like the ``render`` template filter, evaluating its
+    choice querysets (and, if it is bound and not yet validated, cleaning
+    it with ``afull_clean``) first.
+
+    """
+    from .templatetags.form_utils import render
+    if form.is_bound and form._errors is None:
+        # rendering reads ``form.errors``
+        await afull_clean(form, thread_sensitive=thread_sensitive)
+    await aevaluate_choices(form, thread_sensitive=thread_sensitive)
+    return render(form, template_name)
+
+
+def _run_in_new_loop(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def _running_loop():
+    get_running_loop = getattr(asyncio, '_get_running_loop', None)
+    if get_running_loop is not None:
+        return get_running_loop()
+    # Python < 3.5.3
+    try:
+        loop = asyncio.get_event_loop()
+    except RuntimeError:
+        return None
+    return loop if loop.is_running() else None
+
+
+def run_sync(coroutine):
+    """
+    Run ``coroutine`` to completion in a new event loop, and return its
+    result. If an event loop is already running in this thread (e.g.
+    ``form.is_valid()`` was called from an ``async def`` view), the new
+    loop is run in another thread, blocking this one until it is done;
+    use ``ais_valid`` instead to avoid that.
+
+    """
+    if _running_loop() is None:
+        return _run_in_new_loop(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(_run_in_new_loop, coroutine).result()
+
+
+async def _acheck(name, validator, value):
+    try:
+        if asyncio.iscoroutinefunction(validator):
+            await validator(value)
+        else:
+            await sync_to_async(validator, thread_sensitive=False)(value)
+    except ValidationError as e:
+        return name, e
+    return name, None
+
+
+async def afull_clean(form, thread_sensitive=True):
+    """
+    Clean ``form`` like ``full_clean()``, with the fields and then
+    ``clean()`` and model validation run in a worker thread.
+
+    In between, the ``async_validators`` of a ``BetterForm`` or
+    ``BetterModelForm`` are all run concurrently: coroutine functions on
+    the event loop, and other callables in (thread-insensitive) worker
+    threads. Their errors are added in field and validator order,
+    whichever finishes first.
+
+    """
+    to_async = functools.partial(sync_to_async,
+                                 thread_sensitive=thread_sensitive)
+    if not getattr(form, 'async_validators', None):
+        return await to_async(form.full_clean)()
+    if not await to_async(form._begin_full_clean)():
+        return
+    results = await asyncio.gather(*[
+        _acheck(name, validator, value)
+        for name, validator, value in form._async_validator_calls()])
+    form._add_async_errors([(name, e) for name, e in results if e])
+    await to_async(form._finish_full_clean)()
+
+
+async def ais_valid(form, thread_sensitive=True):
+    """
+    Validate ``form`` with ``afull_clean`` and return ``is_valid()``.
+
+    A ``PreviewForm`` being previewed is only validated if it uses a
+    preview token, as with ``is_valid()``.
+
+    """
+    if not getattr(form, 'async_validators', None):
+        return await sync_to_async(form.is_valid,
+                                   thread_sensitive=thread_sensitive)()
+    if form._errors is None and (not getattr(form, 'preview', False) or
+                                 form.use_preview_token):
+        await afull_clean(form, thread_sensitive=thread_sensitive)
+    return form.is_valid()
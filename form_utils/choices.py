@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+request-scoped caching of model choice querysets for django-form-utils
+
+While a ``ChoiceCache`` is active (for the duration of a request with
+``ChoiceCacheMiddleware``, or inside a ``choice_cache()`` block), the
+choices of model choice fields of ``BetterForm`` and ``BetterModelForm``
+instances, and of fields passed to the ``value_text`` and
+``selected_values`` filters, are read from the cache. Each distinct
+queryset (by database, SQL and parameters) is then evaluated only once,
+however many forms use it.
+
+"""
+from __future__ import unicode_literals
+
+from contextlib import contextmanager
+import threading
+
+from django import forms
+from django.forms.models import ModelChoiceIterator
+try:
+    from django.core.exceptions import EmptyResultSet
+except ImportError: # Django < 1.11 compatibility
+    from django.db.models.sql.datastructures import EmptyResultSet
+
+_state = threading.local()
+
+
+def queryset_key(queryset):
+    """
+    Return a hashable key identifying the results of ``queryset`` by its
+    database, model, SQL and params, or ``None`` if it can't match
+    anything.
+
+    """
+    try:
+        sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+    except EmptyResultSet:
+        return None
+    return (queryset.db, queryset.model, sql, tuple(params))
+
+
+class ChoiceCache(object):
+    """A cache of evaluated querysets, keyed by their SQL and params."""
+    def __init__(self):
+        self._results = {}
+
+    def get_objects(self, queryset):
+        key = queryset_key(queryset)
+        if key is None:
+            return []
+        try:
+            return self._results[key]
+        except KeyError:
+            objects = self._results[key] = list(queryset.all())
+            return objects
+
+
+class CachedModelChoiceIterator(ModelChoiceIterator):
+    """A ``ModelChoiceIterator`` reading its objects from a cache."""
+    def __init__(self, field, cache):
+        super(CachedModelChoiceIterator, self).__init__(field)
+        self.cache = cache
+
+    def _get_objects(self):
+        # the field's queryset may be replaced after we are installed
+        return self.cache.get_objects(self.field.queryset)
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ("", self.field.empty_label)
+        for obj in self._get_objects():
+            yield self.choice(obj)
+
+    def __len__(self):
+        return (len(self._get_objects()) +
+                (1 if self.field.empty_label is not None else 0))
+
+
+def get_choice_cache():
+    """Return the active ``ChoiceCache``, or ``None``."""
+    return getattr(_state, 'cache', None)
+
+
+@contextmanager
+def choice_cache():
+    """Activate a new ``ChoiceCache`` for the duration of the block."""
+    previous = get_choice_cache()
+    _state.cache = ChoiceCache()
+    try:
+        yield _state.cache
+    finally:
+        _state.cache = previous
+
+
+def get_choices(field):
+    """
+    Return the choices of ``field``, from the active ``ChoiceCache`` if
+    it is a model choice field with dynamic choices.
+
+    """
+    cache = get_choice_cache()
+    if (cache is not None and isinstance(field, forms.ModelChoiceField) and
+            not hasattr(field, '_choices')):
+        return CachedModelChoiceIterator(field, cache)
+    return getattr(field, 'choices', [])
+
+
+def use_choice_cache(form):
+    """Make the model choice fields of ``form`` use the active cache."""
+    cache = get_choice_cache()
+    if cache is None:
+        return
+    for field in form.fields.values():
+        if (isinstance(field, forms.ModelChoiceField) and
+                not hasattr(field, '_choices')):
+            # Assigning to ``choices`` would evaluate the iterator; set
+            # what ModelChoiceField._get_choices looks for instead.
+            field._choices = field.widget.choices = CachedModelChoiceIterator(
+                field, cache)
+
+
+class ChoiceCacheMiddleware(object):
+    """Activate a ``ChoiceCache`` for the duration of each request."""
+    def __init__(self, get_response=None):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with choice_cache():
+            return self.get_response(request)
+
+    def process_request(self, request):
+        _state.cache = ChoiceCache()
+
+    def process_response(self, request, response):
+        _state.cache = None
+        return response
+
+    def process_exception(self, request, exception):
+        _state.cache = None
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+deferred deletion of replaced files for django-form-utils
+
+A model ``FileField`` never deletes its old file when it is cleared
+(through ``ClearableFileField``) or replaced by a new upload. With
+``delete_replaced_files`` on ``BetterModelForm`` or
+``ClearableFileFieldsAdmin``, the names of such files are recorded when
+the instance is saved (after the transaction commits), and deleted later
+in batches, off the request path: by a background thread of the same
+process, or, if ``FORM_UTILS_DELETION_QUEUE_FILE`` is set, by the
+``delete_replaced_files`` management command. A file is not deleted if it
+is the field's default, or if another instance still refers to it when
+the queue is flushed.
+
+"""
+from __future__ import unicode_literals
+
+import atexit
+import json
+import logging
+import os
+import threading
+
+from django.db import connections, models, transaction
+try:
+    from django.core.exceptions import FieldDoesNotExist
+except ImportError: # Django < 1.8 compatibility
+    from django.db.models.fields import FieldDoesNotExist
+
+from .settings import DELETION_QUEUE_FILE, DELETION_BATCH_SIZE, DELETION_DELAY
+
+logger = logging.getLogger(__name__)
+
+
+def replaced_files(form, instance=None):
+    """
+    Return ``(field name, file name)`` pairs of the files of ``instance``
+    (defaults to ``form.instance``) that the saved data of ``form``
+    cleared or replaced.
+
+    """
+    instance = instance if instance is not None else form.instance
+    opts = instance._meta
+    result = []
+    for name in form.changed_data:
+        try:
+            field = opts.get_field(name)
+        except FieldDoesNotExist:
+            continue
+        if not isinstance(field, models.FileField):
+            continue
+        old_name = getattr(form.initial.get(name), 'name', None)
+        new_name = getattr(getattr(instance, name), 'name', None)
+        default = field.get_default()
+        default = getattr(default, 'name', default)
+        if old_name and old_name != new_name and old_name != default:
+            result.append((name, old_name))
+    return result
+
+
+def delete_files(files):
+    """
+    Delete ``(model, field name, file name)`` files from the storage of
+    their field, unless an instance of the model still refers to them,
+    logging (and skipping) failures. Returns the number of files deleted.
+
+    """
+    deleted = 0
+    for model, field_name, name in files:
+        try:
+            if model._default_manager.filter(**{field_name: name}).exists():
+                continue
+            model._meta.get_field(field_name).storage.delete(name)
+            deleted += 1
+        except Exception:
+            logger.exception('Could not delete replaced file %s', name)
+    return deleted
+
+
+class LocalDeletionQueue(object):
+    """
+    Deletes recorded files in a background thread of this process,
+    ``delay`` seconds after the first file is recorded, in batches of
+    ``batch_size``. Files still pending when the process exits are
+    deleted then.
+
+    """
+    def __init__(self, batch_size=DELETION_BATCH_SIZE, delay=DELETION_DELAY):
+        self.batch_size = batch_size
+        self.delay = delay
+        self._pending = []
+        self._timer = None
+        self._lock = threading.Lock()
+        self._registered = False
+
+    def add(self, model, field_name, name):
+        with self._lock:
+            self._pending.append((model, field_name, name))
+            if not self._registered:
+                atexit.register(self.flush)
+                self._registered = True
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay,
+                                              self._flush_in_thread)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush_in_thread(self):
+        try:
+            self.flush()
+        finally:
+            # the connections opened by this thread are not closed for it
+            for connection in connections.all():
+                connection.close()
+
+    def flush(self):
+        """Delete all recorded files now; return the number deleted."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        deleted = 0
+        for i in range(0, len(pending), self.batch_size):
+            deleted += delete_files(pending[i:i + self.batch_size])
+        return deleted
+
+
+class FileDeletionQueue(object):
+    """
+    Appends recorded files to the file ``path``, to be deleted in batches
+    of ``batch_size`` by ``flush`` (the ``delete_replaced_files``
+    management command) in any process.
+
+    """
+    def __init__(self, path, batch_size=DELETION_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+
+    def add(self, model, field_name, name):
+        label = '%s.%s' % (model._meta.app_label,
+                           model._meta.object_name.lower())
+        line = json.dumps([label, field_name, name]) + '\n'
+        with open(self.path, 'a') as queue:
+            queue.write(line)
+
+    def _entries(self, path):
+        try:
+            from django.apps import apps
+            get_model = apps.get_model
+        except ImportError:  # Django < 1.7 compatibility
+            from django.db.models import get_model as get_app_model
+
+            def get_model(label):
+                model = get_app_model(*label.split('.'))
+                if model is None:
+                    raise LookupError(label)
+                return model
+
+        with open(path) as queue:
+            for line in queue:
+                label, field_name, name = json.loads(line)
+                try:
+                    model = get_model(label)
+                except LookupError:
+                    logger.error('Unknown model %s in deletion queue', label)
+                    continue
+                yield model, field_name, name
+
+    def flush(self):
+        """Delete all recorded files now; return the number deleted."""
+        # files recorded from now on go to a new queue file
+        processing = '%s.%s' % (self.path, os.getpid())
+        try:
+            os.rename(self.path, processing)
+        except OSError:
+            return 0
+        deleted = 0
+        batch = []
+        for entry in self._entries(processing):
+            batch.append(entry)
+            if len(batch) == self.batch_size:
+                deleted += delete_files(batch)
+                batch = []
+        deleted += delete_files(batch)
+        os.remove(processing)
+        return deleted
+
+
+_queue = None
+
+
+def get_deletion_queue():
+    """Return the deletion queue configured in settings."""
+    global _queue
+    if _queue is None:
+        if DELETION_QUEUE_FILE:
+            _queue = FileDeletionQueue(DELETION_QUEUE_FILE)
+        else:
+            _queue = LocalDeletionQueue()
+    return _queue
+
+
+def queue_replaced_files(form, instance=None):
+    """
+    Queue the files ``form`` cleared or replaced on ``instance`` (defaults
+    to ``form.instance``) for deletion once the current transaction
+    commits. Call it after the instance is saved.
+
+    Before Django 1.9 there is no way to wait for the commit, so nothing
+    is queued if the instance was saved inside an atomic block (or, before
+    Django 1.6, a managed transaction).
+
+    """
+    instance = instance if instance is not None else form.instance
+    files = replaced_files(form, instance)
+    if not files:
+        return
+    model = type(instance)
+
+    def queue():
+        deletion_queue = get_deletion_queue()
+        for field_name, name in files:
+            deletion_queue.add(model, field_name, name)
+
+    using = instance._state.db
+    on_commit = getattr(transaction, 'on_commit', None)
+    if on_commit is not None:
+        on_commit(queue, using=using)
+        return
+    # Django < 1.9 compatibility: the save may still be rolled back
+    in_transaction = getattr(connections[using], 'in_atomic_block', None)
+    if in_transaction is None:  # Django < 1.6 compatibility
+        in_transaction = transaction.is_managed(using=using)
+    if not in_transaction:
+        queue()
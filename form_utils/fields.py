@@ -1,10 +1,20 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from io import BytesIO
+import sys
+
 from django import forms
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import UploadedFile
+from django.template.defaultfilters import filesizeformat
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils import six
+from django.utils.translation import ugettext_lazy as _
 
+from .uploads import load_stashed_upload, mark_for_stash
+from .utils import validation_error
+from .validators import UploadValidator
 from .widgets import ClearableFileInput
 
 
@@ -38,23 +48,225 @@ class FakeEmptyFieldFile(object):
 
 
 class ClearableFileField(forms.MultiValueField):
+    """
+    A ``MultiValueField`` combining a file field with a checkbox to
+    clear it.
+
+    If ``stash_uploads`` is ``True``, an upload that passed validation
+    is kept in temporary storage when the form is redisplayed (after a
+    preview or an error in another field), and the redisplayed form
+    carries a signed reference to it; submitting the form again reuses
+    the stashed file unless a new file is uploaded or the clear checkbox
+    is checked.
+
+    If ``upload_url`` (the URL of ``form_utils.views.direct_upload``) is
+    given, the widget uploads a selected file directly to that URL in
+    chunks, and submits only the reference it gets back, which the
+    field accepts in place of the file.
+
+    The ``max_size``, ``content_types`` and ``checksum`` keyword
+    arguments add an ``UploadValidator`` with these options to the file
+    field, which checks uploads while reading them in chunks.
+
+    """
     default_file_field_class = forms.FileField
+    # keyword arguments passed only to the default file field
+    file_field_options = ()
+    # the file field class used instead of the default one if any of
+    # ``file_field_options`` are given
+    options_file_field_class = None
     widget = ClearableFileInput
+    stash_uploads = False
+    upload_url = None
 
     def __init__(self, file_field=None, template=None, *args, **kwargs):
-        file_field = file_field or self.default_file_field_class(*args,
-                                                                 **kwargs)
+        stash_uploads = kwargs.pop('stash_uploads', None)
+        if stash_uploads is not None:
+            self.stash_uploads = stash_uploads
+        upload_url = kwargs.pop('upload_url', None)
+        if upload_url is not None:
+            self.upload_url = upload_url
+        file_field_kwargs = dict(
+            (option, kwargs.pop(option)) for option in
+            self.file_field_options if option in kwargs)
+        validator_options = dict(
+            (option, kwargs.pop(option)) for option in
+            ('max_size', 'content_types', 'checksum') if option in kwargs)
+        if file_field is None:
+            file_field_class = self.default_file_field_class
+            if file_field_kwargs and self.options_file_field_class:
+                file_field_class = self.options_file_field_class
+            file_field_kwargs.update(kwargs)
+            file_field = file_field_class(*args, **file_field_kwargs)
+        if validator_options:
+            file_field.validators.append(UploadValidator(**validator_options))
         fields = (file_field, forms.BooleanField(required=False))
         kwargs['required'] = file_field.required
-        kwargs['widget'] = self.widget(file_widget=file_field.widget,
-                                       template=template)
+        widget_kwargs = {'file_widget': file_field.widget,
+                         'template': template}
+        if self.upload_url:
+            widget_kwargs['upload_url'] = self.upload_url
+        kwargs['widget'] = self.widget(**widget_kwargs)
         super(ClearableFileField, self).__init__(fields, *args, **kwargs)
 
+    @property
+    def _accepts_tokens(self):
+        return bool(self.stash_uploads or self.upload_url)
+
+    def clean(self, value):
+        if isinstance(value, (list, tuple)) and len(value) > 2:
+            upload, clear, token = value[:3]
+            if token and not upload and not clear and self._accepts_tokens:
+                upload = load_stashed_upload(token)
+            value = [upload, clear]
+        result = super(ClearableFileField, self).clean(value)
+        if self.stash_uploads and isinstance(result, UploadedFile):
+            mark_for_stash(result)
+        return result
+
+    def has_changed(self, initial, data):
+        # MultiValueField.has_changed would run the initial FieldFile
+        # through FileField.to_python, which reads its size from storage.
+        if getattr(self, 'disabled', False):
+            return False
+        if not isinstance(data, (list, tuple)):
+            data = [data]
+        upload, clear, token = (list(data) + [None, None, None])[:3]
+        return bool(upload or clear or (token and self._accepts_tokens))
+
+    # Django < 1.8 compatibility
+    _has_changed = has_changed
+
     def compress(self, data_list):
         if data_list[1] and not data_list[0]:
             return FakeEmptyFieldFile()
         return data_list[0]
 
 
+class ImageHeaderField(forms.ImageField):
+    """
+    An ``ImageField`` that reads only the image header to find its
+    format and dimensions, and checks them against limits before the
+    image data is decoded.
+
+    ``max_size``: the maximum size of the file in bytes, checked before
+    the file is opened at all.
+
+    ``max_width``, ``max_height`` and ``max_pixels``: the maximum
+    dimensions and pixel count (width times height) of the image.
+
+    ``formats``: the allowed Pillow format names (e.g. ``['JPEG',
+    'PNG']``).
+
+    ``verify``: if ``True`` (the default) the whole image is then
+    checked with Pillow's ``verify()``, as ``forms.ImageField`` does; if
+    ``False`` only the header is read, and a truncated or corrupt image
+    is accepted.
+
+    """
+    default_error_messages = {
+        'max_size': _('Ensure this file is no larger than %(max_size)s.'),
+        'max_dimensions': _('Ensure this image is no larger than '
+                            '%(max_width)s x %(max_height)s pixels '
+                            '(it is %(width)s x %(height)s).'),
+        'max_pixels': _('Ensure this image has no more than %(max_pixels)s '
+                        'pixels.'),
+        'format': _('Images of format %(format)s are not allowed.'),
+    }
+
+    def __init__(self, *args, **kwargs):
+        self.max_size = kwargs.pop('max_size', None)
+        self.max_width = kwargs.pop('max_width', None)
+        self.max_height = kwargs.pop('max_height', None)
+        self.max_pixels = kwargs.pop('max_pixels', None)
+        self.formats = kwargs.pop('formats', None)
+        self.verify = kwargs.pop('verify', True)
+        super(ImageHeaderField, self).__init__(*args, **kwargs)
+
+    def to_python(self, data):
+        # skip forms.ImageField.to_python, which reads the whole file
+        f = forms.FileField.to_python(self, data)
+        if f is None:
+            return None
+        size = getattr(f, 'size', None)
+        if self.max_size is not None and size is not None and (
+                size > self.max_size):
+            raise validation_error(
+                self.error_messages['max_size'], 'max_size',
+                {'max_size': filesizeformat(self.max_size)})
+
+        from PIL import Image
+
+        if hasattr(data, 'temporary_file_path'):
+            file = data.temporary_file_path()
+        elif hasattr(data, 'read'):
+            # Pillow reads the header from the file object as needed
+            data.seek(0)
+            file = data
+        else:
+            file = BytesIO(data['content'])
+        bomb_error = getattr(Image, 'DecompressionBombError', None)
+        try:
+            image = Image.open(file)
+        except Exception as e:
+            if bomb_error is not None and isinstance(e, bomb_error):
+                self._raise_max_pixels(
+                    self.max_pixels or Image.MAX_IMAGE_PIXELS)
+            self._raise_invalid_image()
+        self.check_image(image)
+        if self.verify:
+            try:
+                # verify() must be called immediately after open()
+                image.verify()
+            except Exception:
+                self._raise_invalid_image()
+        f.image = image
+        f.content_type = Image.MIME.get(image.format)
+        if hasattr(f, 'seek') and callable(f.seek):
+            f.seek(0)
+        return f
+
+    def check_image(self, image):
+        """
+        Check the format and dimensions of the (not yet decoded) Pillow
+        ``image`` against the limits of this field.
+
+        """
+        if self.formats and image.format not in self.formats:
+            raise validation_error(
+                self.error_messages['format'], 'format',
+                {'format': image.format})
+        width, height = image.size
+        if (self.max_width is not None and width > self.max_width) or (
+                self.max_height is not None and height > self.max_height):
+            raise validation_error(
+                self.error_messages['max_dimensions'], 'max_dimensions',
+                {'max_width': self.max_width or width,
+                 'max_height': self.max_height or height,
+                 'width': width, 'height': height})
+        if self.max_pixels is not None and width * height > self.max_pixels:
+            self._raise_max_pixels(self.max_pixels)
+
+    def _raise_max_pixels(self, max_pixels):
+        raise validation_error(
+            self.error_messages['max_pixels'], 'max_pixels',
+            {'max_pixels': max_pixels})
+
+    def _raise_invalid_image(self):
+        six.reraise(ValidationError, ValidationError(
+            self.error_messages['invalid_image'], code='invalid_image',
+        ), sys.exc_info()[2])
+
+
 class ClearableImageField(ClearableFileField):
+    """
+    A ``ClearableFileField`` for images, using ``forms.ImageField``, or
+    ``ImageHeaderField`` if any of the ``max_size``, ``max_width``,
+    ``max_height``, ``max_pixels``, ``formats`` and ``verify`` keyword
+    arguments are given, which are passed on to it.
+
+    """
     default_file_field_class = forms.ImageField
+    options_file_field_class = ImageHeaderField
+    file_field_options = ('max_size', 'max_width', 'max_height',
+                          'max_pixels', 'formats', 'verify')
@@ -7,8 +7,16 @@ Time-stamp: <2010-04-28 02:57:16 carljm forms.py>
 """
 from __future__ import unicode_literals
 from copy import deepcopy
+import hashlib
+import json
 
+import django
 from django import forms
+from django.core import signing
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.validators import EMPTY_VALUES
+from django.forms.models import construct_instance
 try:
     from django.forms.utils import flatatt, ErrorDict
 except ImportError: # Django < 1.9 compatibility
@@ -16,6 +24,15 @@ except ImportError: # Django < 1.9 compatibility
 from django.utils import six
 from django.utils.safestring import mark_safe
 
+from .choices import use_choice_cache
+from .cleanup import queue_replaced_files
+from .uploads import discard_stashed_uploads
+from .utils import media_key, select_template_from_string
+
+# Django < 1.5 compatibility: ``Model.save()`` has no ``update_fields``, so
+# ``save_changed_only`` has no effect
+SUPPORTS_UPDATE_FIELDS = django.VERSION >= (1, 5)
+
 
 def with_metaclass(meta, *bases):
     """Create a base class with a metaclass.
@@ -85,20 +102,84 @@ class FieldsetCollection(object):
         if not self.fieldsets:
             self.fieldsets = (('main', {'fields': self.form.fields.keys(),
                                         'legend': ''}),)
-        for name, options in self.fieldsets:
-            try:
-                field_names = [n for n in options['fields']
-                               if n in self.form.fields]
-            except KeyError:
-                message = "Fieldset definition must include 'fields' option."
-                raise ValueError(message)
+        layout = self.form._layout
+        if layout is not None:
+            specs = layout.get_fieldset_specs(self.form.fields)
+        else:
+            specs = _compile_fieldsets(self.fieldsets, self.form.fields)
+        for name, field_names, legend, classes, description in specs:
             boundfields = [forms.forms.BoundField(self.form,
                                                   self.form.fields[n], n)
                            for n in field_names]
             self._cached_fieldsets.append(Fieldset(self.form, name,
-                boundfields, options.get('legend', None),
-                ' '.join(options.get('classes', ())),
-                options.get('description', '')))
+                boundfields, legend, classes, description))
+
+
+def _compile_fieldsets(fieldsets, fields):
+    """
+    Resolve a fieldsets definition against the given fields, returning
+    a list of (name, field_names, legend, classes, description) tuples.
+
+    """
+    specs = []
+    for name, options in fieldsets:
+        try:
+            field_names = [n for n in options['fields'] if n in fields]
+        except KeyError:
+            message = "Fieldset definition must include 'fields' option."
+            raise ValueError(message)
+        specs.append((name, field_names, options.get('legend', None),
+                      ' '.join(options.get('classes', ())),
+                      options.get('description', '')))
+    return specs
+
+
+class FormLayout(object):
+    """
+    The fieldsets and row_attrs of a ``BetterForm`` class, with the work
+    that doesn't depend on a form's data done once and cached: resolving
+    the fieldsets against the form's fields, flattening the row_attrs of
+    each field, and selecting the rendering template.
+
+    A single ``FormLayout`` is shared by all forms of a ``BetterFormSet``
+    (see ``BetterBaseForm.get_layout``); it must not be modified.
+
+    """
+    def __init__(self, fieldsets, row_attrs):
+        self.fieldsets = fieldsets
+        self.row_attrs = row_attrs
+        self._fieldset_specs = {}
+        self._flat_row_attrs = {}
+        self._templates = {}
+
+    def get_fieldset_specs(self, fields):
+        key = tuple(fields)
+        try:
+            return self._fieldset_specs[key]
+        except KeyError:
+            fieldsets = self.fieldsets or (
+                ('main', {'fields': key, 'legend': ''}),)
+            specs = _compile_fieldsets(fieldsets, fields)
+            self._fieldset_specs[key] = specs
+            return specs
+
+    def get_row_attrs(self, name, required, error):
+        key = (name, required, error)
+        try:
+            return self._flat_row_attrs[key]
+        except KeyError:
+            flat = _flatten_row_attrs(self.row_attrs.get(name, {}),
+                                      required, error)
+            self._flat_row_attrs[key] = flat
+            return flat
+
+    def get_template(self, template_name):
+        try:
+            return self._templates[template_name]
+        except KeyError:
+            tpl = select_template_from_string(template_name)
+            self._templates[template_name] = tpl
+            return tpl
 
 
 def _get_meta_attr(attrs, attr, default):
@@ -148,19 +229,28 @@ def get_row_attrs(bases, attrs):
     return _get_meta_attr(attrs, 'row_attrs', {})
 
 
-def _mark_row_attrs(bf, form):
-    row_attrs = deepcopy(form._row_attrs.get(bf.name, {}))
-    if bf.field.required:
+def _flatten_row_attrs(row_attrs, required, error):
+    row_attrs = dict(row_attrs)
+    if required:
         req_class = 'required'
     else:
         req_class = 'optional'
-    if bf.errors:
+    if error:
         req_class += ' error'
     if 'class' in row_attrs:
         row_attrs['class'] = row_attrs['class'] + ' ' + req_class
     else:
         row_attrs['class'] = req_class
-    bf.row_attrs = mark_safe(flatatt(row_attrs))
+    return mark_safe(flatatt(row_attrs))
+
+
+def _mark_row_attrs(bf, form):
+    if form._layout is not None:
+        bf.row_attrs = form._layout.get_row_attrs(
+            bf.name, bf.field.required, bool(bf.errors))
+    else:
+        bf.row_attrs = _flatten_row_attrs(form._row_attrs.get(bf.name, {}),
+                                          bf.field.required, bf.errors)
     return bf
 
 
@@ -240,11 +330,64 @@ class BetterBaseForm(object):
     fieldsets.
 
     """
+    # A dictionary mapping field names to lists of validators, run on the
+    # cleaned value of each field that has no errors after all fields are
+    # cleaned and before ``clean()``. They may be coroutine functions;
+    # ``afull_clean`` runs them all concurrently (see ``form_utils.aio``).
+    async_validators = {}
+
     def __init__(self, *args, **kwargs):
-        self._fieldsets = deepcopy(self.base_fieldsets)
-        self._row_attrs = deepcopy(self.base_row_attrs)
+        self._layout = kwargs.pop('layout', None)
+        if self._layout is not None:
+            self._fieldsets = self._layout.fieldsets
+            self._row_attrs = self._layout.row_attrs
+        else:
+            self._fieldsets = deepcopy(self.base_fieldsets)
+            self._row_attrs = deepcopy(self.base_row_attrs)
         self._fieldset_collection = None
         super(BetterBaseForm, self).__init__(*args, **kwargs)
+        use_choice_cache(self)
+
+    def _media_key(self):
+        keys = tuple(media_key(field.widget) for field in self.fields.values())
+        if None in keys:
+            return None
+        return (type(self), keys)
+
+    @property
+    def media(self):
+        # The merged media of the widgets is computed once for all forms
+        # of this class whose widgets have the same media_key.
+        key = self._media_key()
+        if key is None:
+            return super(BetterBaseForm, self).media
+        cls = type(self)
+        cache = cls.__dict__.get('_media_cache')
+        if cache is None:
+            cache = cls._media_cache = {}
+        try:
+            media = cache[key]
+        except KeyError:
+            media = cache[key] = super(BetterBaseForm, self).media
+        # a copy, as Media can be modified in place
+        return forms.Media() + media
+
+    @classmethod
+    def get_layout(cls):
+        """
+        Return the shared ``FormLayout`` for this form class.
+
+        Passing it to the constructor as ``layout`` makes the form use it
+        instead of its own copies of ``base_fieldsets`` and
+        ``base_row_attrs``; forms sharing a layout must not modify their
+        fieldsets or row_attrs.
+
+        """
+        layout = cls.__dict__.get('_shared_layout')
+        if layout is None:
+            layout = FormLayout(cls.base_fieldsets, cls.base_row_attrs)
+            cls._shared_layout = layout
+        return layout
 
     @property
     def fieldsets(self):
@@ -261,16 +404,145 @@ class BetterBaseForm(object):
         bf = super(BetterBaseForm, self).__getitem__(name)
         return _mark_row_attrs(bf, self)
 
+    def full_clean(self):
+        if not self.async_validators:
+            return super(BetterBaseForm, self).full_clean()
+        if self._begin_full_clean():
+            self._run_async_validators()
+            self._finish_full_clean()
+
+    # ``full_clean`` in two parts, around the async validators.
+
+    def _begin_full_clean(self):
+        """Clean the fields; return False if validation is complete."""
+        self._errors = ErrorDict()
+        if not self.is_bound:
+            return False
+        self.cleaned_data = {}
+        if self.empty_permitted and not self.has_changed():
+            return False
+        self._clean_fields()
+        return True
+
+    def _finish_full_clean(self):
+        self._clean_form()
+        self._post_clean()
+
+    def _async_validator_calls(self):
+        """
+        Return a ``(name, validator, value)`` tuple for each async
+        validator to run, in field and then validator order.
+
+        """
+        calls = []
+        for name, field in self.fields.items():
+            validators = self.async_validators.get(name)
+            if (not validators or name in self._errors or
+                    name not in self.cleaned_data):
+                continue
+            value = self.cleaned_data[name]
+            # Django < 1.6 compatibility: fields have no empty_values
+            if value in getattr(field, 'empty_values', EMPTY_VALUES):
+                continue
+            calls.extend((name, v, value) for v in validators)
+        return calls
+
+    def _add_async_errors(self, errors):
+        """Add ``(name, ValidationError)`` pairs, in order, to the errors."""
+        for name, error in errors:
+            self.add_error(name, error)
+
+    def _run_async_validators(self):
+        errors = []
+        for name, validator, value in self._async_validator_calls():
+            try:
+                result = validator(value)
+                if hasattr(result, '__await__'):
+                    from .aio import run_sync
+                    run_sync(result)
+            except ValidationError as e:
+                errors.append((name, e))
+        self._add_async_errors(errors)
+
+    # The asyncio entry points live in ``form_utils.aio``, which is
+    # imported lazily as it requires Python 3.5 or later.
+
+    def arender(self, template_name=None, **kwargs):
+        """Return a coroutine rendering this form; see ``aio.arender``."""
+        from .aio import arender
+        return arender(self, template_name, **kwargs)
+
+    def ais_valid(self, **kwargs):
+        """Return a coroutine validating this form; see ``aio.ais_valid``."""
+        from .aio import ais_valid
+        return ais_valid(self, **kwargs)
+
+    def afull_clean(self, **kwargs):
+        """Return a coroutine cleaning this form; see ``aio.afull_clean``."""
+        from .aio import afull_clean
+        return afull_clean(self, **kwargs)
+
 
 class BetterForm(with_metaclass(BetterFormMetaclass, BetterBaseForm),
                  forms.Form):
     __doc__ = BetterBaseForm.__doc__
 
 
+def changed_model_fields(form, instance=None):
+    """
+    Return the names of the concrete model fields of ``instance``
+    (defaults to ``form.instance``) whose form fields have changed, and,
+    if there are any, of its ``auto_now`` fields, which are updated on
+    every save.
+
+    """
+    opts = (instance if instance is not None else form.instance)._meta
+    # Django < 1.6 compatibility: no concrete_fields, but no virtual fields
+    # in fields either
+    fields = [f for f in getattr(opts, 'concrete_fields', opts.fields)
+              if not f.primary_key]
+    concrete = set(f.name for f in fields)
+    names = [name for name in form.changed_data if name in concrete]
+    if names:
+        names.extend(f.name for f in fields
+                     if getattr(f, 'auto_now', False) and f.name not in names)
+    return names
+
+
 class BetterModelForm(with_metaclass(BetterModelFormMetaclass,
                                      BetterBaseForm), forms.ModelForm):
     __doc__ = BetterBaseForm.__doc__
 
+    # If True, saving an existing instance only writes the model fields
+    # whose form fields changed (using ``update_fields``), and doesn't
+    # touch the database at all if nothing changed.
+    save_changed_only = False
+
+    # If True, files cleared or replaced through this form are queued for
+    # deletion when it is saved (see ``form_utils.cleanup``).
+    delete_replaced_files = False
+
+    def save(self, commit=True):
+        instance = self._save(commit)
+        if commit:
+            discard_stashed_uploads(self.cleaned_data)
+            if self.delete_replaced_files:
+                queue_replaced_files(self, instance)
+        return instance
+
+    def _save(self, commit):
+        instance = self.instance
+        if not (commit and self.save_changed_only and
+                SUPPORTS_UPDATE_FIELDS and not instance._state.adding):
+            return super(BetterModelForm, self).save(commit)
+        instance = super(BetterModelForm, self).save(commit=False)
+        update_fields = changed_model_fields(self, instance)
+        if update_fields:
+            instance.save(update_fields=update_fields)
+        if set(self.changed_data) - set(update_fields):
+            self.save_m2m()
+        return instance
+
 
 class BasePreviewFormMixin(object):
     """
@@ -283,10 +555,35 @@ class BasePreviewFormMixin(object):
     be marked invalid (though this invalidation will not put an error in
     its ``errors`` dictionary).
 
+    If ``use_preview_token`` is ``True``, the form is also validated
+    during preview, and if it is valid ``preview_token`` holds a signed
+    token of its cleaned data and a digest of the submitted data (render
+    it with ``preview_token_input``). When the final submission carries a
+    valid token, less than ``preview_token_max_age`` seconds old, for
+    unchanged data (and the same prefix and instance), validation is
+    skipped: ``cleaned_data`` is restored from the token, and neither
+    validators, ``clean_<field>`` methods, ``clean()`` nor model
+    validation are run. ``preview_token_used`` is then ``True``.
+
+    Forms with file fields or other multi-value fields never issue a
+    token, since their data can't be verified this way, and neither do
+    forms whose cleaned data can't be restored exactly from JSON.
+
+    A token is signed for the form class only, so anyone can replay it
+    with the same data, skipping validation that depends on who submits
+    it. Pass something identifying the user or session (e.g. the session
+    key) as ``preview_token_salt`` to tie the token to it.
+
     """
+    use_preview_token = False
+    preview_token_name = 'preview_token'
+    preview_token_max_age = 60 * 60
+
     def __init__(self, *args, **kwargs):
+        self.preview_token_salt = kwargs.pop('preview_token_salt', '')
         super(BasePreviewFormMixin, self).__init__(*args, **kwargs)
         self.preview = self.check_preview(kwargs.get('data', None))
+        self.preview_token_used = False
 
     def check_preview(self, data):
         if data and data.get('submit', '').lower() == u'preview':
@@ -295,9 +592,150 @@ class BasePreviewFormMixin(object):
 
     def is_valid(self, *args, **kwargs):
         if self.preview:
+            if self.use_preview_token:
+                # validate now, so that a token can be issued
+                self.errors
             return False
         return super(BasePreviewFormMixin, self).is_valid()
 
+    def full_clean(self):
+        if self.async_validators:
+            # checked by _begin_full_clean
+            return super(BasePreviewFormMixin, self).full_clean()
+        if not self._clean_if_previewed():
+            super(BasePreviewFormMixin, self).full_clean()
+
+    def _begin_full_clean(self):
+        if self._clean_if_previewed():
+            return False
+        return super(BasePreviewFormMixin, self)._begin_full_clean()
+
+    def _clean_if_previewed(self):
+        """Restore the cleaned data from a valid token, if there is one."""
+        if not (self.use_preview_token and self.is_bound and
+                not self.preview):
+            return False
+        values = self._check_preview_token()
+        if values is None:
+            return False
+        try:
+            self._clean_previewed(values)
+        except ValidationError:
+            return False
+        return True
+
+    def _clean_previewed(self, values):
+        """Populate ``cleaned_data`` from already-validated data."""
+        self._errors = ErrorDict()
+        self.cleaned_data = self._restore_cleaned_data(values)
+        if isinstance(self, forms.BaseModelForm):
+            opts = self._meta
+            self.instance = construct_instance(
+                self, self.instance, opts.fields, opts.exclude)
+        self.preview_token_used = True
+
+    def _restore_cleaned_data(self, values):
+        cleaned_data = {}
+        for name, value in values.items():
+            field = self.fields.get(name)
+            if field is None:
+                cleaned_data[name] = value
+            elif isinstance(field, forms.ModelMultipleChoiceField):
+                key = '%s__in' % (field.to_field_name or 'pk')
+                cleaned_data[name] = field.queryset.filter(**{key: value})
+            else:
+                cleaned_data[name] = field.to_python(value)
+        return cleaned_data
+
+    def _serialize_cleaned_data(self):
+        """
+        Return a JSON-compatible form of ``cleaned_data`` from which
+        ``_restore_cleaned_data`` restores equal data, or ``None``.
+
+        """
+        values = {}
+        for name, value in self.cleaned_data.items():
+            field = self.fields.get(name)
+            if field is not None:
+                value = field.prepare_value(value)
+            try:
+                values[name] = json.loads(
+                    json.dumps(value, cls=DjangoJSONEncoder))
+            except TypeError:
+                return None
+        try:
+            restored = self._restore_cleaned_data(values)
+        except ValidationError:
+            return None
+        for name, value in self.cleaned_data.items():
+            if isinstance(self.fields.get(name),
+                          forms.ModelMultipleChoiceField):
+                same = (sorted(o.pk for o in restored[name]) ==
+                        sorted(o.pk for o in value))
+            else:
+                same = restored[name] == value
+            if not same:
+                return None
+        return values
+
+    def _preview_salt(self):
+        return 'form_utils.preview:%s.%s:%s' % (
+            self.__class__.__module__, self.__class__.__name__,
+            self.preview_token_salt)
+
+    def _preview_digest(self):
+        instance = getattr(self, 'instance', None)
+        values = [self.prefix, getattr(instance, 'pk', None)]
+        for name, field in self.fields.items():
+            if isinstance(field, (forms.FileField, forms.MultiValueField)):
+                return None
+            values.append([name, field.widget.value_from_datadict(
+                self.data, self.files, self.add_prefix(name))])
+        serialized = json.dumps(values, default=six.text_type)
+        return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+    def _check_preview_token(self):
+        """Return the cleaned values of a valid token, or ``None``."""
+        token = self.data.get(self.add_prefix(self.preview_token_name))
+        digest = token and self._preview_digest()
+        if not digest:
+            return None
+        try:
+            data = signing.loads(token, salt=self._preview_salt(),
+                                 max_age=self.preview_token_max_age)
+        except signing.BadSignature:
+            return None
+        if not isinstance(data, dict) or data.get('d') != digest:
+            return None
+        return data.get('c')
+
+    @property
+    def preview_token(self):
+        """Signed token of the previewed data, or '' if not valid."""
+        if not (self.use_preview_token and self.preview) or self.errors:
+            return ''
+        # built once per form, as it serializes and signs the cleaned data
+        token = self.__dict__.get('_preview_token')
+        if token is None:
+            digest = self._preview_digest()
+            values = digest and self._serialize_cleaned_data()
+            token = ''
+            if values is not None:
+                token = signing.dumps({'d': digest, 'c': values},
+                                      salt=self._preview_salt(),
+                                      compress=True)
+            self._preview_token = token
+        return token
+
+    @property
+    def preview_token_input(self):
+        """A hidden input carrying ``preview_token``, or ''."""
+        token = self.preview_token
+        if not token:
+            return ''
+        return forms.HiddenInput().render(
+            self.add_prefix(self.preview_token_name), token)
+
 
 class PreviewModelForm(BasePreviewFormMixin, BetterModelForm):
     pass
@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+"""
+formsets for django-form-utils
+
+"""
+from __future__ import unicode_literals
+
+from functools import partial
+
+import django
+from django import forms
+from django.core.exceptions import ValidationError
+from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
+from django.core.validators import EMPTY_VALUES
+from django.db import connections, transaction
+from django.forms.formsets import BaseFormSet, formset_factory
+from django.forms.models import BaseModelFormSet, modelformset_factory
+from django.utils.encoding import force_text
+
+from .choices import queryset_key
+from .cleanup import queue_replaced_files
+from .forms import BetterModelForm, changed_model_fields
+from .uploads import discard_stashed_uploads
+
+
+class ChoiceLookup(object):
+    """
+    The objects of a model choice queryset matching the keys submitted
+    for any form of a formset, fetched in as few queries as possible.
+
+    """
+    def __init__(self, queryset, to_field_name=None):
+        self.queryset = queryset
+        self.key = to_field_name or 'pk'
+        opts = queryset.model._meta
+        self.model_field = (opts.get_field(to_field_name) if to_field_name
+                            else opts.pk)
+        self.keys = set()
+        self.objects = {}
+
+    def normalize(self, value):
+        try:
+            return force_text(self.model_field.to_python(value))
+        except (ValidationError, ValueError, TypeError):
+            return None
+
+    def add(self, value):
+        key = self.normalize(value)
+        if key is not None:
+            self.keys.add(key)
+
+    def fetch(self, batch_size):
+        keys = sorted(self.keys)
+        for i in range(0, len(keys), batch_size):
+            lookup = {'%s__in' % self.key: keys[i:i + batch_size]}
+            for obj in self.queryset.filter(**lookup):
+                self.objects[force_text(getattr(obj, self.key))] = obj
+
+    def get(self, value):
+        return self.objects.get(self.normalize(value))
+
+
+def _batched_to_python(field, lookup, value):
+    """``ModelChoiceField.to_python`` using a ``ChoiceLookup``."""
+    # Django < 1.6 compatibility: fields have no empty_values
+    if value in getattr(field, 'empty_values', EMPTY_VALUES):
+        return None
+    obj = lookup.get(value)
+    if obj is None:
+        raise ValidationError(field.error_messages['invalid_choice'],
+                              code='invalid_choice')
+    return obj
+
+
+def _batched_clean_multiple(field, lookup, value):
+    """``ModelMultipleChoiceField.clean`` using a ``ChoiceLookup``."""
+    if field.required and not value:
+        raise ValidationError(field.error_messages['required'],
+                              code='required')
+    elif not field.required and not value:
+        return []
+    if not isinstance(value, (list, tuple)):
+        raise ValidationError(field.error_messages['list'], code='list')
+    objects = []
+    for val in value:
+        obj = lookup.get(val)
+        if obj is None:
+            message = field.error_messages['invalid_choice']
+            if django.VERSION < (1, 6):
+                # Django < 1.6 compatibility: params aren't interpolated,
+                # and the message takes the value as %s
+                raise ValidationError(message % val, code='invalid_choice')
+            raise ValidationError(message, code='invalid_choice',
+                                  params={'value': val})
+        if obj not in objects:
+            objects.append(obj)
+    field.run_validators(value)
+    return objects
+
+
+class BetterFormSetMixin(object):
+    """
+    Mixin for formsets of ``BetterForm`` or ``BetterModelForm``.
+
+    All forms of the formset share the ``FormLayout`` of the form class,
+    so the fieldsets and row_attrs are resolved and flattened, and the
+    ``render`` filter's template selected, once rather than for every
+    form.
+
+    If ``batch_choice_validation`` is ``True``, the submitted values of
+    the model choice fields of all forms are checked together before the
+    forms are cleaned, with one query per distinct queryset (per
+    ``choice_validation_batch_size`` keys), rather than one or more
+    queries per field of every form. The cleaned value of a
+    ``ModelMultipleChoiceField`` is then a list of objects rather than a
+    queryset.
+
+    """
+    batch_choice_validation = False
+    choice_validation_batch_size = 500
+
+    @property
+    def layout(self):
+        return self.form.get_layout()
+
+    @property
+    def media(self):
+        # the media of each distinct kind of form, merged once
+        media = forms.Media()
+        seen = set()
+        for form in self.forms or [self.empty_form]:
+            key = form._media_key()
+            if key is None or key not in seen:
+                seen.add(key)
+                media = media + form.media
+        return media
+
+    def _construct_form(self, i, **kwargs):
+        kwargs.setdefault('layout', self.layout)
+        return super(BetterFormSetMixin, self)._construct_form(i, **kwargs)
+
+    def full_clean(self):
+        if self.batch_choice_validation and self.is_bound:
+            self._batch_choices()
+        super(BetterFormSetMixin, self).full_clean()
+
+    def _batch_choices(self):
+        lookups = {}
+        for form in self.forms:
+            for name, field in form.fields.items():
+                if (not isinstance(field, forms.ModelChoiceField) or
+                        getattr(field, 'disabled', False)):
+                    continue
+                key = (queryset_key(field.queryset), field.to_field_name)
+                if key[0] is None:
+                    continue
+                lookup = lookups.get(key)
+                if lookup is None:
+                    lookup = lookups[key] = ChoiceLookup(
+                        field.queryset, field.to_field_name)
+                value = field.widget.value_from_datadict(
+                    form.data, form.files, form.add_prefix(name))
+                if isinstance(field, forms.ModelMultipleChoiceField):
+                    for val in value or ():
+                        lookup.add(val)
+                    # shadow the class's methods on this form's copy only
+                    field.clean = partial(_batched_clean_multiple,
+                                          field, lookup)
+                else:
+                    lookup.add(value)
+                    field.to_python = partial(_batched_to_python,
+                                              field, lookup)
+        for lookup in lookups.values():
+            lookup.fetch(self.choice_validation_batch_size)
+
+
+class BaseBetterFormSet(BetterFormSetMixin, BaseFormSet):
+    pass
+
+
+def bulk_update(model, objs, fields, batch_size=None):
+    """
+    Save the given model ``fields`` of existing instances ``objs`` with
+    one UPDATE query per batch (using ``CASE`` on the primary key).
+
+    Like ``QuerySet.bulk_update`` in later Django versions, ``save()``
+    is not called and no signals are sent, but each field's
+    ``pre_save`` is, so uploaded files are committed to storage.
+    Requires Django 1.8 or later.
+
+    A field that is NULL on every instance of a batch is set without
+    ``CASE``: PostgreSQL can't infer its type, and ``Cast`` requires
+    Django 1.10.
+
+    """
+    # Django < 1.8 compatibility: conditional expressions are imported here
+    # so that the module can still be imported.
+    from django.db.models import Case, Value, When
+    try:
+        from django.db.models.functions import Cast
+    except ImportError:  # Django < 1.10 compatibility
+        Cast = None
+    if not objs or not fields:
+        return
+    manager = model._default_manager
+    connection = connections[manager.db]
+    # PostgreSQL can't infer the type of the parameters in CASE (an
+    # all-NULL batch would be text), so they are cast to the field's type.
+    cast = Cast is not None and getattr(
+        connection.features, 'requires_casted_case_in_updates',
+        connection.vendor == 'postgresql')
+    max_batch_size = connection.ops.bulk_batch_size(
+        ['pk', 'pk'] + list(fields), objs)
+    batch_size = min(batch_size or max_batch_size, max_batch_size) or 1
+    for obj in objs:
+        for field in fields:
+            setattr(obj, field.attname, field.pre_save(obj, False))
+    for i in range(0, len(objs), batch_size):
+        batch = objs[i:i + batch_size]
+        updates = {}
+        for field in fields:
+            values = [getattr(obj, field.attname) for obj in batch]
+            if all(value is None for value in values):
+                updates[field.name] = None
+                continue
+            whens = []
+            for obj, value in zip(batch, values):
+                value = Value(value, output_field=field)
+                if cast:
+                    value = Cast(value, output_field=field)
+                whens.append(When(pk=obj.pk, then=value))
+            updates[field.name] = Case(*whens, output_field=field)
+        manager.filter(pk__in=[obj.pk for obj in batch]).update(**updates)
+
+
+def _remote_field(field):
+    # Django < 1.9 compatibility
+    return getattr(field, 'remote_field', None) or field.rel
+
+
+class _Window(list):
+    """
+    The fetched objects of a paginated formset, with the ``db`` of their
+    queryset (Django < 1.7 reads it from ``get_queryset()``).
+
+    """
+    def __init__(self, queryset):
+        super(_Window, self).__init__(queryset.iterator())
+        self.db = queryset.db
+
+
+class BaseBetterModelFormSet(BetterFormSetMixin, BaseModelFormSet):
+    """
+    Base class for model formsets of ``BetterModelForm``.
+
+    If ``paginate_by`` is set, the formset edits only one page of its
+    queryset at a time: the ``page`` keyword argument selects the page
+    (``1`` by default, out of range values select the first or last
+    page), and only that page's objects are fetched (with
+    ``iterator()``) and turned into forms. A bound formset fetches just
+    the objects whose primary keys were submitted, so it validates and
+    saves exactly the rows that were posted, even if the queryset has
+    changed since the page was rendered.
+
+    """
+    paginate_by = None
+
+    def __init__(self, *args, **kwargs):
+        self.page_number = kwargs.pop('page', 1)
+        super(BaseBetterModelFormSet, self).__init__(*args, **kwargs)
+
+    @property
+    def page(self):
+        """The ``Page`` of the queryset edited by this formset, or ``None``."""
+        if self.paginate_by is None:
+            return None
+        if not hasattr(self, '_page'):
+            paginator = Paginator(
+                super(BaseBetterModelFormSet, self).get_queryset(),
+                self.paginate_by)
+            try:
+                self._page = paginator.page(self.page_number)
+            except PageNotAnInteger:
+                self._page = paginator.page(1)
+            except EmptyPage:
+                self._page = paginator.page(paginator.num_pages)
+        return self._page
+
+    def get_queryset(self):
+        if self.paginate_by is None:
+            return super(BaseBetterModelFormSet, self).get_queryset()
+        if not hasattr(self, '_window'):
+            if self.is_bound:
+                qs = super(BaseBetterModelFormSet, self).get_queryset()
+                qs = qs.filter(pk__in=self._submitted_pks())
+            else:
+                qs = self.page.object_list
+            self._window = _Window(qs)
+        return self._window
+
+    def _submitted_pks(self):
+        pk_field = self.model._meta.pk
+        pks = []
+        for i in range(self.initial_form_count()):
+            value = self.data.get('%s-%s' % (self.add_prefix(i),
+                                             pk_field.name))
+            try:
+                value = pk_field.to_python(value)
+            except ValidationError:
+                continue
+            if value is not None:
+                pks.append(value)
+        return pks
+
+    def _model_fields(self, form):
+        """The concrete model fields set from ``form``, and auto_now ones."""
+        return [f for f in form.instance._meta.concrete_fields
+                if not f.primary_key and (
+                    (f.name in form.fields and f.editable) or
+                    getattr(f, 'auto_now', False))]
+
+    def _update_groups(self, changed_forms):
+        """
+        Group the instances of ``changed_forms`` by the model fields to
+        update: all those set from the form, or, if it has
+        ``save_changed_only``, only the changed ones.
+
+        """
+        groups = {}
+        order = []
+        for form, obj in changed_forms:
+            fields = self._model_fields(form)
+            if getattr(form, 'save_changed_only', False):
+                names = set(changed_model_fields(form, obj))
+                fields = [f for f in fields if f.name in names]
+            if not fields:
+                continue
+            key = tuple(f.name for f in fields)
+            if key not in groups:
+                groups[key] = (fields, [])
+                order.append(key)
+            groups[key][1].append(obj)
+        return [groups[key] for key in order]
+
+    def _m2m_fields(self, form):
+        """The many-to-many fields with auto-created through models."""
+        return [f for f in form.instance._meta.many_to_many
+                if f.name in form.fields and f.name in form.cleaned_data and
+                _remote_field(f).through._meta.auto_created]
+
+    def bulk_save(self, batch_size=None):
+        """
+        Save the formset like ``save()``, but with as few queries as
+        possible: all new instances are inserted with ``bulk_create``,
+        all changed instances updated with ``bulk_update`` (only in the
+        fields covered by the form, or only in the changed ones if the
+        form has ``save_changed_only``), deleted instances deleted with
+        one query, and the many-to-many relations of all saved instances
+        replaced with one delete and one insert per relation. Stashed
+        uploads are discarded and, with ``delete_replaced_files``,
+        replaced files queued for deletion as ``BetterModelForm.save()``
+        does.
+
+        Model ``save()`` methods are not called, and no ``pre_save``,
+        ``post_save`` or ``m2m_changed`` signals are sent; deleting
+        instances still sends ``pre_delete`` and ``post_delete``, as
+        ``QuerySet.delete()`` does. Requires Django 1.8 or later.
+
+        If the database can't return the primary keys of bulk-inserted
+        rows (e.g. SQLite before Django 1.10), new instances are returned
+        with ``pk=None``, except those whose form has many-to-many
+        fields, which are saved one by one.
+
+        Returns the list of new and changed instances.
+
+        """
+        self.new_objects = []
+        self.changed_objects = []
+        self.deleted_objects = []
+        changed_forms = []
+        new_forms = []
+        forms_to_delete = self.deleted_forms
+        for form in self.initial_forms:
+            obj = form.instance
+            if form in forms_to_delete:
+                if obj.pk is not None:
+                    self.deleted_objects.append(obj)
+            elif form.has_changed():
+                self.changed_objects.append((obj, form.changed_data))
+                changed_forms.append(
+                    (form, self.save_existing(form, obj, commit=False)))
+        for form in self.extra_forms:
+            if not form.has_changed():
+                continue
+            if self.can_delete and self._should_delete_form(form):
+                continue
+            new_forms.append((form, self.save_new(form, commit=False)))
+
+        manager = self.model._default_manager
+        features = connections[manager.db].features
+        returns_pks = (
+            getattr(features, 'can_return_ids_from_bulk_insert', False) or
+            getattr(features, 'can_return_rows_from_bulk_insert', False))
+        with transaction.atomic(using=manager.db):
+            if self.deleted_objects:
+                manager.filter(
+                    pk__in=[obj.pk for obj in self.deleted_objects]).delete()
+            bulk_new = []
+            for form, obj in new_forms:
+                if returns_pks or not self._m2m_fields(form):
+                    bulk_new.append(obj)
+                else:
+                    obj.save()
+            manager.bulk_create(bulk_new, batch_size=batch_size)
+            for fields, objs in self._update_groups(changed_forms):
+                bulk_update(self.model, objs, fields, batch_size=batch_size)
+            self._bulk_save_m2m(
+                new_forms,
+                [(form, obj) for form, obj in changed_forms
+                 if set(form.changed_data) & set(
+                     f.name for f in self._m2m_fields(form))],
+                batch_size)
+
+        for form, obj in new_forms + changed_forms:
+            discard_stashed_uploads(form.cleaned_data)
+        for form, obj in changed_forms:
+            if getattr(form, 'delete_replaced_files', False):
+                queue_replaced_files(form, obj)
+        self.new_objects = [obj for form, obj in new_forms]
+        return self.new_objects + [obj for form, obj in changed_forms]
+
+    def _bulk_save_m2m(self, new, changed, batch_size):
+        saved = new + changed
+        if not saved:
+            return
+        for field in self._m2m_fields(saved[0][0]):
+            through = _remote_field(field).through
+            source = field.m2m_field_name()
+            target = field.m2m_reverse_field_name()
+            rows = []
+            for form, obj in saved:
+                for value in form.cleaned_data[field.name] or ():
+                    rows.append(through(**{source: obj, target: value}))
+            if changed:
+                through._default_manager.filter(**{
+                    '%s__in' % source: [obj.pk for form, obj in changed]
+                }).delete()
+            through._default_manager.bulk_create(rows, batch_size=batch_size)
+
+
+def betterformset_factory(form, formset=BaseBetterFormSet, **kwargs):
+    """Like ``formset_factory``, defaulting to ``BaseBetterFormSet``."""
+    return formset_factory(form, formset=formset, **kwargs)
+
+
+def bettermodelformset_factory(model, form=BetterModelForm,
+                               formset=BaseBetterModelFormSet, **kwargs):
+    """Like ``modelformset_factory``, defaulting to ``BetterModelForm``."""
+    return modelformset_factory(model, form=form, formset=formset, **kwargs)
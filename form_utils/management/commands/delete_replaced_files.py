@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from form_utils.cleanup import get_deletion_queue
+
+
+class Command(BaseCommand):
+    help = ('Delete the files cleared or replaced through forms with '
+            'delete_replaced_files, recorded in '
+            'FORM_UTILS_DELETION_QUEUE_FILE.')
+
+    def handle(self, *args, **options):
+        deleted = get_deletion_queue().flush()
+        self.stdout.write('Deleted %d replaced files.\n' % deleted)
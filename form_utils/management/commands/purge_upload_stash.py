@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from form_utils.uploads import purge_stash
+
+
+class Command(BaseCommand):
+    help = ('Delete the stashed and directly uploaded files older than '
+            'FORM_UTILS_UPLOAD_STASH_MAX_AGE.')
+
+    def handle(self, *args, **options):
+        deleted = purge_stash()
+        self.stdout.write('Deleted %d stashed files.\n' % deleted)
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from form_utils.warmup import warm_up
+
+
+class Command(BaseCommand):
+    help = ('Warm up all BetterForm and BetterModelForm classes, checking '
+            'their fieldsets, and report the time taken.')
+
+    def handle(self, *args, **options):
+        report = warm_up()
+        if int(options['verbosity']) > 1:
+            for form_class in report.forms:
+                self.stdout.write('%s.%s\n' % (form_class.__module__,
+                                               form_class.__name__))
+        self.stdout.write('Warmed up %d form classes in %.1f ms.\n' % (
+            len(report.forms), report.seconds * 1000))
+        if report.problems:
+            for problem in report.problems:
+                self.stderr.write(problem + '\n')
+            raise CommandError('%d problems found in fieldsets.' %
+                               len(report.problems))
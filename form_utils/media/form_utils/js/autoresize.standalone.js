@@ -0,0 +1,103 @@
+/*
+ * Automatically resizing textareas for django-form-utils, without jQuery.
+ *
+ * Source of autoresize.min.js (used with FORM_UTILS_STANDALONE_AUTORESIZE);
+ * regenerate it with "python minify_js.py" after changing this file.
+ * Textareas with the "autoresize" class grow (and shrink) to fit their
+ * contents plus a line, like jquery.autogrow.js, no lower than their CSS
+ * min-height and up to their max-height, beyond which they scroll.
+ *
+ * Only textareas that changed are measured, in batches once per animation
+ * frame with all reads before all writes; initially all textareas are
+ * sized with one read pass and one write pass.
+ */
+(function() {
+    var requestFrame = window.requestAnimationFrame || function(callback) {
+            return window.setTimeout(callback, 16);
+        },
+        queue = [];
+
+    function isAutoresize(element) {
+        return element.tagName === 'TEXTAREA' &&
+            (' ' + element.className + ' ').indexOf(' autoresize ') !== -1;
+    }
+
+    function read(textarea) {
+        var style = window.getComputedStyle(textarea);
+        return {
+            textarea: textarea,
+            height: textarea.scrollHeight +
+                (parseFloat(style.borderTopWidth) || 0) +
+                (parseFloat(style.borderBottomWidth) || 0) +
+                (parseFloat(style.lineHeight) || 0),
+            minHeight: parseFloat(style.minHeight) || 0,
+            maxHeight: parseFloat(style.maxHeight) || 0
+        };
+    }
+
+    function write(size) {
+        var style = size.textarea.style,
+            height = Math.max(size.height, size.minHeight);
+        if (size.maxHeight > 0 && height > size.maxHeight) {
+            style.overflowY = 'auto';
+            height = size.maxHeight;
+        } else {
+            style.overflowY = 'hidden';
+        }
+        style.height = height + 'px';
+    }
+
+    function flush() {
+        var textareas = queue, sizes = [], i;
+        queue = [];
+        // collapse, measure, then resize: one layout for all of them
+        for (i = 0; i < textareas.length; i++) {
+            textareas[i].style.height = 'auto';
+        }
+        for (i = 0; i < textareas.length; i++) {
+            sizes.push(read(textareas[i]));
+        }
+        for (i = 0; i < sizes.length; i++) {
+            write(sizes[i]);
+        }
+    }
+
+    function schedule(textarea) {
+        if (queue.indexOf(textarea) === -1) {
+            if (!queue.length) {
+                requestFrame(flush);
+            }
+            queue.push(textarea);
+        }
+    }
+
+    function init() {
+        var all = document.getElementsByTagName('textarea'),
+            textareas = [], sizes = [], i;
+        for (i = 0; i < all.length; i++) {
+            if (isAutoresize(all[i])) {
+                textareas.push(all[i]);
+            }
+        }
+        for (i = 0; i < textareas.length; i++) {
+            sizes.push(read(textareas[i]));
+        }
+        for (i = 0; i < textareas.length; i++) {
+            textareas[i].style.display = 'block';
+            textareas[i].style.boxSizing = 'border-box';
+            write(sizes[i]);
+        }
+    }
+
+    document.addEventListener('input', function(event) {
+        if (isAutoresize(event.target)) {
+            schedule(event.target);
+        }
+    }, false);
+
+    if (document.readyState === 'loading') {
+        document.addEventListener('DOMContentLoaded', init, false);
+    } else {
+        init();
+    }
+})();
@@ -0,0 +1,77 @@
+/*
+ * Direct, chunked uploads for ClearableFileField (django-form-utils).
+ *
+ * A file selected in an <input type="file" data-upload-url="..."> is
+ * posted in chunks to form_utils.views.direct_upload; the returned token
+ * is put in the field's hidden input and the file input is cleared, so
+ * the form submission itself doesn't carry the file.
+ */
+(function() {
+    var CHUNK_SIZE = 1024 * 1024;
+
+    function csrfToken() {
+        var match = document.cookie.match(/(?:^|;\s*)csrftoken=([^;]+)/);
+        return match ? decodeURIComponent(match[1]) : '';
+    }
+
+    function post(url, body, done, fail) {
+        var xhr = new XMLHttpRequest();
+        xhr.open('POST', url, true);
+        xhr.setRequestHeader('Content-Type', 'application/octet-stream');
+        xhr.setRequestHeader('X-CSRFToken', csrfToken());
+        xhr.onload = function() {
+            if (xhr.status === 200) {
+                done(JSON.parse(xhr.responseText));
+            } else {
+                fail(xhr);
+            }
+        };
+        xhr.onerror = function() { fail(xhr); };
+        xhr.send(body);
+    }
+
+    function upload(input, file) {
+        var base = input.getAttribute('data-upload-url'),
+            sep = base.indexOf('?') === -1 ? '?' : '&',
+            hidden = input.form && input.form.elements[
+                input.name.replace(/_0$/, '_2')],
+            offset = 0,
+            uploadId = null;
+
+        function next() {
+            var end = Math.min(offset + CHUNK_SIZE, file.size),
+                params = (uploadId ?
+                    'upload=' + encodeURIComponent(uploadId) :
+                    'name=' + encodeURIComponent(file.name)) +
+                    '&offset=' + offset;
+            if (end === file.size) {
+                params += '&complete=1';
+            }
+            post(base + sep + params, file.slice(offset, end), function(data) {
+                uploadId = data.upload;
+                offset = end;
+                if (data.token) {
+                    hidden.value = data.token;
+                    input.value = '';
+                    input.removeAttribute('disabled');
+                } else {
+                    next();
+                }
+            }, function() {
+                // leave the file in the input to be submitted normally
+                input.removeAttribute('disabled');
+            });
+        }
+
+        input.setAttribute('disabled', 'disabled');
+        next();
+    }
+
+    document.addEventListener('change', function(event) {
+        var input = event.target;
+        if (input.getAttribute && input.getAttribute('data-upload-url') &&
+                input.files && input.files.length && window.Blob) {
+            upload(input, input.files[0]);
+        }
+    }, false);
+})();
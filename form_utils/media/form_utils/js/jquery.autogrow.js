@@ -1,132 +1,131 @@
-/* 
- * Auto Expanding Text Area (1.2.2)
- * by Chrys Bader (www.chrysbader.com)
- * chrysb@gmail.com
- *
- * Special thanks to:
- * Jake Chapa - jake@hybridstudio.com
- * John Resig - jeresig@gmail.com
- *
- * Copyright (c) 2008 Chrys Bader (www.chrysbader.com)
- * Licensed under the GPL (GPL-LICENSE.txt) license. 
- *
- *
- * NOTE: This script requires jQuery to work.  Download jQuery at www.jquery.com
- *
- */
- 
-(function(jQuery) {
-		  
-	var self = null;
- 
-	jQuery.fn.autogrow = function(o)
-	{	
-		return this.each(function() {
-			new jQuery.autogrow(this, o);
-		});
-	};
-	
-
-    /**
-     * The autogrow object.
-     *
-     * @constructor
-     * @name jQuery.autogrow
-     * @param Object e The textarea to create the autogrow for.
-     * @param Hash o A set of key/value pairs to set as configuration properties.
-     * @cat Plugins/autogrow
-     */
-	
-	jQuery.autogrow = function (e, o)
-	{
-		this.options		  	= o || {};
-		this.dummy			  	= null;
-		this.interval	 	  	= null;
-		this.line_height	  	= this.options.lineHeight || parseInt(jQuery(e).css('line-height'));
-		this.min_height		  	= this.options.minHeight || parseInt(jQuery(e).css('min-height'));
-		this.max_height		  	= this.options.maxHeight || parseInt(jQuery(e).css('max-height'));;
-		this.textarea		  	= jQuery(e);
-		
-		if(this.line_height == NaN)
-		  this.line_height = 0;
-		
-		// Only one textarea activated at a time, the one being used
-		this.init();
-	};
-	
-	jQuery.autogrow.fn = jQuery.autogrow.prototype = {
-    autogrow: '1.2.2'
-  };
-	
- 	jQuery.autogrow.fn.extend = jQuery.autogrow.extend = jQuery.extend;
-	
-	jQuery.autogrow.fn.extend({
-						 
-		init: function() {			
-			var self = this;			
-			this.textarea.css({overflow: 'hidden', display: 'block'});
-			this.textarea.bind('focus', function() { self.startExpand() } ).bind('blur', function() { self.stopExpand() });
-			this.checkExpand();	
-		},
-						 
-		startExpand: function() {				
-		  var self = this;
-			this.interval = window.setInterval(function() {self.checkExpand()}, 400);
-		},
-		
-		stopExpand: function() {
-			clearInterval(this.interval);	
-		},
-		
-		checkExpand: function() {
-			
-			if (this.dummy == null)
-			{
-				this.dummy = jQuery('<div></div>');
-				this.dummy.css({
-												'font-size'  : this.textarea.css('font-size'),
-												'font-family': this.textarea.css('font-family'),
-												'width'      : this.textarea.css('width'),
-												'padding'    : this.textarea.css('padding'),
-												'line-height': this.line_height + 'px',
-												'overflow-x' : 'hidden',
-												'position'   : 'absolute',
-												'top'        : 0,
-												'left'		 : -9999
-												}).appendTo('body');
-			}
-			
-			// Strip HTML tags
-			var html = this.textarea.val().replace(/(<|>)/g, '');
-			
-			// IE is different, as per usual
-			if ($.browser.msie)
-			{
-				html = html.replace(/\n/g, '<BR>new');
-			}
-			else
-			{
-				html = html.replace(/\n/g, '<br>new');
-			}
-			
-			if (this.dummy.html() != html)
-			{
-				this.dummy.html(html);	
-				
-				if (this.max_height > 0 && (this.dummy.height() + this.line_height > this.max_height))
-				{
-					this.textarea.css('overflow-y', 'auto');	
-				}
-				else
-				{
-					this.textarea.css('overflow-y', 'hidden');
-					if (this.textarea.height() < this.dummy.height() + this.line_height || (this.dummy.height() < this.textarea.height()))
-					{	
-						this.textarea.animate({height: (this.dummy.height() + this.line_height) + 'px'}, 100);	
-					}
-				}
-			}
-		}
-						 
-	 });
-})(jQuery);
\ No newline at end of file
+/*
+ * Auto Expanding Text Area (1.2.2)
+ * by Chrys Bader (www.chrysbader.com)
+ * chrysb@gmail.com
+ *
+ * Special thanks to:
+ * Jake Chapa - jake@hybridstudio.com
+ * John Resig - jeresig@gmail.com
+ *
+ * Copyright (c) 2008 Chrys Bader (www.chrysbader.com)
+ * Licensed under the GPL (GPL-LICENSE.txt) license.
+ *
+ * Reworked for django-form-utils: textareas are measured by their
+ * scrollHeight instead of a hidden copy of their contents, and only when
+ * they change. Measurements are batched once per animation frame, with
+ * all reads done before all writes, so typing doesn't force a layout per
+ * textarea, and a whole set of textareas is sized initially with a single
+ * read pass and a single write pass.
+ *
+ * NOTE: This script requires jQuery to work.  Download jQuery at www.jquery.com
+ *
+ */
+
+(function(jQuery) {
+
+	var requestFrame = window.requestAnimationFrame || function(callback) {
+			return window.setTimeout(callback, 16);
+		},
+		queue = [];
+
+	jQuery.fn.autogrow = function(o)
+	{
+		var items = [];
+		this.each(function() {
+			if (!jQuery.data(this, 'autogrow')) {
+				var item = new jQuery.autogrow(this, o);
+				jQuery.data(this, 'autogrow', item);
+				items.push(item);
+			}
+		});
+		// read pass, then write pass
+		jQuery.each(items, function() { this.read(); });
+		jQuery.each(items, function() { this.init(); this.write(); });
+		return this;
+	};
+
+    /**
+     * The autogrow object.
+     *
+     * @constructor
+     * @name jQuery.autogrow
+     * @param Object e The textarea to create the autogrow for.
+     * @param Hash o A set of key/value pairs to set as configuration properties.
+     * @cat Plugins/autogrow
+     */
+
+	jQuery.autogrow = function (e, o)
+	{
+		this.options		  	= o || {};
+		this.textarea		  	= e;
+		this.height				= null;
+		this.queued				= false;
+	};
+
+	jQuery.autogrow.fn = jQuery.autogrow.prototype = {
+    autogrow: '1.2.2'
+  };
+
+ 	jQuery.autogrow.fn.extend = jQuery.autogrow.extend = jQuery.extend;
+
+	function flush() {
+		var items = queue;
+		queue = [];
+		// collapse, measure, then resize: one layout for all of them
+		jQuery.each(items, function() {
+			this.queued = false;
+			this.textarea.style.height = 'auto';
+		});
+		jQuery.each(items, function() { this.read(); });
+		jQuery.each(items, function() { this.write(); });
+	}
+
+	jQuery.autogrow.fn.extend({
+
+		init: function() {
+			var self = this;
+			jQuery(this.textarea).css({overflow: 'hidden', display: 'block',
+									   'box-sizing': 'border-box'});
+			jQuery(this.textarea).bind('input keyup change', function() {
+				self.schedule();
+			});
+		},
+
+		schedule: function() {
+			if (!this.queued) {
+				this.queued = true;
+				if (!queue.length) {
+					requestFrame(flush);
+				}
+				queue.push(this);
+			}
+		},
+
+		read: function() {
+			var style = window.getComputedStyle(this.textarea);
+			if (this.line_height == null) {
+				this.line_height = this.options.lineHeight || parseFloat(style.lineHeight) || 0;
+				this.min_height = this.options.minHeight || parseFloat(style.minHeight) || 0;
+				this.max_height = this.options.maxHeight || parseFloat(style.maxHeight) || 0;
+				this.border = (parseFloat(style.borderTopWidth) || 0) +
+					(parseFloat(style.borderBottomWidth) || 0);
+			}
+			this.height = this.textarea.scrollHeight + this.border + this.line_height;
+		},
+
+		write: function() {
+			var height = Math.max(this.height, this.min_height);
+			if (this.max_height > 0 && height > this.max_height)
+			{
+				this.textarea.style.overflowY = 'auto';
+				height = this.max_height;
+			}
+			else
+			{
+				this.textarea.style.overflowY = 'hidden';
+			}
+			this.textarea.style.height = height + 'px';
+		}
+
+	 });
+})(jQuery);
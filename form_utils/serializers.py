@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+JSON descriptions of BetterForms for django-form-utils
+
+A form is described in two parts: its layout (fieldsets, field order,
+labels, widget kinds, required state and row_attrs), which only depends
+on the form class and the active language and is built and cached once
+per class, with an ETag; and its state (values and errors), which is all
+that needs to be sent for each request.
+
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.forms.forms import pretty_name
+from django.utils import translation
+from django.utils.encoding import force_text
+
+from .forms import _compile_fieldsets
+
+
+class FormJSONEncoder(DjangoJSONEncoder):
+    """
+    A ``DjangoJSONEncoder`` that encodes anything else it doesn't know
+    (lazy strings, model instances, ``FieldFile`` s) as text.
+
+    """
+    def default(self, o):
+        try:
+            return super(FormJSONEncoder, self).default(o)
+        except TypeError:
+            return force_text(o)
+
+
+def _text(value):
+    return None if value is None else force_text(value)
+
+
+def field_data(name, field, row_attrs=None):
+    """Return a dictionary describing the form field ``field``."""
+    widget = field.widget
+    label = field.label if field.label is not None else pretty_name(name)
+    return {
+        'name': name,
+        'label': force_text(label),
+        'help_text': force_text(field.help_text),
+        'widget': type(widget).__name__,
+        'input_type': getattr(widget, 'input_type', None),
+        'is_hidden': widget.is_hidden,
+        'required': field.required,
+        'row_attrs': dict((k, force_text(v))
+                          for k, v in (row_attrs or {}).items()),
+    }
+
+
+def fieldset_data(fieldset):
+    """Return a dictionary describing the bound ``Fieldset`` ``fieldset``."""
+    row_attrs = fieldset.form._row_attrs
+    return {
+        'name': fieldset.name,
+        'legend': _text(fieldset.legend),
+        'classes': fieldset.classes.split(),
+        'description': force_text(fieldset.description),
+        'fields': [field_data(bf.name, bf.field, row_attrs.get(bf.name))
+                   for bf in fieldset.boundfields],
+    }
+
+
+def layout_data(form):
+    """
+    Return a dictionary describing the layout of ``form``, a
+    ``BetterForm`` or ``BetterModelForm`` class or instance: a list of
+    ``fieldsets``, each with its ``name``, ``legend``, ``classes``,
+    ``description`` and ``fields`` in order.
+
+    Given a class, the layout of its ``base_fields`` is described; given a
+    form, that of its (possibly modified) ``fields``.
+
+    """
+    if not isinstance(form, type):
+        return {'fieldsets': [fieldset_data(fs) for fs in form.fieldsets]}
+    fields = form.base_fields
+    row_attrs = form.base_row_attrs
+    specs = _compile_fieldsets(
+        form.base_fieldsets or (('main', {'fields': fields, 'legend': ''}),),
+        fields)
+    fieldsets = []
+    for name, field_names, legend, classes, description in specs:
+        fieldsets.append({
+            'name': name,
+            'legend': _text(name if legend is None else legend),
+            'classes': classes.split(),
+            'description': force_text(description),
+            'fields': [field_data(n, fields[n], row_attrs.get(n))
+                       for n in field_names],
+        })
+    return {'fieldsets': fieldsets}
+
+
+def layout_json(form_class):
+    """
+    Return a ``(content, etag)`` tuple of the JSON layout of
+    ``form_class`` (see ``layout_data``) and a quoted ETag for it.
+
+    The result is built once per form class and language.
+
+    """
+    cache = form_class.__dict__.get('_layout_json')
+    if cache is None:
+        cache = form_class._layout_json = {}
+    language = translation.get_language()
+    try:
+        return cache[language]
+    except KeyError:
+        content = json.dumps(layout_data(form_class), cls=FormJSONEncoder,
+                             sort_keys=True, separators=(',', ':'))
+        etag = '"%s"' % hashlib.md5(content.encode('utf-8')).hexdigest()
+        cache[language] = (content, etag)
+        return content, etag
+
+
+def state_data(form):
+    """
+    Return a dictionary of the per-request state of ``form``: its field
+    ``values`` (as they would be rendered) and, if it is bound, its
+    ``errors``, as lists of messages by field name (``__all__`` for
+    non-field errors).
+
+    """
+    values = dict((name, form[name].value()) for name in form.fields)
+    errors = {}
+    if form.is_bound:
+        errors = dict((name, [force_text(e) for e in messages])
+                      for name, messages in form.errors.items())
+    return {'values': values, 'errors': errors}
+
+
+def state_json(form):
+    """Return the JSON state of ``form`` (see ``state_data``)."""
+    return json.dumps(state_data(form), cls=FormJSONEncoder,
+                      sort_keys=True, separators=(',', ':'))
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+import os
 import posixpath
+import tempfile
 
 from django.conf import settings
 
@@ -10,3 +12,51 @@ JQUERY_URL = getattr(
 
 if not ((':' in JQUERY_URL) or (JQUERY_URL.startswith('/'))):
     JQUERY_URL = posixpath.join(settings.STATIC_URL, JQUERY_URL)
+
+STANDALONE_AUTORESIZE = getattr(
+    settings, 'FORM_UTILS_STANDALONE_AUTORESIZE', False)
+
+UPLOAD_STASH_STORAGE = getattr(
+    settings, 'FORM_UTILS_UPLOAD_STASH_STORAGE', None)
+
+UPLOAD_STASH_DIR = getattr(
+    settings, 'FORM_UTILS_UPLOAD_STASH_DIR',
+    os.path.join(tempfile.gettempdir(), 'form_utils_stash'))
+
+UPLOAD_STASH_MAX_AGE = getattr(
+    settings, 'FORM_UTILS_UPLOAD_STASH_MAX_AGE', 60 * 60 * 24)
+
+THUMBNAIL_CACHE_SIZE = getattr(
+    settings, 'FORM_UTILS_THUMBNAIL_CACHE_SIZE', 256)
+
+THUMBNAIL_CACHE_BACKEND = getattr(
+    settings, 'FORM_UTILS_THUMBNAIL_CACHE_BACKEND', None)
+
+THUMBNAIL_CACHE_TIMEOUT = getattr(
+    settings, 'FORM_UTILS_THUMBNAIL_CACHE_TIMEOUT', 60 * 60 * 24)
+
+LOCAL_THUMBNAILS = getattr(settings, 'FORM_UTILS_LOCAL_THUMBNAILS', False)
+
+THUMBNAIL_DIR = getattr(
+    settings, 'FORM_UTILS_THUMBNAIL_DIR', 'form_utils_thumbs')
+
+THUMBNAIL_WORKERS = getattr(settings, 'FORM_UTILS_THUMBNAIL_WORKERS', 2)
+
+THUMBNAIL_WAIT = getattr(settings, 'FORM_UTILS_THUMBNAIL_WAIT', 0.1)
+
+THUMBNAIL_PLACEHOLDER_URL = getattr(
+    settings, 'FORM_UTILS_THUMBNAIL_PLACEHOLDER_URL',
+    'data:image/gif;base64,'
+    'R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
+
+DIRECT_UPLOAD_MAX_SIZE = getattr(
+    settings, 'FORM_UTILS_DIRECT_UPLOAD_MAX_SIZE', 100 * 1024 * 1024)
+
+DELETION_QUEUE_FILE = getattr(
+    settings, 'FORM_UTILS_DELETION_QUEUE_FILE', None)
+
+DELETION_BATCH_SIZE = getattr(settings, 'FORM_UTILS_DELETION_BATCH_SIZE', 100)
+
+DELETION_DELAY = getattr(settings, 'FORM_UTILS_DELETION_DELAY', 5)
+
+COMPACT_TEMPLATES = getattr(settings, 'FORM_UTILS_COMPACT_TEMPLATES', False)
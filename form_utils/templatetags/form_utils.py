@@ -10,11 +10,18 @@ from django import template
 from django.template.loader import render_to_string
 from django.utils import six
 
+from ..choices import get_choices
 from ..forms import BetterForm, BetterModelForm
+from ..settings import COMPACT_TEMPLATES
 from ..utils import select_template_from_string
 
 register = template.Library()
 
+_template_dir = 'form_utils/compact/' if COMPACT_TEMPLATES else 'form_utils/'
+FORM_TEMPLATE = _template_dir + 'form.html'
+BETTER_FORM_TEMPLATE = ','.join([_template_dir + 'better_form.html',
+                                 FORM_TEMPLATE])
+
 
 @register.filter
 def render(form, template_name=None):
@@ -34,11 +41,18 @@ def render(form, template_name=None):
     ``form_utils.forms.BetterModelForm``, the template
     ``form_utils/better_form.html`` will be used instead if present.
 
+    With ``FORM_UTILS_COMPACT_TEMPLATES``, the default templates are those
+    in ``form_utils/compact/`` instead.
+
     """
-    default = 'form_utils/form.html'
+    default = FORM_TEMPLATE
     if isinstance(form, (BetterForm, BetterModelForm)):
-        default = ','.join(['form_utils/better_form.html', default])
-    tpl = select_template_from_string(template_name or default)
+        default = BETTER_FORM_TEMPLATE
+    layout = getattr(form, '_layout', None)
+    if layout is not None:
+        tpl = layout.get_template(template_name or default)
+    else:
+        tpl = select_template_from_string(template_name or default)
 
     return tpl.render(template.Context({'form': form}))
 
@@ -60,8 +74,7 @@ def value_text(boundfield):
     """Return the value for given boundfield as human-readable text."""
     val = boundfield.value()
     # If choices is set, use the display label
-    return six.text_type(
-        dict(getattr(boundfield.field, "choices", [])).get(val, val))
+    return six.text_type(dict(get_choices(boundfield.field)).get(val, val))
 
 
 @register.filter
@@ -69,7 +82,7 @@ def selected_values(boundfield):
     """Return the values for given multiple-select as human-readable text."""
     val = boundfield.value()
     # If choices is set, use the display label
-    choice_dict = dict(getattr(boundfield.field, "choices", []))
+    choice_dict = dict(get_choices(boundfield.field))
     return [six.text_type(choice_dict.get(v, v)) for v in val]
 
 
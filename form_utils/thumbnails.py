@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+thumbnail caching for django-form-utils
+
+``ImageWidget`` renders its thumbnail HTML through ``thumbnail_cache``,
+a bounded LRU cache keyed by image name, a modification marker from its
+storage and the thumbnail size, optionally backed by a Django cache
+shared between processes. Rendering the same image again then costs no
+storage lookups or thumbnail generation.
+
+``ThumbnailEngine`` is a Pillow-based thumbnail generator used by
+``ImageWidget`` if neither sorl-thumbnail nor easy-thumbnails is
+installed (and ``FORM_UTILS_LOCAL_THUMBNAILS`` is set). Thumbnails are
+generated by a bounded pool of worker threads and kept in storage under
+a name derived from the source image and the thumbnail size; a
+placeholder is rendered while a thumbnail is being generated.
+
+"""
+from __future__ import unicode_literals
+
+import hashlib
+from io import BytesIO
+import os
+import posixpath
+import threading
+try:
+    from collections import OrderedDict
+except ImportError: # Python 2.6 compatibility
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, default_storage
+try:
+    from django.utils.encoding import force_bytes
+except ImportError: # Django < 1.5 compatibility
+    from django.utils.encoding import smart_str as force_bytes
+from django.utils import six
+from django.utils.html import escape
+
+from .settings import (
+    THUMBNAIL_CACHE_SIZE, THUMBNAIL_CACHE_BACKEND, THUMBNAIL_CACHE_TIMEOUT,
+    THUMBNAIL_DIR, THUMBNAIL_WORKERS, THUMBNAIL_WAIT,
+    THUMBNAIL_PLACEHOLDER_URL)
+
+try:
+    from concurrent.futures import ThreadPoolExecutor, TimeoutError
+except ImportError: # Python 2 without the futures backport
+    ThreadPoolExecutor = None
+
+    class TimeoutError(Exception):
+        pass
+
+
+def storage_marker(storage, name):
+    """
+    Return a marker that changes when the file ``name`` in ``storage``
+    is replaced under the same name: its modification time for local
+    storage, or ``None`` for other storages, where asking would cost a
+    request (Django gives replaced files new names anyway).
+
+    """
+    if isinstance(storage, FileSystemStorage):
+        try:
+            return os.path.getmtime(storage.path(name))
+        except (OSError, ValueError):
+            return None
+    return None
+
+
+def modification_marker(value):
+    """The ``storage_marker`` of the ``FieldFile`` ``value``."""
+    storage = getattr(value, 'storage', None)
+    return storage_marker(storage, value.name)
+
+
+def image_html(url, alt, **attrs):
+    extra = ''.join(' %s="%s"' % (name, escape(attrs[name]))
+                    for name in sorted(attrs))
+    return '<img src="%s" alt="%s"%s />' % (escape(url), escape(alt), extra)
+
+
+class PendingThumbnail(six.text_type):
+    """The HTML of a placeholder for a thumbnail not yet generated."""
+    cacheable = False
+
+
+class FailedThumbnail(six.text_type):
+    """The (empty) HTML for a thumbnail that failed, but may not next time."""
+    cacheable = False
+
+
+class ThumbnailCache(object):
+    """
+    A thread-safe LRU cache of up to ``maxsize`` rendered thumbnails,
+    optionally backed by the Django cache ``backend`` (an alias from
+    ``CACHES``).
+
+    """
+    def __init__(self, maxsize=THUMBNAIL_CACHE_SIZE,
+                 backend=THUMBNAIL_CACHE_BACKEND,
+                 timeout=THUMBNAIL_CACHE_TIMEOUT):
+        self.maxsize = maxsize
+        self.backend = backend
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def shared_cache(self):
+        if self.backend is None:
+            return None
+        try:
+            from django.core.cache import caches
+        except ImportError: # Django < 1.7 compatibility
+            from django.core.cache import get_cache
+            return get_cache(self.backend)
+        return caches[self.backend]
+
+    def shared_key(self, key):
+        return 'form_utils.thumbnail.%s' % hashlib.sha1(
+            force_bytes(repr(key))).hexdigest()
+
+    def get(self, key, render):
+        """
+        Return the cached thumbnail for ``key``, calling ``render()`` to
+        create it if it isn't cached.
+
+        """
+        if not self.maxsize and self.backend is None:
+            return render()
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                pass
+            else:
+                self._entries[key] = value
+                return value
+        shared_cache = self.shared_cache
+        value = None
+        if shared_cache is not None:
+            value = shared_cache.get(self.shared_key(key))
+        if value is None:
+            value = render()
+            if not getattr(value, 'cacheable', True):
+                return value
+            if shared_cache is not None:
+                shared_cache.set(self.shared_key(key), value, self.timeout)
+        self._set(key, value)
+        return value
+
+    def _set(self, key, value):
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                # the least recently used; SortedDict.popitem() takes no
+                # ``last`` argument
+                del self._entries[next(iter(self._entries))]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+thumbnail_cache = ThumbnailCache()
+
+
+# file extensions of the formats thumbnails are saved in
+THUMBNAIL_FORMATS = {
+    '.jpg': 'JPEG',
+    '.jpeg': 'JPEG',
+    '.png': 'PNG',
+    '.gif': 'GIF',
+    '.webp': 'WEBP',
+}
+
+
+class ThumbnailEngine(object):
+    """
+    Generates thumbnails of images in ``source_storage`` with Pillow,
+    saving them in ``storage`` under ``directory``.
+
+    ``render`` waits up to ``wait`` seconds for a thumbnail that has to
+    be generated, and renders a ``PendingThumbnail`` placeholder
+    (``placeholder_url``) if it isn't ready by then. At most
+    ``max_workers`` thumbnails are generated at once.
+
+    """
+    def __init__(self, storage=None, source_storage=None,
+                 directory=THUMBNAIL_DIR, max_workers=THUMBNAIL_WORKERS,
+                 wait=THUMBNAIL_WAIT, placeholder_url=THUMBNAIL_PLACEHOLDER_URL):
+        self.storage = storage or default_storage
+        self.source_storage = source_storage or default_storage
+        self.directory = directory
+        self.max_workers = max_workers
+        self.wait = wait
+        self.placeholder_url = placeholder_url
+        self._executor = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def thumbnail_name(self, image_path, width, height):
+        """
+        Return the storage name of the ``width`` x ``height`` thumbnail
+        of ``image_path``, derived from its name and modification marker.
+
+        """
+        digest = hashlib.sha1(force_bytes(repr((
+            image_path, storage_marker(self.source_storage, image_path),
+            width, height)))).hexdigest()
+        ext = os.path.splitext(image_path)[1].lower()
+        if ext not in THUMBNAIL_FORMATS:
+            ext = '.png'
+        return posixpath.join(self.directory, digest[:2], digest + ext)
+
+    def render(self, image_path, width, height):
+        """Return the HTML of an ``<img>`` for the thumbnail."""
+        name = self.thumbnail_name(image_path, width, height)
+        if not self.storage.exists(name):
+            try:
+                future = self._submit(image_path, width, height, name)
+                if future is not None:
+                    future.result(self.wait)
+            except TimeoutError:
+                return PendingThumbnail(image_html(
+                    self.placeholder_url, image_path,
+                    width=width, height=height))
+            except Exception:
+                # fall back to the original image
+                return image_html(self.source_storage.url(image_path),
+                                  image_path)
+        return image_html(self.storage.url(name), image_path)
+
+    def _submit(self, image_path, width, height, name):
+        if ThreadPoolExecutor is None or not self.max_workers:
+            self.generate(image_path, width, height, name)
+            return None
+        with self._lock:
+            future = self._pending.get(name)
+            if future is not None:
+                return future
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers)
+            future = self._pending[name] = self._executor.submit(
+                self.generate, image_path, width, height, name)
+        # outside the lock: the callback runs at once if already done
+        future.add_done_callback(lambda f: self._done(name))
+        return future
+
+    def _done(self, name):
+        with self._lock:
+            self._pending.pop(name, None)
+
+    def generate(self, image_path, width, height, name):
+        """Generate the thumbnail ``name`` of ``image_path``."""
+        from PIL import Image
+
+        image_format = THUMBNAIL_FORMATS.get(
+            os.path.splitext(name)[1], 'PNG')
+        source = self.source_storage.open(image_path, 'rb')
+        try:
+            image = Image.open(source)
+            if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.thumbnail((width, height))
+            output = BytesIO()
+            image.save(output, image_format)
+        finally:
+            source.close()
+        if not self.storage.exists(name):
+            self.storage.save(name, ContentFile(output.getvalue()))
+
+
+thumbnail_engine = ThumbnailEngine()
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+temporary storage of uploaded files for django-form-utils
+
+An upload that passed validation can be "stashed" in temporary storage
+when its form is redisplayed (after a preview or a validation error
+elsewhere in the form). The redisplayed form carries a signed reference
+to the stashed file instead of the file itself, so the user does not
+have to upload it again.
+
+A file can also be uploaded directly into the stash, in chunks, with
+``start_direct_upload``, ``append_chunk`` and ``finish_direct_upload``
+(see ``form_utils.views.direct_upload``); the form then only submits the
+resulting reference.
+
+The stash is the storage ``FORM_UTILS_UPLOAD_STASH_STORAGE``, by default
+a ``FileSystemStorage`` in ``FORM_UTILS_UPLOAD_STASH_DIR``; with several
+servers it must be shared by them. Direct uploads append to files in
+place, so they need a storage with local paths (e.g. on a shared volume).
+
+A stashed file is moved out of the stash when it is saved to a
+``FileSystemStorage`` from a local stash, and deleted when a
+``BetterModelForm`` (or ``ClearableFileFieldsAdmin``) using it is saved.
+``purge_stash`` (the ``purge_upload_stash`` management command) deletes
+files left in the stash for longer than
+``FORM_UTILS_UPLOAD_STASH_MAX_AGE``.
+
+"""
+from __future__ import unicode_literals
+
+import datetime
+import os
+import posixpath
+import time
+import uuid
+
+from django.core import signing
+from django.core.files import locks
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, get_storage_class
+from django.core.files.uploadedfile import UploadedFile
+from django.utils import timezone
+
+from .settings import (
+    UPLOAD_STASH_DIR, UPLOAD_STASH_MAX_AGE, UPLOAD_STASH_STORAGE)
+from .validators import sniff_content_type
+
+STASH_SALT = 'form_utils.uploads.stash'
+DIRECT_UPLOAD_SALT = 'form_utils.uploads.direct'
+
+if UPLOAD_STASH_STORAGE:
+    stash_storage = get_storage_class(UPLOAD_STASH_STORAGE)()
+else:
+    stash_storage = FileSystemStorage(location=UPLOAD_STASH_DIR)
+
+
+def _local_path(name):
+    # the local path of a file in the stash, or None if the storage has none
+    try:
+        return stash_storage.path(name)
+    except NotImplementedError:
+        return None
+
+
+def mark_for_stash(upload):
+    """Mark a validated ``UploadedFile`` as eligible for stashing."""
+    upload._form_utils_stash = True
+
+
+def stash_upload(upload):
+    """
+    Save ``upload`` (if it was marked by ``mark_for_stash`` and not yet
+    stashed) in the stash storage, and return a signed reference to it.
+
+    Returns ``None`` for anything that is not eligible for stashing.
+
+    """
+    token = getattr(upload, '_form_utils_stash_token', None)
+    if token is None and getattr(upload, '_form_utils_stash', False):
+        name = stash_storage.save(
+            posixpath.join(uuid.uuid4().hex, upload.name), upload)
+        token = signing.dumps({'n': name, 't': upload.content_type},
+                              salt=STASH_SALT)
+        upload._form_utils_stash_token = token
+    return token
+
+
+def load_stashed_upload(token, max_age=UPLOAD_STASH_MAX_AGE):
+    """
+    Return the stashed file for a reference returned by ``stash_upload``
+    as an ``UploadedFile``, or ``None`` if the reference is invalid,
+    expired, or the file is gone.
+
+    """
+    try:
+        data = signing.loads(token, salt=STASH_SALT, max_age=max_age)
+    except signing.BadSignature:
+        return None
+    name = data['n']
+    if not stash_storage.exists(name):
+        return None
+    upload_class = StashedUpload
+    if _local_path(name) is not None:
+        upload_class = LocalStashedUpload
+    upload = upload_class(stash_storage.open(name), name,
+                          content_type=data['t'],
+                          size=stash_storage.size(name))
+    upload._form_utils_stash_token = token
+    return upload
+
+
+class StashedUpload(UploadedFile):
+    """An upload loaded from the stash."""
+    def __init__(self, file, stash_name, **kwargs):
+        super(StashedUpload, self).__init__(
+            file, name=posixpath.basename(stash_name), **kwargs)
+        self.stash_name = stash_name
+
+    def discard(self):
+        """Delete the stashed file, if it is still there."""
+        self.file.close()
+        if stash_storage.exists(self.stash_name):
+            stash_storage.delete(self.stash_name)
+
+
+class LocalStashedUpload(StashedUpload):
+    """
+    An upload loaded from a stash with local paths. Like a
+    ``TemporaryUploadedFile``, it has a ``temporary_file_path``, so
+    ``FileSystemStorage`` moves it into place rather than copying it.
+
+    """
+    def temporary_file_path(self):
+        return stash_storage.path(self.stash_name)
+
+
+def discard_stashed_uploads(cleaned_data):
+    """Discard the stashed uploads among the values of ``cleaned_data``."""
+    for value in cleaned_data.values():
+        if isinstance(value, StashedUpload):
+            value.discard()
+
+
+def purge_stash(max_age=UPLOAD_STASH_MAX_AGE):
+    """
+    Delete the files in the stash (including unfinished direct uploads)
+    last modified more than ``max_age`` seconds ago, and any empty
+    directories. Returns the number of files deleted.
+
+    """
+    root = _local_path('')
+    if root is None:
+        return _purge_storage(max_age)
+    if not os.path.isdir(root):
+        return 0
+    limit = time.time() - max_age
+    deleted = 0
+    for path, dirs, files in os.walk(root, topdown=False):
+        emptied = False
+        for name in files:
+            filename = os.path.join(path, name)
+            try:
+                if os.path.getmtime(filename) < limit:
+                    os.remove(filename)
+                    deleted += 1
+                    emptied = True
+            except OSError:
+                pass
+        if path != root:
+            try:
+                # a new, empty directory may be about to get its file
+                if emptied or os.path.getmtime(path) < limit:
+                    os.rmdir(path)
+            except OSError:
+                # not empty
+                pass
+    return deleted
+
+
+def _modified_time(name):
+    try:
+        return stash_storage.get_modified_time(name)
+    except AttributeError:  # Django < 1.10 compatibility
+        return stash_storage.modified_time(name)
+
+
+def _purge_storage(max_age, path=''):
+    # purge_stash for storages without local paths
+    dirs, files = stash_storage.listdir(path)
+    deleted = 0
+    for name in files:
+        name = posixpath.join(path, name)
+        modified = _modified_time(name)
+        if timezone.is_aware(modified):
+            now = timezone.now()
+        else:
+            now = datetime.datetime.now()
+        if modified < now - datetime.timedelta(seconds=max_age):
+            stash_storage.delete(name)
+            deleted += 1
+    for name in dirs:
+        deleted += _purge_storage(max_age, posixpath.join(path, name))
+    return deleted
+
+
+class DirectUploadError(Exception):
+    pass
+
+
+def start_direct_upload(name):
+    """
+    Create an empty file for a direct upload of a file called ``name``
+    in the stash storage, and return a signed upload id for it.
+
+    """
+    name = stash_storage.save(
+        posixpath.join(uuid.uuid4().hex, posixpath.basename(name)),
+        ContentFile(b''))
+    return signing.dumps({'n': name}, salt=DIRECT_UPLOAD_SALT)
+
+
+def _direct_upload_name(upload_id):
+    try:
+        data = signing.loads(upload_id, salt=DIRECT_UPLOAD_SALT,
+                             max_age=UPLOAD_STASH_MAX_AGE)
+    except signing.BadSignature:
+        raise DirectUploadError('Invalid upload id.')
+    if not stash_storage.exists(data['n']):
+        raise DirectUploadError('Unknown upload.')
+    return data['n']
+
+
+def append_chunk(upload_id, stream, offset=None, max_size=None,
+                 chunk_size=64 * 1024):
+    """
+    Write the contents of the file-like ``stream`` to the direct upload
+    ``upload_id`` at ``offset`` (by default, its end), reading it in
+    pieces of ``chunk_size`` bytes, and return the size of the upload so
+    far.
+
+    Raises ``DirectUploadError`` if the upload id is invalid, if
+    ``offset`` is not the current size of the upload (the chunk is out of
+    order, or was already written), or if the upload grows larger than
+    ``max_size`` bytes. Chunks are written under an exclusive lock on the
+    file, so concurrent chunks are written (or rejected) one at a time.
+
+    """
+    name = _direct_upload_name(upload_id)
+    path = stash_storage.path(name)
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | getattr(os, 'O_BINARY', 0))
+    too_large = False
+    with os.fdopen(fd, 'ab') as destination:
+        locks.lock(destination, locks.LOCK_EX)
+        try:
+            # checked again under the lock, as another chunk may have been
+            # written since the caller learned the size
+            size = os.fstat(fd).st_size
+            if offset is None:
+                offset = size
+            elif offset != size:
+                raise DirectUploadError('Unexpected chunk offset.')
+            while True:
+                data = stream.read(chunk_size)
+                if not data:
+                    break
+                offset += len(data)
+                if max_size is not None and offset > max_size:
+                    too_large = True
+                    break
+                destination.write(data)
+            destination.flush()
+        finally:
+            locks.unlock(destination)
+    if too_large:
+        stash_storage.delete(name)
+        raise DirectUploadError('Upload too large.')
+    return offset
+
+
+def finish_direct_upload(upload_id):
+    """
+    Return a signed reference to the completed direct upload
+    ``upload_id``, which ``ClearableFileField`` accepts in place of a
+    file. Its content type is sniffed from the first bytes of the file.
+
+    """
+    name = _direct_upload_name(upload_id)
+    f = stash_storage.open(name)
+    try:
+        content_type = sniff_content_type(f.read(512))
+    finally:
+        f.close()
+    return signing.dumps({'n': name, 't': content_type}, salt=STASH_SALT)
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+from django.conf.urls import url
+
+from .views import direct_upload
+
+# The direct upload view does no access control of its own: only include
+# these URLs under a prefix that is otherwise protected, or wrap the view
+# yourself (see the README).
+urlpatterns = [
+    url(r'^upload/$', direct_upload, name='form_utils_direct_upload'),
+]
@@ -7,6 +7,9 @@ Time-stamp: <2009-03-26 12:32:41 carljm utils.py>
 """
 from __future__ import unicode_literals
 
+import django
+from django import forms
+from django.core.exceptions import ValidationError
 from django.template import loader
 
 
@@ -21,3 +24,60 @@ def select_template_from_string(arg):
     else:
         tpl = loader.get_template(arg)
     return tpl
+
+
+def validation_error(message, code, params):
+    """
+    Return a ``ValidationError`` with ``message``, ``code`` and
+    ``params``. Before Django 1.6, which doesn't interpolate ``params``,
+    the message is interpolated here.
+
+    """
+    if django.VERSION < (1, 6):  # Django < 1.6 compatibility
+        message = message % params
+    return ValidationError(message, code=code, params=params)
+
+
+def evaluate_choices(form):
+    """
+    Evaluate the queryset behind each ``ModelChoiceField`` (or
+    ``ModelMultipleChoiceField``) of a form once, and fix the result
+    as the field's choices.
+
+    After this, rendering the form's select widgets and using the
+    ``value_text`` and ``selected_values`` filters on its fields no
+    longer touch the database.
+    """
+    for field in form.fields.values():
+        if isinstance(field, forms.ModelChoiceField):
+            # iter() first, so list() doesn't run a COUNT query for len()
+            field.choices = list(iter(field.choices))
+
+
+def media_key(widget):
+    """
+    Return a hashable key that is the same for any two widgets with the
+    same ``media``, or ``None`` if that can't be told without computing
+    it.
+
+    The media of most widgets depends only on their class (and its
+    ``Media`` definitions); that of a ``MultiWidget`` on its
+    sub-widgets. Widgets whose ``media`` property depends on more can
+    provide a ``media_key()`` method.
+
+    """
+    key = getattr(widget, 'media_key', None)
+    if key is not None:
+        return key()
+    cls = type(widget)
+    # classes that define media other than through their Media class
+    owners = [klass for klass in cls.__mro__ if 'media' in klass.__dict__ and
+              getattr(getattr(klass.__dict__['media'], 'fget', None),
+                      '__name__', None) != '_media']
+    if not owners:
+        return cls
+    if owners == [forms.MultiWidget]:
+        keys = tuple(media_key(w) for w in widget.widgets)
+        if None not in keys:
+            return (cls, keys)
+    return None
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+validators for django-form-utils
+
+"""
+from __future__ import unicode_literals
+
+import hashlib
+
+import django
+from django.template.defaultfilters import filesizeformat
+from django.utils.translation import ugettext_lazy as _
+
+from .utils import validation_error
+
+# (leading bytes, content type) pairs recognized by ``sniff_content_type``
+MAGIC_NUMBERS = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+    (b'BM', 'image/bmp'),
+    (b'%PDF-', 'application/pdf'),
+    (b'PK\x03\x04', 'application/zip'),
+    (b'\x1f\x8b', 'application/gzip'),
+)
+
+
+def sniff_content_type(head):
+    """
+    Guess the content type of a file from its first bytes. Returns
+    ``text/plain`` for anything that looks like UTF-8 text, and
+    ``application/octet-stream`` if nothing matches.
+
+    """
+    for magic, content_type in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return content_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if b'\x00' not in head:
+        try:
+            # the chunk may end in the middle of a multi-byte character
+            head.decode('utf-8')
+            return 'text/plain'
+        except UnicodeDecodeError as e:
+            if e.start >= len(head) - 3:
+                return 'text/plain'
+    return 'application/octet-stream'
+
+
+def _type_allowed(content_type, allowed):
+    for pattern in allowed:
+        if pattern == content_type or (
+                pattern.endswith('/*') and
+                content_type.startswith(pattern[:-1])):
+            return True
+    return False
+
+
+class UploadValidator(object):
+    """
+    Validate an uploaded file while reading it in chunks of
+    ``chunk_size`` bytes, so memory use is bounded whatever its size.
+
+    ``max_size``: the maximum size of the file in bytes.
+
+    ``content_types``: the allowed content types (``image/*`` style
+    wildcards are allowed), as sniffed from the first bytes of the file
+    by ``sniff_content_type``; the browser-supplied content type is
+    ignored.
+
+    ``checksum``: the name of a ``hashlib`` algorithm; the hex digest
+    of the file is stored as its ``checksum`` attribute.
+
+    The file is only read as far as needed: not at all if only
+    ``max_size`` is given and the file's size is known, only the first
+    chunk if no ``checksum`` is requested. Validation stops at the first
+    failure.
+
+    """
+    messages = {
+        'max_size': _('Ensure this file is no larger than %(max_size)s.'),
+        'content_type': _('Files of type %(content_type)s are not allowed.'),
+    }
+
+    def __init__(self, max_size=None, content_types=None, checksum=None,
+                 chunk_size=64 * 1024):
+        self.max_size = max_size
+        self.content_types = content_types
+        self.checksum = checksum
+        self.chunk_size = chunk_size
+
+    def __call__(self, upload):
+        if not hasattr(upload, 'chunks'):
+            return
+        size = getattr(upload, 'size', None)
+        if self.max_size is not None and size is not None:
+            self._check_size(size)
+            if not (self.content_types or self.checksum):
+                return
+        digest = self.checksum and hashlib.new(self.checksum)
+        read = 0
+        if size is None and django.VERSION < (1, 6):
+            # Django < 1.6 compatibility: File.chunks() needs the size
+            upload.seek(0)
+            chunks = iter(lambda: upload.read(self.chunk_size), b'')
+        else:
+            chunks = upload.chunks(self.chunk_size)
+        try:
+            for chunk in chunks:
+                if not read and self.content_types:
+                    self._check_content_type(chunk)
+                read += len(chunk)
+                if self.max_size is not None:
+                    self._check_size(read)
+                if digest:
+                    digest.update(chunk)
+                elif self.max_size is None or size is not None:
+                    # nothing more to learn from the rest of the file
+                    break
+            else:
+                if not read and self.content_types:
+                    self._check_content_type(b'')
+        finally:
+            # leave the file ready for the next reader, even on failure
+            upload.seek(0)
+        if digest:
+            upload.checksum = digest.hexdigest()
+
+    def _check_size(self, size):
+        if size > self.max_size:
+            raise validation_error(
+                self.messages['max_size'], 'max_size',
+                {'max_size': filesizeformat(self.max_size)})
+
+    def _check_content_type(self, head):
+        content_type = sniff_content_type(head)
+        if not _type_allowed(content_type, self.content_types):
+            raise validation_error(
+                self.messages['content_type'], 'content_type',
+                {'content_type': content_type})
+
+    def __eq__(self, other):
+        return (isinstance(other, self.__class__) and
+                self.__dict__ == other.__dict__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.__class__, self.max_size,
+                     tuple(self.content_types or ()), self.checksum,
+                     self.chunk_size))
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+views for django-form-utils
+
+"""
+from __future__ import unicode_literals
+
+import json
+
+from django.http import HttpResponse, HttpResponseNotModified
+from django.views.decorators.http import require_GET, require_POST
+
+from .serializers import layout_json
+from .settings import DIRECT_UPLOAD_MAX_SIZE
+from .uploads import (
+    DirectUploadError, append_chunk, finish_direct_upload,
+    start_direct_upload)
+
+
+def _json_response(data, status=200):
+    return HttpResponse(json.dumps(data), status=status,
+                        content_type='application/json')
+
+
+@require_POST
+def direct_upload(request, max_size=DIRECT_UPLOAD_MAX_SIZE):
+    """
+    Receive one chunk of a direct upload, as the raw request body (so it
+    is never parsed by Django's upload handlers), and write it straight
+    to the upload stash.
+
+    The first chunk is posted with the file's ``name`` in the query
+    string, and the response contains the ``upload`` id to post the
+    following chunks with, one at a time, each with its ``offset`` in the
+    file. The last chunk is posted with ``complete=1``, and the response
+    contains the ``token`` to submit to ``ClearableFileField`` in place of
+    the file.
+
+    This view does no authentication or authorization of its own; wrap it
+    with the access control of your site (e.g. ``login_required``) in your
+    URLconf.
+
+    """
+    try:
+        upload_id = request.GET.get('upload')
+        if not upload_id:
+            name = request.GET.get('name')
+            if not name:
+                raise DirectUploadError('No file name given.')
+            upload_id = start_direct_upload(name)
+        try:
+            offset = int(request.GET.get('offset', 0))
+        except ValueError:
+            raise DirectUploadError('Invalid chunk offset.')
+        size = append_chunk(upload_id, request, offset=offset,
+                            max_size=max_size)
+        data = {'upload': upload_id, 'size': size}
+        if request.GET.get('complete'):
+            data['token'] = finish_direct_upload(upload_id)
+    except DirectUploadError as e:
+        return _json_response({'error': '%s' % e}, status=400)
+    return _json_response(data)
+
+
+@require_GET
+def form_layout(request, form_class):
+    """
+    Return the JSON layout of ``form_class`` (see
+    ``form_utils.serializers.layout_data``) with an ``ETag``, or an empty
+    304 response if the client already has it.
+
+    """
+    content, etag = layout_json(form_class)
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+    if (if_none_match.strip() == '*' or
+            etag in [e.strip() for e in if_none_match.split(',')]):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type='application/json')
+    response['ETag'] = etag
+    return response
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+warming up of form classes for django-form-utils
+
+``warm_up()`` does up front the lazy work that would otherwise be done
+by the first requests served by a process: importing the ``forms``
+modules of installed apps and the thumbnail backends, and building the
+shared ``FormLayout`` of every ``BetterForm`` and ``BetterModelForm``
+class (with its templates), checking their fieldsets against their
+fields on the way. The layouts are only used by forms that share them,
+i.e. the forms of ``BetterFormSet`` s.
+
+"""
+from __future__ import unicode_literals
+
+from collections import namedtuple
+try:
+    from importlib import import_module
+except ImportError: # Python 2.6 compatibility
+    from django.utils.importlib import import_module
+from timeit import default_timer
+
+from django.conf import settings
+from django.template import TemplateDoesNotExist
+from django.utils.module_loading import module_has_submodule
+
+from .forms import BetterForm, BetterModelForm
+from .templatetags.form_utils import BETTER_FORM_TEMPLATE, FORM_TEMPLATE
+
+#: The templates used by the ``render`` filter.
+TEMPLATES = (FORM_TEMPLATE, BETTER_FORM_TEMPLATE)
+
+WarmUp = namedtuple('WarmUp', 'forms problems seconds')
+
+
+def form_classes():
+    """
+    Return all ``BetterForm`` and ``BetterModelForm`` subclasses defined
+    so far, sorted by module and name.
+
+    """
+    found = set()
+    pending = [BetterForm, BetterModelForm]
+    while pending:
+        for subclass in pending.pop().__subclasses__():
+            if subclass not in found:
+                found.add(subclass)
+                pending.append(subclass)
+    return sorted(found, key=lambda c: (c.__module__, c.__name__))
+
+
+def check_fieldsets(form_class):
+    """
+    Return a list of problems with the fieldsets of ``form_class``:
+    field names they include that the form class doesn't have.
+
+    """
+    problems = []
+    for name, options in form_class.base_fieldsets:
+        for field_name in options.get('fields', ()):
+            if field_name not in form_class.base_fields:
+                problems.append(
+                    "%s.%s: fieldset '%s' includes unknown field '%s'." % (
+                        form_class.__module__, form_class.__name__, name,
+                        field_name))
+    return problems
+
+
+def warm_form_class(form_class):
+    """Build and fill the shared ``FormLayout`` of ``form_class``."""
+    layout = form_class.get_layout()
+    layout.get_fieldset_specs(form_class.base_fields)
+    for name, field in form_class.base_fields.items():
+        for error in (False, True):
+            layout.get_row_attrs(name, field.required, error)
+    for template_name in TEMPLATES:
+        try:
+            layout.get_template(template_name)
+        except TemplateDoesNotExist:
+            pass
+
+
+def import_app_modules(modules):
+    """Import the given modules of all installed apps that have them."""
+    try:
+        from django.utils.module_loading import autodiscover_modules
+    except ImportError:  # Django < 1.7 compatibility
+        for app in settings.INSTALLED_APPS:
+            package = import_module(app)
+            for module in modules:
+                if module_has_submodule(package, module):
+                    import_module('%s.%s' % (app, module))
+    else:
+        autodiscover_modules(*modules)
+
+
+def warm_up(modules=('forms',)):
+    """
+    Import the given modules of all installed apps and the thumbnail
+    backends, and warm up every ``BetterForm`` and ``BetterModelForm``
+    class.
+
+    Return a ``WarmUp`` of the warmed up form classes, a list of the
+    problems found with their fieldsets, and the time taken in seconds.
+
+    """
+    start = default_timer()
+    # imports sorl-thumbnail or easy-thumbnails, if installed
+    import_module('form_utils.widgets')
+    if modules:
+        import_app_modules(modules)
+    classes = form_classes()
+    problems = []
+    for form_class in classes:
+        problems.extend(check_fieldsets(form_class))
+        warm_form_class(form_class)
+    return WarmUp(classes, problems, default_timer() - start)
@@ -8,13 +8,27 @@ parts of this code taken from http://www.djangosnippets.org/snippets/934/
 """
 from __future__ import unicode_literals
 
+import copy
+import hashlib
+import logging
+import os
 import posixpath
 
 from django import forms
 from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.files.images import ImageFile
+from django.utils import six
+from django.utils.functional import lazy
 from django.utils.safestring import mark_safe
 
-from .settings import JQUERY_URL
+from .settings import JQUERY_URL, LOCAL_THUMBNAILS, STANDALONE_AUTORESIZE
+from .thumbnails import (
+    FailedThumbnail, modification_marker, thumbnail_cache, thumbnail_engine)
+from .uploads import stash_upload
+from .utils import media_key
+
+logger = logging.getLogger(__name__)
 
 try:
     from sorl.thumbnail import get_thumbnail
@@ -33,9 +47,49 @@ except ImportError:
                 thumbnail_options)
             return u'<img src="%s" alt="%s" />' % (thumbnail.url, image_path)
     except ImportError:
-        def thumbnail(image_path, width, height):
-            absolute_url = posixpath.join(settings.MEDIA_URL, image_path)
-            return u'<img src="%s" alt="%s" />' % (absolute_url, image_path)
+        try:
+            import PIL
+        except ImportError:
+            PIL = None
+
+        if LOCAL_THUMBNAILS and PIL is not None:
+            def thumbnail(image_path, width, height):
+                return thumbnail_engine.render(image_path, width, height)
+        else:
+            def thumbnail(image_path, width, height):
+                absolute_url = posixpath.join(settings.MEDIA_URL, image_path)
+                return u'<img src="%s" alt="%s" />' % (absolute_url,
+                                                       image_path)
+
+
+def is_image(value):
+    """
+    Return ``True`` if ``value`` is an image file, without reading it.
+
+    The dimensions of an ``ImageFieldFile`` are read from the file itself
+    when first accessed, so rather than asking for them this trusts the
+    dimensions already cached on it or stored in the model's
+    ``width_field`` and ``height_field``, if any; unknown (``None``)
+    dimensions there mean the file could not be read as an image.
+    Otherwise an ``ImageFieldFile`` is assumed to be an image. An empty
+    file (with no name) is not an image.
+
+    """
+    if not value:
+        return False
+    if not isinstance(value, ImageFile):
+        return hasattr(value, 'width') and hasattr(value, 'height')
+    dimensions = value.__dict__.get('_dimensions_cache')
+    if dimensions is None:
+        field = getattr(value, 'field', None)
+        instance = getattr(value, 'instance', None)
+        names = [name for name in (getattr(field, 'width_field', None),
+                                   getattr(field, 'height_field', None))
+                 if name]
+        if instance is None or not names:
+            return True
+        dimensions = [getattr(instance, name, None) for name in names]
+    return None not in dimensions
 
 
 class ImageWidget(forms.FileInput):
@@ -50,8 +104,14 @@ class ImageWidget(forms.FileInput):
 
     def render(self, name, value, attrs=None):
         input_html = super(ImageWidget, self).render(name, value, attrs)
-        if hasattr(value, 'width') and hasattr(value, 'height'):
-            image_html = thumbnail(value.name, self.width, self.height)
+        image_html = ''
+        if is_image(value):
+            key = (value.name, modification_marker(value),
+                   self.width, self.height)
+            image_html = thumbnail_cache.get(
+                key, lambda: _thumbnail_or_empty(value.name, self.width,
+                                                 self.height))
+        if image_html:
             output = self.template % {'input': input_html,
                                       'image': image_html}
         else:
@@ -59,47 +119,145 @@ class ImageWidget(forms.FileInput):
         return mark_safe(output)
 
 
+def _not_an_image(error):
+    # Pillow raises an IOError (UnidentifiedImageError in later versions)
+    # for a file it can't read as an image, easy-thumbnails its own error
+    if type(error).__name__ in ('UnidentifiedImageError',
+                                'InvalidImageFormatError'):
+        return True
+    return (isinstance(error, IOError) and
+            'cannot identify image file' in '%s' % error)
+
+
+def _thumbnail_or_empty(image_path, width, height):
+    # A file that can't be thumbnailed renders no image. If it is not an
+    # image, that is cached like a thumbnail, so it isn't tried again on
+    # every render; other failures (of the storage, say) are not cached.
+    try:
+        return thumbnail(image_path, width, height)
+    except Exception as e:
+        if _not_an_image(e):
+            logger.info('Not rendering a thumbnail of %s: %s', image_path, e)
+            return ''
+        logger.exception('Could not render a thumbnail of %s', image_path)
+        return FailedThumbnail('')
+
+
 class ClearableFileInput(forms.MultiWidget):
     default_file_widget_class = forms.FileInput
     template = '%(input)s Clear: %(checkbox)s'
 
+    upload_url = None
+    # the state of the current render (see render)
+    value = None
+    stash_token = None
+
     def __init__(self, file_widget=None,
-                 attrs=None, template=None):
+                 attrs=None, template=None, upload_url=None):
         if template is not None:
             self.template = template
+        if upload_url is not None:
+            self.upload_url = upload_url
         file_widget = file_widget or self.default_file_widget_class()
+        if self.upload_url:
+            # a copy, as the file widget may be its file field's own
+            file_widget = copy.copy(file_widget)
+            file_widget.attrs = dict(file_widget.attrs,
+                                     **{'data-upload-url': self.upload_url})
         super(ClearableFileInput, self).__init__(
-            widgets=[file_widget, forms.CheckboxInput()],
+            widgets=[file_widget, forms.CheckboxInput(), forms.HiddenInput()],
             attrs=attrs)
 
     def render(self, name, value, attrs=None):
-        if isinstance(value, list):
-            self.value = value[0]
-        else:
-            self.value = value
-        return super(ClearableFileInput, self).render(name, value, attrs)
+        if not isinstance(value, list):
+            value = self.decompress(value)
+        upload, clear = value[0], value[1]
+        # a stashed upload is carried through redisplay by reference only
+        stash_token = stash_upload(upload) or (value[2:] or [None])[0]
+        # format_output reads the state of this render from a copy of the
+        # widget, so that the widget itself is never modified
+        widget = copy.copy(self)
+        widget.value = upload or stash_token
+        widget.stash_token = stash_token
+        return super(ClearableFileInput, widget).render(
+            name, [upload, clear, stash_token], attrs)
 
     def decompress(self, value):
         # the clear checkbox is never initially checked
-        return [value, None]
+        return [value, None, None]
 
     def format_output(self, rendered_widgets):
         if self.value:
-            return self.template % {'input': rendered_widgets[0],
-                                    'checkbox': rendered_widgets[1]}
-        return rendered_widgets[0]
+            output = self.template % {'input': rendered_widgets[0],
+                                      'checkbox': rendered_widgets[1]}
+        else:
+            output = rendered_widgets[0]
+        # with direct uploads the script fills in the hidden input
+        if self.stash_token or self.upload_url:
+            output += rendered_widgets[2]
+        return output
+
+    def media_key(self):
+        # see form_utils.utils.media_key
+        keys = tuple(media_key(widget) for widget in self.widgets)
+        if None in keys:
+            return None
+        return (type(self), bool(self.upload_url), keys)
+
+    @property
+    def media(self):
+        media = super(ClearableFileInput, self).media
+        if self.upload_url:
+            media = media + forms.Media(
+                js=[root('form_utils/js/direct_upload.js')])
+        return media
 
 root = lambda path: posixpath.join(settings.STATIC_URL, path)
 
+_fingerprinted = {}
+
+
+def fingerprinted(path):
+    """
+    Return the URL of the shipped media file ``path`` with a hash of its
+    contents appended, so it can be cached forever. The URL comes from
+    ``staticfiles_storage`` if staticfiles is installed (so a storage that
+    serves from a CDN or hashes names is honoured), ``STATIC_URL``
+    otherwise. Computed once per path, on first use.
+
+    """
+    try:
+        return _fingerprinted[path]
+    except KeyError:
+        pass
+    filename = os.path.join(os.path.dirname(__file__), 'media',
+                            *path.split('/'))
+    with open(filename, 'rb') as f:
+        digest = hashlib.md5(f.read()).hexdigest()[:12]
+    if 'django.contrib.staticfiles' in settings.INSTALLED_APPS:
+        url = staticfiles_storage.url(path)
+    else:
+        url = root(path)
+    url = _fingerprinted[path] = '%s%sv=%s' % (
+        url, '&' if '?' in url else '?', digest)
+    return url
+
+
+if STANDALONE_AUTORESIZE:
+    AUTORESIZE_JS = (lazy(fingerprinted, six.text_type)(
+        'form_utils/js/autoresize.min.js'),)
+else:
+    AUTORESIZE_JS = (JQUERY_URL,
+                     root('form_utils/js/jquery.autogrow.js'),
+                     root('form_utils/js/autoresize.js'))
+
 
 class AutoResizeTextarea(forms.Textarea):
     """
     A Textarea widget that automatically resizes to accomodate its contents.
     """
     class Media:
-        js = (JQUERY_URL,
-              root('form_utils/js/jquery.autogrow.js'),
-              root('form_utils/js/autoresize.js'))
+        js = AUTORESIZE_JS
 
     def __init__(self, *args, **kwargs):
         attrs = kwargs.setdefault('attrs', {})
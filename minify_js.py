@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Regenerate form_utils/media/form_utils/js/autoresize.min.js from
+autoresize.standalone.js::
+
+    python minify_js.py [--check]
+
+Comments and insignificant whitespace are stripped; names are kept. This
+is not a general JavaScript minifier: it doesn't handle regular expression
+literals, and statements must end with semicolons. With ``--check``,
+nothing is written and the exit status is 1 if the minified file is out of
+date.
+
+"""
+from __future__ import print_function, unicode_literals
+
+import io
+import os
+import re
+import sys
+
+
+JS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'form_utils', 'media', 'form_utils', 'js')
+
+SCRIPTS = [('autoresize.standalone.js', 'autoresize.min.js')]
+
+HEADER = '/* django-form-utils %s, minified by minify_js.py */\n'
+
+TOKENS = re.compile(r"""
+    (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+  | (?P<space>\s+)
+  | (?P<other>[\w$]+|.)
+""", re.S | re.X)
+
+WORD = re.compile(r'[\w$]')
+
+
+def _needs_space(before, after):
+    """Whether a space can't be dropped between ``before`` and ``after``."""
+    if not before or not after:
+        return False
+    if WORD.match(before[-1]) and WORD.match(after[0]):
+        return True
+    return before[-1] in '+-' and after[0] == before[-1]
+
+
+def minify(source):
+    tokens = []
+    for match in TOKENS.finditer(source):
+        if match.lastgroup in ('comment', 'space'):
+            if tokens and tokens[-1] is not None:
+                tokens.append(None)
+        else:
+            tokens.append(match.group())
+    output = []
+    for i, token in enumerate(tokens):
+        if token is not None:
+            output.append(token)
+        elif (output and i + 1 < len(tokens) and
+              _needs_space(output[-1], tokens[i + 1])):
+            output.append(' ')
+    return ''.join(output) + '\n'
+
+
+def main(argv):
+    check = '--check' in argv
+    stale = []
+    for source_name, minified_name in SCRIPTS:
+        with io.open(os.path.join(JS_DIR, source_name),
+                     encoding='utf-8') as f:
+            minified = HEADER % source_name + minify(f.read())
+        path = os.path.join(JS_DIR, minified_name)
+        try:
+            with io.open(path, encoding='utf-8') as f:
+                current = f.read()
+        except IOError:
+            current = None
+        if current == minified:
+            continue
+        stale.append(minified_name)
+        if not check:
+            with io.open(path, 'w', encoding='utf-8') as f:
+                f.write(minified)
+    for name in stale:
+        print('%s %s' % ('Out of date:' if check else 'Wrote', name))
+    return 1 if check and stale else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -30,7 +30,8 @@ setup(
     author='Carl Meyer',
     author_email='carl@oddbird.net',
     url='http://bitbucket.org/carljm/django-form-utils/',
-    packages=['form_utils', 'form_utils.templatetags'],
+    packages=['form_utils', 'form_utils.templatetags',
+              'form_utils.management', 'form_utils.management.commands'],
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',
@@ -47,6 +48,7 @@ setup(
     ],
     zip_safe=False,
     package_data={'form_utils': ['templates/form_utils/*.html',
+                                 'templates/form_utils/compact/*.html',
                                  'media/form_utils/js/*.js']},
     test_suite='tests.runtests.runtests',
     tests_require=['Django', 'mock', 'Pillow'],
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Forms with coroutine validators, for the tests of ``form_utils.aio``.
+
+This module requires Python 3.5 or later, so it is imported lazily.
+
+"""
+import asyncio
+
+from django import forms
+from django.core.exceptions import ValidationError
+
+from form_utils.forms import BetterForm, PreviewForm
+
+
+class Checks(object):
+    """Records the validator calls and the maximum number running at once."""
+    def __init__(self):
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+
+    def validator(self, message=None, delay=0.05):
+        async def check(value):
+            self.calls.append(value)
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self.running -= 1
+            if message:
+                raise ValidationError(message)
+        return check
+
+
+def address_form(checks):
+    class AddressForm(BetterForm):
+        street = forms.CharField()
+        city = forms.CharField()
+        email = forms.EmailField(required=False)
+
+        async_validators = {
+            'street': [checks.validator('Unknown street.', delay=0.1),
+                       checks.validator('Street is taken.', delay=0.01)],
+            'city': [checks.validator()],
+            'email': [checks.validator('Taken.')],
+        }
+
+        def clean(self):
+            self.clean_saw = dict(self.errors)
+            return self.cleaned_data
+    return AddressForm
+
+
+def address_preview_form(checks, use_token=False):
+    class AddressPreviewForm(PreviewForm):
+        street = forms.CharField()
+
+        use_preview_token = use_token
+
+        async_validators = {'street': [checks.validator()]}
+    return AddressPreviewForm
+
+
+async def is_valid(form):
+    """Call the synchronous ``is_valid()`` from a coroutine."""
+    return form.is_valid()
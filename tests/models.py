@@ -1,9 +1,27 @@
 from django.db import models
+from django.utils.encoding import python_2_unicode_compatible
 
 class Person(models.Model):
     age = models.IntegerField()
     name = models.CharField(max_length=100)
 
+class Note(models.Model):
+    text = models.CharField(max_length=100)
+    modified = models.DateTimeField(auto_now=True)
+
 class Document(models.Model):
     myfile = models.FileField(upload_to='uploads')
-    
+
+@python_2_unicode_compatible
+class Team(models.Model):
+    name = models.CharField(max_length=100)
+
+    def __str__(self):
+        return self.name
+
+class Player(models.Model):
+    name = models.CharField(max_length=100)
+    team = models.ForeignKey(Team)
+    number = models.IntegerField(null=True, blank=True)
+    rivals = models.ManyToManyField(Team, blank=True,
+                                    related_name='rival_players')
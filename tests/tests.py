@@ -1,22 +1,68 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import copy
+import datetime
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
 import django
 from django import forms
 from django import template
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.db.models.fields.files import (
     FieldFile, ImageFieldFile, FileField, ImageField)
-from django.test import TestCase
+from django.template.defaultfilters import filesizeformat
+from django.test import RequestFactory, TestCase, TransactionTestCase
 from django.utils import six
-
-from mock import patch
-
-from form_utils.forms import BetterForm, BetterModelForm
-from form_utils.widgets import ImageWidget, ClearableFileInput
-from form_utils.fields import ClearableFileField, ClearableImageField
-
-from .models import Person, Document
+from django.utils.datastructures import MultiValueDict
+from django.utils.functional import lazy
+try:
+    from unittest import skipIf
+except ImportError:  # Python 2.6 compatibility
+    from django.utils.unittest import skipIf
+
+from mock import Mock, patch
+
+from form_utils.forms import (
+    BetterForm, BetterModelForm, PreviewForm, PreviewModelForm)
+from form_utils.widgets import (
+    AutoResizeTextarea, ClearableFileInput, ImageWidget, fingerprinted,
+    is_image)
+from form_utils import cleanup
+from form_utils.choices import (
+    ChoiceCacheMiddleware, choice_cache, get_choice_cache)
+from form_utils.formsets import (
+    betterformset_factory, bettermodelformset_factory, bulk_update)
+from form_utils.fields import (
+    ClearableFileField, ClearableImageField, FakeEmptyFieldFile,
+    ImageHeaderField)
+from form_utils.serializers import (
+    layout_data, layout_json, state_data, state_json)
+from form_utils.utils import evaluate_choices, media_key
+from form_utils.uploads import (
+    DirectUploadError, discard_stashed_uploads, load_stashed_upload,
+    mark_for_stash, purge_stash, stash_upload)
+from form_utils.thumbnails import (
+    PendingThumbnail, ThreadPoolExecutor, ThumbnailCache, ThumbnailEngine,
+    thumbnail_cache)
+from form_utils.validators import UploadValidator, sniff_content_type
+from form_utils.views import direct_upload, form_layout
+from form_utils.warmup import check_fieldsets, form_classes, warm_up
+
+from .models import Person, Note, Document, Team, Player
 
 
 class ApplicationForm(BetterForm):
@@ -549,6 +595,79 @@ class ImageWidgetTests(TestCase):
         html = widget.render('fieldname', FieldFile(None, FileField(), 'something.txt'))
         self.assertHTMLEqual(html, '<input type="file" name="fieldname" />')
 
+    def test_render_does_not_read_image(self):
+        """
+        ``ImageWidget`` does not open the image to find its dimensions.
+
+        """
+        widget = ImageWidget()
+        value = ImageFieldFile(None, ImageField(), 'tiny.png')
+        with patch('django.core.files.images.get_image_dimensions') as dims:
+            html = widget.render('fieldname', value)
+        self.assertFalse(dims.called)
+        self.assertTrue('<img' in html)
+
+    def test_is_image_dimension_fields(self):
+        """
+        The model's dimension fields are trusted; empty ones mean the
+        file is not an image.
+
+        """
+        class Instance(object):
+            width = 10
+            height = None
+        field = ImageField(width_field='width', height_field='height')
+        value = ImageFieldFile(Instance(), field, 'tiny.png')
+        self.assertFalse(is_image(value))
+        Instance.height = 20
+        self.assertTrue(is_image(value))
+
+    def test_is_image_cached_dimensions(self):
+        """
+        Dimensions already read are trusted.
+
+        """
+        value = ImageFieldFile(None, ImageField(), 'tiny.png')
+        value._dimensions_cache = (None, None)
+        self.assertFalse(is_image(value))
+        value._dimensions_cache = (1, 1)
+        self.assertTrue(is_image(value))
+
+    def test_empty_value(self):
+        """An unset ``ImageFieldFile`` renders no image."""
+        widget = ImageWidget()
+        for name in ('', None):
+            value = ImageFieldFile(None, ImageField(), name)
+            self.assertFalse(is_image(value))
+            self.assertFalse('<img' in widget.render('fieldname', value))
+
+    def test_thumbnail_failure_cached(self):
+        """A file that is not an image is remembered as such."""
+        widget = ImageWidget()
+        value = ImageFieldFile(None, ImageField(), 'not-an-image.png')
+        self.addCleanup(thumbnail_cache.clear)
+        error = IOError("cannot identify image file 'not-an-image.png'")
+        with patch('form_utils.widgets.thumbnail',
+                   side_effect=error) as thumbnail:
+            for i in range(2):
+                html = widget.render('fieldname', value)
+                self.assertFalse('<img' in html)
+        self.assertEqual(thumbnail.call_count, 1)
+
+    def test_thumbnail_error_not_cached(self):
+        """Other thumbnail failures are logged, and not cached."""
+        widget = ImageWidget()
+        value = ImageFieldFile(None, ImageField(), 'unreachable.png')
+        self.addCleanup(thumbnail_cache.clear)
+        with patch('form_utils.widgets.thumbnail',
+                   side_effect=IOError('Connection reset')) as thumbnail:
+            with patch('form_utils.widgets.logger') as logger:
+                for i in range(2):
+                    html = widget.render('fieldname', value)
+                    self.assertFalse('<img' in html)
+        self.assertEqual(thumbnail.call_count, 2)
+        self.assertEqual(logger.exception.call_count, 2)
+
     def test_custom_template(self):
         """
         ``ImageWidget`` respects a custom template.
@@ -628,6 +747,63 @@ class ClearableFileInputTests(TestCase):
             )
 
 
+class WidgetCopyTests(TestCase):
+    def test_render_keeps_no_state(self):
+        """
+        Rendering a ``ClearableFileInput`` stores nothing on the widget.
+
+        """
+        widget = ClearableFileInput()
+        before = dict(vars(widget))
+        widget.render('fieldname', 'tiny.png')
+        self.assertEqual(vars(widget), before)
+
+    @skipIf(django.VERSION >= (1, 11),
+            "MultiWidget.format_output is not used from Django 1.11")
+    def test_format_output_override(self):
+        """
+        A subclass can override ``format_output`` and read ``value``.
+
+        """
+        class Widget(ClearableFileInput):
+            def format_output(self, rendered_widgets):
+                return '%s|%s' % (len(rendered_widgets), self.value)
+        self.assertEqual(Widget().render('fieldname', 'tiny.png'),
+                         '3|tiny.png')
+
+    def test_deepcopy(self):
+        """
+        A copy of a ``ClearableFileInput`` has its own attrs and
+        sub-widgets, but shares its template.
+
+        """
+        widget = ClearableFileInput(file_widget=ImageWidget(width=50),
+                                    template='%(checkbox)s%(input)s')
+        copied = copy.deepcopy(widget)
+        self.assertEqual(copied.template, widget.template)
+        self.assertFalse(copied.attrs is widget.attrs)
+        for original, widget_copy in zip(widget.widgets, copied.widgets):
+            self.assertFalse(widget_copy is original)
+            self.assertFalse(widget_copy.attrs is original.attrs)
+            self.assertTrue(type(widget_copy) is type(original))
+        self.assertEqual(copied.widgets[0].width, 50)
+        copied.widgets[0].attrs['class'] = 'copied'
+        self.assertFalse('class' in widget.widgets[0].attrs)
+
+    def test_form_copies(self):
+        """
+        Each form gets its own copy of the widget.
+
+        """
+        class FileForm(forms.Form):
+            upload = ClearableFileField()
+        one, two = FileForm(), FileForm()
+        self.assertFalse(one.fields['upload'].widget is
+                         two.fields['upload'].widget)
+        self.assertFalse(one.fields['upload'].widget.widgets[1] is
+                         two.fields['upload'].widget.widgets[1])
+
+
 class ClearableFileFieldTests(TestCase):
     upload = SimpleUploadedFile('something.txt', b'Something')
 
@@ -903,3 +1079,1886 @@ class FieldFilterTests(TestCase):
         f = self.form()
 
         self.assertFalse(self.form_utils.is_radio(f["level"]))
+
+
+class PlayerForm(BetterModelForm):
+    class Meta:
+        model = Player
+        fieldsets = [('main', {'fields': ['name', 'team']})]
+
+
+@skipIf(sys.version_info < (3, 5), "asyncio support requires Python 3.5")
+class AsyncTests(TransactionTestCase):
+    def run_async(self, coroutine):
+        import asyncio
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+
+    def test_evaluate_choices(self):
+        """
+        ``evaluate_choices`` runs each choice query once; afterwards the
+        form renders and the filters work without touching the database.
+
+        """
+        Team.objects.create(name='Reds')
+        form = PlayerForm()
+        with self.assertNumQueries(1):
+            evaluate_choices(form)
+        with self.assertNumQueries(0):
+            html = six.text_type(form['team'])
+            self.assertTrue('Reds' in html)
+
+    def test_arender(self):
+        """
+        ``arender`` evaluates choice querysets off the event loop and
+        returns the same markup as the ``render`` filter.
+
+        """
+        Team.objects.create(name='Reds')
+        form = PlayerForm()
+        html = self.run_async(form.arender())
+        self.assertTrue('Reds' in html)
+        self.assertHTMLEqual(
+            html, template.Template('{% load form_utils %}{{ form|render }}'
+                                    ).render(template.Context({'form': form})))
+
+    def test_arender_bound(self):
+        """``arender`` validates a bound form off the event loop."""
+        import threading
+        team = Team.objects.create(name='Reds')
+        form = PlayerForm({'name': 'Jo', 'team': team.pk + 1})
+        loop_thread = threading.current_thread()
+        threads = []
+        full_clean = form.full_clean
+
+        def record():
+            threads.append(threading.current_thread())
+            full_clean()
+        form.full_clean = record
+        html = self.run_async(form.arender())
+        self.assertEqual(len(threads), 1)
+        self.assertFalse(threads[0] is loop_thread)
+        self.assertTrue('errorlist' in html)
+
+    def test_ais_valid(self):
+        """``ais_valid`` validates the form in a worker thread."""
+        team = Team.objects.create(name='Reds')
+        form = PlayerForm({'name': 'Jo', 'team': team.pk})
+        self.assertTrue(self.run_async(form.ais_valid()))
+        self.assertEqual(form.cleaned_data['team'], team)
+        form = PlayerForm({'name': 'Jo', 'team': team.pk + 1})
+        self.assertFalse(self.run_async(form.ais_valid()))
+        self.assertTrue('team' in form.errors)
+
+
+@skipIf(sys.version_info < (3, 5), "asyncio support requires Python 3.5")
+class AsyncValidatorTests(TestCase):
+    def setUp(self):
+        from .async_forms import Checks
+        self.checks = Checks()
+
+    def run_async(self, coroutine):
+        import asyncio
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+
+    def address_form(self, data):
+        from .async_forms import address_form
+        return address_form(self.checks)(data)
+
+    def test_concurrent(self):
+        """The async validators of all fields run concurrently."""
+        form = self.address_form({'street': 'Main St', 'city': 'Springfield'})
+        self.assertFalse(self.run_async(form.ais_valid()))
+        self.assertEqual(self.checks.max_running, 3)
+        # the empty optional email isn't checked
+        self.assertEqual(sorted(self.checks.calls),
+                         ['Main St', 'Main St', 'Springfield'])
+
+    def test_errors(self):
+        """Errors are added in validator order, before ``clean()``."""
+        form = self.address_form({'street': 'Main St', 'city': 'Springfield',
+                                  'email': 'a@example.com'})
+        self.assertFalse(self.run_async(form.ais_valid()))
+        self.assertEqual(list(form.errors), ['street', 'email'])
+        self.assertEqual(form.errors['street'],
+                         ['Unknown street.', 'Street is taken.'])
+        self.assertEqual(form.clean_saw, form.errors)
+        self.assertEqual(form.cleaned_data, {'city': 'Springfield'})
+
+    def test_invalid_fields(self):
+        """Fields with errors aren't checked."""
+        form = self.address_form({'street': '', 'city': 'Springfield',
+                                  'email': 'bad'})
+        self.assertFalse(self.run_async(form.ais_valid()))
+        self.assertEqual(self.checks.calls, ['Springfield'])
+
+    def test_sync(self):
+        """``is_valid()`` runs the async validators one at a time."""
+        form = self.address_form({'street': 'Main St', 'city': 'Springfield',
+                                  'email': 'a@example.com'})
+        self.assertFalse(form.is_valid())
+        self.assertEqual(self.checks.max_running, 1)
+        self.assertEqual(form.errors['street'],
+                         ['Unknown street.', 'Street is taken.'])
+        self.assertEqual(form.errors['email'], ['Taken.'])
+
+    def test_sync_in_event_loop(self):
+        """``is_valid()`` also works while an event loop is running."""
+        from .async_forms import is_valid
+        form = self.address_form({'street': 'Main St', 'city': 'Springfield',
+                                  'email': 'a@example.com'})
+        self.assertFalse(self.run_async(is_valid(form)))
+        self.assertEqual(form.errors['email'], ['Taken.'])
+
+    def test_arender(self):
+        """``arender`` runs the async validators of a bound form."""
+        form = self.address_form({'street': 'Main St', 'city': 'Springfield'})
+        html = self.run_async(form.arender())
+        self.assertTrue('Street is taken.' in html)
+        self.assertEqual(self.checks.max_running, 3)
+
+    def test_sync_validator(self):
+        """Plain callables can be async validators too."""
+        def check(value):
+            raise forms.ValidationError('No %s.' % value)
+        form = self.address_form({'street': 'Main St', 'city': 'Springfield'})
+        form.async_validators = {'city': [check]}
+        self.assertFalse(self.run_async(form.ais_valid()))
+        self.assertEqual(form.errors, {'city': ['No Springfield.']})
+
+    def test_preview(self):
+        """A previewed ``PreviewForm`` isn't validated."""
+        from .async_forms import address_preview_form
+        form = address_preview_form(self.checks)(
+            data={'street': 'Main St', 'submit': 'preview'})
+        self.assertFalse(self.run_async(form.ais_valid()))
+        self.assertEqual(self.checks.calls, [])
+
+    def test_preview_token(self):
+        """A submission with a valid preview token isn't checked again."""
+        from .async_forms import address_preview_form
+        AddressPreviewForm = address_preview_form(self.checks, True)
+        form = AddressPreviewForm(
+            data={'street': 'Main St', 'submit': 'preview'})
+        self.assertFalse(self.run_async(form.ais_valid()))
+        self.assertEqual(self.checks.calls, ['Main St'])
+        form = AddressPreviewForm(
+            data={'street': 'Main St', 'preview_token': form.preview_token})
+        self.assertTrue(self.run_async(form.ais_valid()))
+        self.assertTrue(form.preview_token_used)
+        self.assertEqual(self.checks.calls, ['Main St'])
+
+
+class ArticlePreviewForm(PreviewForm):
+    title = forms.CharField()
+    body = forms.CharField(required=False)
+
+    use_preview_token = True
+    title_checks = 0
+
+    def clean_title(self):
+        ArticlePreviewForm.title_checks += 1
+        return self.cleaned_data['title'].upper()
+
+
+class PreviewTokenTests(TestCase):
+    def setUp(self):
+        ArticlePreviewForm.title_checks = 0
+
+    def _preview(self, data):
+        form = ArticlePreviewForm(data=dict(data, submit='preview'))
+        self.assertFalse(form.is_valid())
+        return form
+
+    def test_preview_validates(self):
+        """With ``use_preview_token``, the preview step validates."""
+        form = self._preview({'body': 'text'})
+        self.assertTrue('title' in form.errors)
+        self.assertEqual(form.preview_token, '')
+
+    def test_token_skips_clean(self):
+        """
+        A final submission with a valid token for unchanged data isn't
+        validated again.
+
+        """
+        form = self._preview({'title': 'hi', 'body': 'text'})
+        token = form.preview_token
+        self.assertTrue(token)
+        self.assertTrue('name="preview_token"' in form.preview_token_input)
+        self.assertEqual(ArticlePreviewForm.title_checks, 1)
+        form = ArticlePreviewForm(data={'title': 'hi', 'body': 'text',
+                                        'preview_token': token})
+        self.assertTrue(form.is_valid())
+        self.assertTrue(form.preview_token_used)
+        self.assertEqual(ArticlePreviewForm.title_checks, 1)
+        # the cleaned data, as cleaned during preview
+        self.assertEqual(form.cleaned_data, {'title': 'HI', 'body': 'text'})
+
+    def test_token_changed_data(self):
+        """If the data changed after preview, the form is validated."""
+        token = self._preview({'title': 'hi'}).preview_token
+        form = ArticlePreviewForm(data={'title': 'bye',
+                                        'preview_token': token})
+        self.assertTrue(form.is_valid())
+        self.assertFalse(form.preview_token_used)
+        self.assertEqual(form.cleaned_data['title'], 'BYE')
+
+    def test_token_prefix(self):
+        """A token is only valid for the same prefix."""
+        token = self._preview({'title': 'hi'}).preview_token
+        form = ArticlePreviewForm(data={'a-title': 'hi',
+                                        'a-preview_token': token},
+                                  prefix='a')
+        self.assertTrue(form.is_valid())
+        self.assertFalse(form.preview_token_used)
+
+    def test_token_expired(self):
+        """A token older than ``preview_token_max_age`` is ignored."""
+        token = self._preview({'title': 'hi'}).preview_token
+        with patch.object(ArticlePreviewForm, 'preview_token_max_age', -1):
+            form = ArticlePreviewForm(data={'title': 'hi',
+                                            'preview_token': token})
+            self.assertTrue(form.is_valid())
+        self.assertFalse(form.preview_token_used)
+
+    def test_token_salt(self):
+        """A token is only valid for the same ``preview_token_salt``."""
+        form = ArticlePreviewForm(data={'title': 'hi', 'submit': 'preview'},
+                                  preview_token_salt='session-1')
+        self.assertFalse(form.is_valid())
+        token = form.preview_token
+        data = {'title': 'hi', 'preview_token': token}
+        form = ArticlePreviewForm(data=data, preview_token_salt='session-2')
+        self.assertTrue(form.is_valid())
+        self.assertFalse(form.preview_token_used)
+        form = ArticlePreviewForm(data=data, preview_token_salt='session-1')
+        self.assertTrue(form.is_valid())
+        self.assertTrue(form.preview_token_used)
+
+    def test_token_built_once(self):
+        """Rendering the form builds its token once."""
+        form = self._preview({'title': 'hi', 'body': 'text'})
+        with patch.object(ArticlePreviewForm, '_serialize_cleaned_data',
+                          wraps=form._serialize_cleaned_data) as serialize:
+            html = template.Template(
+                '{% load form_utils %}{{ form|render }}').render(
+                    template.Context({'form': form}))
+        self.assertTrue('name="preview_token"' in html)
+        self.assertEqual(serialize.call_count, 1)
+
+    def test_token_checked_once(self):
+        """With async validators, the token is still checked once."""
+        form = self._preview({'title': 'hi', 'body': 'text'})
+        # changed data, so the token is checked and validation runs
+        form = ArticlePreviewForm(data={'title': 'bye', 'body': 'text',
+                                        'preview_token': form.preview_token})
+        form.async_validators = {'title': [lambda value: None]}
+        with patch.object(ArticlePreviewForm, '_check_preview_token',
+                          wraps=form._check_preview_token) as check:
+            self.assertTrue(form.is_valid())
+        self.assertFalse(form.preview_token_used)
+        self.assertEqual(check.call_count, 1)
+
+    def test_token_tampered(self):
+        """A token with a bad signature is ignored."""
+        token = self._preview({'title': 'hi'}).preview_token
+        form = ArticlePreviewForm(data={'title': 'hi',
+                                        'preview_token': token + 'x'})
+        self.assertTrue(form.is_valid())
+        self.assertFalse(form.preview_token_used)
+
+    def test_model_form_token(self):
+        """A previewed model form still builds its instance."""
+        class PersonPreviewForm(PreviewModelForm):
+            use_preview_token = True
+
+            class Meta:
+                model = Person
+                fields = ['name', 'age']
+        token = PersonPreviewForm(data={'name': 'Jo', 'age': '30',
+                                        'submit': 'preview'}).preview_token
+        form = PersonPreviewForm(data={'name': 'Jo', 'age': '30',
+                                       'preview_token': token})
+        self.assertTrue(form.is_valid())
+        self.assertTrue(form.preview_token_used)
+        self.assertEqual(form.save().age, 30)
+
+    def test_model_form_token_instance(self):
+        """A token is only valid for the instance previewed."""
+        class PersonPreviewForm(PreviewModelForm):
+            use_preview_token = True
+
+            class Meta:
+                model = Person
+                fields = ['name', 'age']
+        first = Person.objects.create(name='A', age=1)
+        second = Person.objects.create(name='B', age=2)
+        data = {'name': 'Jo', 'age': '30'}
+        token = PersonPreviewForm(data=dict(data, submit='preview'),
+                                  instance=first).preview_token
+        self.assertTrue(token)
+        form = PersonPreviewForm(data=dict(data, preview_token=token),
+                                 instance=second)
+        self.assertTrue(form.is_valid())
+        self.assertFalse(form.preview_token_used)
+
+    def test_model_choice_token(self):
+        """Model choices are restored from their keys."""
+        team = Team.objects.create(name='Reds')
+
+        class PlayerPreviewForm(PreviewModelForm):
+            use_preview_token = True
+
+            class Meta:
+                model = Player
+                fields = ['name', 'team', 'rivals']
+        data = {'name': 'Jo', 'team': str(team.pk),
+                'rivals': [str(team.pk)]}
+        token = PlayerPreviewForm(data=dict(data, submit='preview')
+                                  ).preview_token
+        self.assertTrue(token)
+        form = PlayerPreviewForm(data=dict(data, preview_token=token))
+        self.assertTrue(form.is_valid())
+        self.assertTrue(form.preview_token_used)
+        self.assertEqual(form.cleaned_data['team'], team)
+        self.assertEqual(list(form.cleaned_data['rivals']), [team])
+
+
+class StashedUploadTests(TestCase):
+    def setUp(self):
+        self.stash_dir = tempfile.mkdtemp()
+        patcher = patch('form_utils.uploads.stash_storage',
+                        FileSystemStorage(location=self.stash_dir))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.stash_dir)
+
+    class UploadForm(forms.Form):
+        title = forms.CharField()
+        f = ClearableFileField(stash_uploads=True)
+
+    def _redisplay(self):
+        upload = SimpleUploadedFile('something.txt', b'Something')
+        form = self.UploadForm(data={}, files={'f_0': upload})
+        self.assertFalse(form.is_valid())
+        self.assertFalse('f' in form.errors)
+        html = six.text_type(form['f'])
+        # attribute order differs between Django versions
+        tag = re.search(r'<input[^>]* name="f_2"[^>]*>', html)
+        self.assertTrue(tag, html)
+        self.assertTrue('type="hidden"' in tag.group(), html)
+        match = re.search(r' value="([^"]+)"', tag.group())
+        self.assertTrue(match, html)
+        return match.group(1)
+
+    def test_redisplay_stashes_upload(self):
+        """
+        A valid upload is stashed when its form is redisplayed, and a
+        later submission can reuse it by reference.
+
+        """
+        token = self._redisplay()
+        self.assertEqual(len(os.listdir(self.stash_dir)), 1)
+        form = self.UploadForm(data={'title': 'x', 'f_2': token})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['f'].name, 'something.txt')
+        self.assertEqual(form.cleaned_data['f'].read(), b'Something')
+
+    def test_clear_discards_stash(self):
+        """Checking the clear checkbox discards the stashed upload."""
+        class OptionalUploadForm(forms.Form):
+            f = ClearableFileField(required=False, stash_uploads=True)
+        token = self._redisplay()
+        form = OptionalUploadForm(data={'f_1': 'on', 'f_2': token})
+        self.assertTrue(form.is_valid())
+        self.assertTrue(isinstance(form.cleaned_data['f'],
+                                   FakeEmptyFieldFile))
+
+    def test_bad_token(self):
+        """A tampered reference is ignored."""
+        token = self._redisplay()
+        form = self.UploadForm(data={'title': 'x', 'f_2': token + 'x'})
+        self.assertFalse(form.is_valid())
+        self.assertTrue('f' in form.errors)
+
+    def stashed_files(self):
+        return [name for path, dirs, files in os.walk(self.stash_dir)
+                for name in files]
+
+    def test_saved_upload_leaves_stash(self):
+        """
+        A stashed upload is moved into place when its model form is saved.
+
+        """
+        class DocumentForm(BetterModelForm):
+            myfile = ClearableFileField(stash_uploads=True)
+
+            class Meta:
+                model = Document
+                fields = ['myfile']
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        with patch.object(Document._meta.get_field('myfile'), 'storage',
+                          FileSystemStorage(location=media)):
+            upload = SimpleUploadedFile('something.txt', b'Something')
+            form = DocumentForm(data={}, files={'myfile_0': upload})
+            self.assertTrue(form.is_valid())
+            form.cleaned_data['myfile']._form_utils_stash = True
+            token = stash_upload(form.cleaned_data['myfile'])
+            form = DocumentForm(data={'myfile_2': token})
+            self.assertTrue(form.is_valid())
+            doc = form.save()
+            self.assertEqual(self.stashed_files(), [])
+            self.assertEqual(doc.myfile.read(), b'Something')
+            doc.myfile.close()
+
+    def test_discard(self):
+        """Stashed uploads in cleaned data can be discarded."""
+        token = self._redisplay()
+        form = self.UploadForm(data={'title': 'x', 'f_2': token})
+        self.assertTrue(form.is_valid())
+        discard_stashed_uploads(form.cleaned_data)
+        self.assertEqual(self.stashed_files(), [])
+
+    def test_purge(self):
+        """Old stashed files and their directories are purged."""
+        self._redisplay()
+        self.assertEqual(purge_stash(), 0)
+        self.assertEqual(len(self.stashed_files()), 1)
+        old = time.time() - 2 * 24 * 60 * 60
+        for path, dirs, files in os.walk(self.stash_dir):
+            for name in dirs + files:
+                os.utime(os.path.join(path, name), (old, old))
+        stdout = six.StringIO()
+        call_command('purge_upload_stash', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Deleted 1 stashed files.\n')
+        self.assertEqual(os.listdir(self.stash_dir), [])
+
+    def test_no_stash_by_default(self):
+        """Without ``stash_uploads`` nothing is stashed."""
+        class UploadForm(forms.Form):
+            title = forms.CharField()
+            f = ClearableFileField()
+        upload = SimpleUploadedFile('something.txt', b'Something')
+        form = UploadForm(data={}, files={'f_0': upload})
+        self.assertFalse(form.is_valid())
+        self.assertFalse('f_2' in six.text_type(form['f']))
+        self.assertEqual(os.listdir(self.stash_dir), [])
+
+
+class DirectUploadTests(TestCase):
+    def setUp(self):
+        self.stash_dir = tempfile.mkdtemp()
+        patcher = patch('form_utils.uploads.stash_storage',
+                        FileSystemStorage(location=self.stash_dir))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.stash_dir)
+        self.factory = RequestFactory()
+
+    class UploadForm(forms.Form):
+        f = ClearableFileField(required=False, upload_url='/upload/')
+
+    def _post(self, query, data, **kwargs):
+        request = self.factory.post('/upload/?' + query, data=data,
+                                    content_type='application/octet-stream')
+        response = direct_upload(request, **kwargs)
+        return response.status_code, json.loads(response.content.decode())
+
+    def _upload(self, *chunks):
+        status, data = self._post('name=a.txt', chunks[0])
+        for chunk in chunks[1:]:
+            status, data = self._post('upload=%s&offset=%d' % (
+                data['upload'], data['size']), chunk)
+        status, data = self._post('upload=%s&offset=%d&complete=1' % (
+            data['upload'], data['size']), b'')
+        self.assertEqual(status, 200)
+        return data['token']
+
+    def test_chunked_upload(self):
+        """
+        A file uploaded in chunks can be submitted by its token.
+
+        """
+        token = self._upload(b'Some', b'thing')
+        form = self.UploadForm(data={'f_2': token})
+        self.assertTrue(form.is_valid())
+        upload = form.cleaned_data['f']
+        self.assertEqual(upload.name, 'a.txt')
+        self.assertEqual(upload.content_type, 'text/plain')
+        self.assertEqual(upload.read(), b'Something')
+
+    def test_clear_ignores_token(self):
+        """
+        Checking the clear checkbox still clears the field.
+
+        """
+        token = self._upload(b'Something')
+        form = self.UploadForm(data={'f_1': 'on', 'f_2': token})
+        self.assertTrue(form.is_valid())
+        self.assertTrue(isinstance(form.cleaned_data['f'],
+                                   FakeEmptyFieldFile))
+
+    def test_bad_upload_id(self):
+        """
+        A forged upload id is rejected.
+
+        """
+        status, data = self._post('upload=forged', b'Something')
+        self.assertEqual(status, 400)
+
+    def test_max_size(self):
+        """
+        An upload larger than ``max_size`` is rejected and deleted.
+
+        """
+        status, data = self._post('name=a.txt', b'Something', max_size=5)
+        self.assertEqual(status, 400)
+        self.assertEqual(
+            [files for root, dirs, files in os.walk(self.stash_dir)
+             if files], [])
+
+    def test_chunk_offset(self):
+        """
+        A chunk not posted at the current end of the upload is rejected.
+
+        """
+        status, data = self._post('name=a.txt', b'Some')
+        upload_id = data['upload']
+        status, data = self._post('upload=%s&offset=9' % upload_id, b'x')
+        self.assertEqual(status, 400)
+        # a repeated chunk
+        status, data = self._post('upload=%s&offset=0' % upload_id, b'Some')
+        self.assertEqual(status, 400)
+        status, data = self._post('upload=%s&offset=4' % upload_id, b'thing')
+        self.assertEqual((status, data['size']), (200, 9))
+
+    def test_offset_checked_under_lock(self):
+        """
+        The offset is checked against the size of the file once it is
+        locked, not before.
+
+        """
+        from django.core.files import locks
+        from form_utils.uploads import append_chunk
+        status, data = self._post('name=a.txt', b'Some')
+        upload_id = data['upload']
+        lock = locks.lock
+
+        def lock_after_other_chunk(f, flags):
+            # another chunk at the same offset is written first
+            with patch.object(locks, 'lock', lock):
+                append_chunk(upload_id, io.BytesIO(b'thing'), offset=4)
+            return lock(f, flags)
+        with patch.object(locks, 'lock', lock_after_other_chunk):
+            self.assertRaises(DirectUploadError, append_chunk, upload_id,
+                              io.BytesIO(b'thing'), offset=4)
+        status, data = self._post('upload=%s&offset=9' % upload_id, b'!')
+        self.assertEqual((status, data['size']), (200, 10))
+
+    def test_content_type_sniffed(self):
+        """The content type of a direct upload is sniffed from its data."""
+        status, data = self._post('name=a.png', b'\x89PNG\r\n\x1a\nxx')
+        status, data = self._post(
+            'upload=%s&offset=%d&complete=1&type=text/html' % (
+                data['upload'], data['size']), b'')
+        form = self.UploadForm(data={'f_2': data['token']})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.cleaned_data['f'].content_type, 'image/png')
+
+    def test_storage_without_paths(self):
+        """
+        Stashing works with storages without local paths; the loaded
+        upload then has no ``temporary_file_path``.
+
+        """
+        with patch('form_utils.uploads._local_path', return_value=None):
+            upload = SimpleUploadedFile('a.txt', b'Something')
+            mark_for_stash(upload)
+            upload = load_stashed_upload(stash_upload(upload))
+            self.assertFalse(hasattr(upload, 'temporary_file_path'))
+            self.assertEqual(upload.read(), b'Something')
+            self.assertEqual(purge_stash(0), 1)
+
+    def test_default_max_size(self):
+        """Direct uploads are limited in size by default."""
+        from form_utils.settings import DIRECT_UPLOAD_MAX_SIZE
+        self.assertTrue(DIRECT_UPLOAD_MAX_SIZE)
+
+    def test_token_not_accepted_by_default(self):
+        """
+        Fields without ``upload_url`` or ``stash_uploads`` ignore tokens.
+
+        """
+        token = self._upload(b'Something')
+
+        class PlainForm(forms.Form):
+            f = ClearableFileField()
+        self.assertFalse(PlainForm(data={'f_2': token}).is_valid())
+
+    def test_render(self):
+        """
+        The file input has the upload URL, the hidden input is always
+        rendered, and the script is included in the media.
+
+        """
+        form = self.UploadForm()
+        html = six.text_type(form['f'])
+        self.assertTrue('data-upload-url="/upload/"' in html)
+        tag = re.search(r'<input[^>]* name="f_2"[^>]*>', html)
+        self.assertTrue(tag and 'type="hidden"' in tag.group(), html)
+        self.assertTrue('direct_upload.js' in six.text_type(form.media))
+
+
+class BetterFormSetTests(TestCase):
+    def test_shared_layout(self):
+        """All forms of a ``BetterFormSet`` share one layout."""
+        FormSet = betterformset_factory(HoneypotForm, extra=3)
+        formset = FormSet()
+        layouts = set(id(form._layout) for form in formset)
+        self.assertEqual(layouts, set([id(HoneypotForm.get_layout())]))
+
+    def test_row_attrs(self):
+        """Forms sharing a layout get the same row_attrs as others."""
+        FormSet = betterformset_factory(HoneypotForm, extra=1)
+        formset = FormSet({'form-TOTAL_FORMS': '1',
+                           'form-INITIAL_FORMS': '0',
+                           'form-0-honeypot': 'spam',
+                           'form-0-name': 'Jo'})
+        form = HoneypotForm({'honeypot': 'spam', 'name': 'Jo'})
+        self.assertEqual([bf.row_attrs for bf in formset.forms[0]],
+                         [bf.row_attrs for bf in form])
+        self.assertTrue(
+            'class="required error"' in formset.forms[0]['honeypot'].row_attrs)
+
+    def test_render(self):
+        """Forms sharing a layout render as they would on their own."""
+        FormSet = betterformset_factory(ApplicationForm, extra=2)
+        tpl = template.Template(
+            '{% load form_utils %}{% for form in formset %}'
+            '{{ form|render }}{% endfor %}')
+        html = tpl.render(template.Context({'formset': FormSet()}))
+        self.assertEqual(html.count('<fieldset class="optional">'), 2)
+        form_html = TemplatetagTests.betterform_html.replace(
+            'id_', 'id_form-0-').replace('name="', 'name="form-0-')
+        self.assertHTMLEqual(
+            template.Template('{% load form_utils %}{{ form|render }}'
+                              ).render(template.Context(
+                                  {'form': FormSet().forms[0]})),
+            form_html)
+
+    def test_model_formset(self):
+        """``bettermodelformset_factory`` shares layouts, too."""
+        Person.objects.create(name='Jo', age=30)
+        FormSet = bettermodelformset_factory(Person, form=PartialPersonForm)
+        formset = FormSet()
+        self.assertEqual(len(formset.forms), 2)
+        for form in formset:
+            self.assertTrue(form._layout is FormSet.form.get_layout())
+            self.assertEqual([[bf.name for bf in fs] for fs in form.fieldsets],
+                             [['name']])
+
+
+class ChoiceCacheTests(TestCase):
+    def setUp(self):
+        self.team = Team.objects.create(name='Reds')
+
+    def test_forms_share_choices(self):
+        """
+        With an active ``ChoiceCache``, each distinct choices queryset is
+        evaluated once for all forms.
+
+        """
+        with choice_cache():
+            forms_ = [PlayerForm(prefix=str(i)) for i in range(3)]
+            with self.assertNumQueries(1):
+                for form in forms_:
+                    self.assertTrue('Reds' in six.text_type(form['team']))
+
+    def test_filtered_querysets(self):
+        """Querysets with different SQL or params are cached apart."""
+        Team.objects.create(name='Blues')
+        with choice_cache():
+            form = PlayerForm()
+            other = PlayerForm()
+            other.fields['team'].queryset = Team.objects.filter(name='Blues')
+            with self.assertNumQueries(2):
+                self.assertTrue('Reds' in six.text_type(form['team']))
+                html = six.text_type(other['team'])
+                self.assertTrue('Blues' in html)
+                self.assertFalse('Reds' in html)
+                six.text_type(PlayerForm()['team'])
+
+    def test_filters(self):
+        """``value_text`` and ``selected_values`` use the cache too."""
+        from form_utils.templatetags.form_utils import (
+            value_text, selected_values)
+
+        class TeamsForm(forms.Form):
+            team = forms.ModelChoiceField(Team.objects.all())
+            teams = forms.ModelMultipleChoiceField(Team.objects.all())
+        form = TeamsForm(initial={'team': self.team.pk,
+                                  'teams': [self.team.pk]})
+        with choice_cache():
+            with self.assertNumQueries(1):
+                self.assertEqual(value_text(form['team']), 'Reds')
+                self.assertEqual(selected_values(form['teams']), ['Reds'])
+
+    def test_inactive(self):
+        """Without an active cache, nothing is cached."""
+        forms_ = [PlayerForm() for i in range(2)]
+        with self.assertNumQueries(2):
+            for form in forms_:
+                six.text_type(form['team'])
+
+    def test_middleware(self):
+        """``ChoiceCacheMiddleware`` activates a cache per request."""
+        middleware = ChoiceCacheMiddleware()
+        middleware.process_request(None)
+        self.assertTrue(get_choice_cache() is not None)
+        middleware.process_response(None, None)
+        self.assertTrue(get_choice_cache() is None)
+
+
+class RosterForm(BetterForm):
+    name = forms.CharField()
+    team = forms.ModelChoiceField(Team.objects.all())
+    rivals = forms.ModelMultipleChoiceField(Team.objects.all(),
+                                            required=False)
+
+
+class BatchedChoiceValidationTests(TestCase):
+    def setUp(self):
+        self.reds = Team.objects.create(name='Reds')
+        self.blues = Team.objects.create(name='Blues')
+        self.FormSet = betterformset_factory(RosterForm, extra=0)
+        self.FormSet.batch_choice_validation = True
+
+    def _data(self, rows):
+        data = {'form-TOTAL_FORMS': str(len(rows)),
+                'form-INITIAL_FORMS': '0'}
+        for i, (team, rivals) in enumerate(rows):
+            data['form-%d-name' % i] = 'Player %d' % i
+            data['form-%d-team' % i] = team
+            data['form-%d-rivals' % i] = rivals
+        return MultiValueDict(dict((k, v if isinstance(v, list) else [v])
+                                   for k, v in data.items()))
+
+    def test_one_query_per_queryset(self):
+        """
+        Model choice values of all forms are validated with one query
+        per distinct queryset.
+
+        """
+        rows = [(self.reds.pk, [self.blues.pk]),
+                (self.blues.pk, [self.reds.pk, self.blues.pk])] * 5
+        formset = self.FormSet(self._data(rows))
+        with self.assertNumQueries(1):
+            self.assertTrue(formset.is_valid())
+        self.assertEqual(formset.forms[0].cleaned_data['team'], self.reds)
+        self.assertEqual(formset.forms[1].cleaned_data['rivals'],
+                         [self.reds, self.blues])
+
+    def test_invalid_choice(self):
+        """Unknown or malformed keys are reported as invalid choices."""
+        formset = self.FormSet(self._data([(self.reds.pk + 100, []),
+                                           ('junk', ['junk'])]))
+        self.assertFalse(formset.is_valid())
+        self.assertEqual(formset.errors[0]['team'][0],
+                         forms.ModelChoiceField.default_error_messages[
+                             'invalid_choice'])
+        self.assertTrue('team' in formset.errors[1])
+        self.assertTrue('junk' in formset.errors[1]['rivals'][0])
+
+    def test_batch_size(self):
+        """Keys are fetched in batches of ``choice_validation_batch_size``."""
+        self.FormSet.choice_validation_batch_size = 1
+        formset = self.FormSet(self._data([(self.reds.pk, []),
+                                           (self.blues.pk, [])]))
+        with self.assertNumQueries(2):
+            self.assertTrue(formset.is_valid())
+
+
+@skipIf(django.VERSION < (1, 8),
+        "conditional expressions require Django 1.8")
+class BulkSaveTests(TestCase):
+    def setUp(self):
+        self.reds = Team.objects.create(name='Reds')
+        self.blues = Team.objects.create(name='Blues')
+        self.players = [Player.objects.create(name='P%d' % i, team=self.reds)
+                        for i in range(3)]
+
+    def _data(self, rows, initial):
+        data = {'form-TOTAL_FORMS': str(len(rows)),
+                'form-INITIAL_FORMS': str(initial)}
+        for i, row in enumerate(rows):
+            for key, value in row.items():
+                data['form-%d-%s' % (i, key)] = value
+        return MultiValueDict(dict((k, v if isinstance(v, list) else [v])
+                                   for k, v in data.items()))
+
+    def test_bulk_save(self):
+        """
+        New, changed and deleted instances are saved with one query
+        each.
+
+        """
+        FormSet = bettermodelformset_factory(
+            Player, form=PlayerForm, extra=0, can_delete=True)
+        p0, p1, p2 = self.players
+        formset = FormSet(self._data([
+            {'id': p0.pk, 'name': 'P0', 'team': self.blues.pk},
+            {'id': p1.pk, 'name': 'Renamed', 'team': self.reds.pk},
+            {'id': p2.pk, 'name': 'P2', 'team': self.reds.pk, 'DELETE': 'on'},
+            {'name': 'New 1', 'team': self.blues.pk},
+            {'name': 'New 2', 'team': self.reds.pk},
+        ], 3))
+        self.assertTrue(formset.is_valid())
+        # savepoint + delete (with cascade lookups) + insert + update
+        with self.assertNumQueries(7):
+            saved = formset.bulk_save()
+        self.assertEqual(len(saved), 4)
+        self.assertEqual(
+            sorted(Player.objects.values_list('name', 'team__name')),
+            [('New 1', 'Blues'), ('New 2', 'Reds'), ('P0', 'Blues'),
+             ('Renamed', 'Reds')])
+        self.assertEqual(len(formset.new_objects), 2)
+        self.assertEqual(formset.deleted_objects, [p2])
+
+    def test_bulk_save_m2m(self):
+        """Many-to-many relations are saved in batches."""
+        class RivalsForm(BetterModelForm):
+            class Meta:
+                model = Player
+                fields = ['name', 'team', 'rivals']
+        FormSet = bettermodelformset_factory(Player, form=RivalsForm,
+                                             extra=0)
+        p0, p1, p2 = self.players
+        p0.rivals.add(self.reds)
+        formset = FormSet(self._data([
+            {'id': p0.pk, 'name': 'P0', 'team': self.reds.pk,
+             'rivals': [self.blues.pk]},
+            {'id': p1.pk, 'name': 'P1', 'team': self.reds.pk,
+             'rivals': [self.reds.pk, self.blues.pk]},
+            {'id': p2.pk, 'name': 'P2', 'team': self.reds.pk},
+            {'name': 'New', 'team': self.reds.pk, 'rivals': [self.reds.pk]},
+        ], 3))
+        self.assertTrue(formset.is_valid())
+        formset.bulk_save()
+        self.assertEqual(list(p0.rivals.all()), [self.blues])
+        self.assertEqual(list(p1.rivals.order_by('pk')),
+                         [self.reds, self.blues])
+        self.assertEqual(list(p2.rivals.all()), [])
+        new = Player.objects.get(name='New')
+        self.assertEqual(list(new.rivals.all()), [self.reds])
+
+    def test_bulk_save_changed_only(self):
+        """With save_changed_only, only the changed fields are updated."""
+        class ChangedOnlyForm(PlayerForm):
+            save_changed_only = True
+        FormSet = bettermodelformset_factory(Player, form=ChangedOnlyForm,
+                                             extra=0)
+        p0, p1, p2 = self.players
+        formset = FormSet(self._data([
+            {'id': p0.pk, 'name': 'Renamed', 'team': self.reds.pk},
+            {'id': p1.pk, 'name': 'P1', 'team': self.blues.pk},
+            {'id': p2.pk, 'name': 'P2', 'team': self.reds.pk},
+        ], 3))
+        self.assertTrue(formset.is_valid())
+        Player.objects.filter(pk=p0.pk).update(team=self.blues)
+        Player.objects.filter(pk=p1.pk).update(name='Changed elsewhere')
+        formset.bulk_save()
+        self.assertEqual(
+            sorted(Player.objects.values_list('name', 'team__name')),
+            [('Changed elsewhere', 'Blues'), ('P2', 'Reds'),
+             ('Renamed', 'Blues')])
+
+    def test_bulk_save_hooks(self):
+        """Stashed uploads are discarded and replaced files queued."""
+        class CleanupForm(PlayerForm):
+            delete_replaced_files = True
+        FormSet = bettermodelformset_factory(Player, form=CleanupForm,
+                                             extra=1)
+        p0, p1, p2 = self.players
+        formset = FormSet(self._data([
+            {'id': p0.pk, 'name': 'Renamed', 'team': self.reds.pk},
+            {'id': p1.pk, 'name': 'P1', 'team': self.reds.pk},
+            {'id': p2.pk, 'name': 'P2', 'team': self.reds.pk},
+            {'name': 'New', 'team': self.reds.pk},
+        ], 3))
+        self.assertTrue(formset.is_valid())
+        with patch('form_utils.formsets.discard_stashed_uploads') as discard:
+            with patch('form_utils.formsets.queue_replaced_files') as queue:
+                formset.bulk_save()
+        self.assertEqual(
+            [call[0][0]['name'] for call in discard.call_args_list],
+            ['New', 'Renamed'])
+        self.assertEqual(queue.call_count, 1)
+        form, obj = queue.call_args[0]
+        self.assertEqual(obj.name, 'Renamed')
+
+    def test_bulk_update_all_null(self):
+        """A field that is NULL in the whole batch is set without CASE."""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        Player.objects.update(number=7)
+        for player in self.players:
+            player.number = None
+        with CaptureQueriesContext(connection) as queries:
+            bulk_update(Player, self.players,
+                        [Player._meta.get_field('number')])
+        self.assertNotIn('CASE', queries[0]['sql'])
+        self.assertEqual(
+            list(Player.objects.values_list('number', flat=True)),
+            [None] * 3)
+
+
+class PaginatedFormSetTests(TestCase):
+    def setUp(self):
+        team = Team.objects.create(name='Reds')
+        self.players = [Player.objects.create(name='P%d' % i, team=team)
+                        for i in range(7)]
+        self.FormSet = bettermodelformset_factory(Player, form=PlayerForm,
+                                                  extra=0)
+        self.FormSet.paginate_by = 3
+
+    def test_page(self):
+        """An unbound formset only has forms for one page of objects."""
+        formset = self.FormSet(page=2)
+        self.assertEqual([form.instance for form in formset],
+                         self.players[3:6])
+        self.assertEqual(formset.page.paginator.num_pages, 3)
+        self.assertTrue('value="3"' in six.text_type(formset.management_form))
+        self.assertEqual(len(list(formset.forms[0].fieldsets)), 1)
+
+    def test_page_out_of_range(self):
+        """Out of range or invalid pages select the last or first page."""
+        self.assertEqual([f.instance for f in self.FormSet(page=9)],
+                         self.players[6:])
+        self.assertEqual([f.instance for f in self.FormSet(page='x')],
+                         self.players[:3])
+
+    def test_bound_window(self):
+        """A bound formset fetches and validates only the posted rows."""
+        p4, p5 = self.players[4:6]
+        formset = self.FormSet({
+            'form-TOTAL_FORMS': '2', 'form-INITIAL_FORMS': '2',
+            'form-0-id': str(p4.pk), 'form-0-name': 'Four',
+            'form-0-team': str(p4.team_id),
+            'form-1-id': str(p5.pk), 'form-1-name': 'Five',
+            'form-1-team': str(p5.team_id)}, page=2)
+        self.assertEqual(formset.get_queryset(), [p4, p5])
+        self.assertTrue(formset.is_valid())
+        formset.save()
+        self.assertEqual(
+            list(Player.objects.filter(pk__in=[p4.pk, p5.pk]).order_by(
+                'pk').values_list('name', flat=True)),
+            ['Four', 'Five'])
+        self.assertEqual(Player.objects.count(), 7)
+
+
+@skipIf(django.VERSION < (1, 5), "update_fields requires Django 1.5")
+class SaveChangedOnlyTests(TestCase):
+    def setUp(self):
+        self.person = Person.objects.create(name='Jo', age=30)
+
+    class ChangedOnlyPersonForm(BetterModelForm):
+        save_changed_only = True
+
+        class Meta:
+            model = Person
+            fields = ['name', 'age']
+
+    def test_changed_fields_only(self):
+        """Only the changed model fields are written."""
+        form = self.ChangedOnlyPersonForm({'name': 'Joe', 'age': '30'},
+                                          instance=self.person)
+        self.assertTrue(form.is_valid())
+        with patch.object(Person, 'save') as save:
+            form.save()
+        save.assert_called_once_with(update_fields=['name'])
+
+    def test_unchanged(self):
+        """Nothing is written if nothing changed."""
+        form = self.ChangedOnlyPersonForm({'name': 'Jo', 'age': '30'},
+                                          instance=self.person)
+        self.assertTrue(form.is_valid())
+        with self.assertNumQueries(0):
+            self.assertEqual(form.save(), self.person)
+
+    def test_new_instance(self):
+        """New instances are saved normally."""
+        form = self.ChangedOnlyPersonForm({'name': 'Al', 'age': '5'})
+        self.assertTrue(form.is_valid())
+        self.assertTrue(form.save().pk)
+
+    def test_auto_now(self):
+        """``auto_now`` fields are written along with changed fields."""
+        NoteForm = forms.models.modelform_factory(
+            Note, form=self.ChangedOnlyPersonForm, fields=['text'])
+        note = Note.objects.create(text='old')
+        Note.objects.filter(pk=note.pk).update(
+            modified=note.modified - datetime.timedelta(days=1))
+        note = Note.objects.get(pk=note.pk)
+        form = NoteForm({'text': 'new'}, instance=note)
+        self.assertTrue(form.is_valid())
+        with patch.object(Note, 'save') as save:
+            form.save()
+        save.assert_called_once_with(update_fields=['text', 'modified'])
+        old = Note.objects.get(pk=note.pk)
+        form = NoteForm({'text': 'newer'}, instance=old)
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertGreater(Note.objects.get(pk=note.pk).modified,
+                           note.modified)
+
+    def test_admin_cleared_file(self):
+        """
+        ``ClearableFileFieldsAdmin.save_changed_only`` writes a cleared
+        file field, and nothing for an unchanged form.
+
+        """
+        from django.contrib.admin import site
+        from form_utils.admin import ClearableFileFieldsAdmin
+        model_admin = ClearableFileFieldsAdmin(Document, site)
+        model_admin.save_changed_only = True
+        DocumentForm = forms.models.modelform_factory(
+            Document, fields=['myfile'],
+            formfield_callback=model_admin.formfield_for_dbfield)
+        # a ClearableFileField doesn't know about the existing file (see
+        # TODO.rst), so it can't be required here
+        DocumentForm.base_fields['myfile'].required = False
+        doc = Document.objects.create(myfile='uploads/something.txt')
+        form = DocumentForm({}, {}, instance=doc)
+        self.assertTrue(form.is_valid())
+        with self.assertNumQueries(0):
+            model_admin.save_model(None, form.save(commit=False), form, True)
+        form = DocumentForm({'myfile_1': 'on'}, {}, instance=doc)
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.changed_data, ['myfile'])
+        model_admin.save_model(None, form.save(commit=False), form, True)
+        self.assertEqual(Document.objects.get(pk=doc.pk).myfile, '')
+
+
+class CountingBytesIO(io.BytesIO):
+    reads = 0
+
+    def read(self, *args):
+        self.reads += 1
+        return super(CountingBytesIO, self).read(*args)
+
+
+class UploadValidatorTests(TestCase):
+    def _png(self):
+        with open(os.path.join(os.path.dirname(__file__),
+                               'media', 'tiny.png'), 'rb') as f:
+            return SimpleUploadedFile('tiny.png', f.read())
+
+    def test_max_size(self):
+        """Files larger than ``max_size`` are rejected."""
+        field = ClearableFileField(max_size=5)
+        try:
+            field.clean([SimpleUploadedFile('big.txt', b'Too big'), '0'])
+        except forms.ValidationError as e:
+            self.assertEqual(e.messages,
+                             ['Ensure this file is no larger than %s.'
+                              % filesizeformat(5)])
+        else:
+            self.fail('ValidationError not raised')
+
+    def test_max_size_unknown_size(self):
+        """If the size is unknown, it is counted while reading chunks."""
+        stream = CountingBytesIO(b'x' * 100)
+        upload = File(stream, name='big.txt')
+        upload.size = None
+        validator = UploadValidator(max_size=50, chunk_size=10)
+        self.assertRaises(forms.ValidationError, validator, upload)
+        # stopped at the first chunk over the limit
+        self.assertEqual(stream.reads, 6)
+
+    def test_content_types(self):
+        """The content type is sniffed from the file's first bytes."""
+        field = ClearableFileField(content_types=['image/*'])
+        self.assertTrue(field.clean([self._png(), '0']))
+        fake = SimpleUploadedFile('fake.png', b'Not a PNG',
+                                  content_type='image/png')
+        self.assertRaises(forms.ValidationError, field.clean, [fake, '0'])
+
+    def test_only_first_chunk_read(self):
+        """Without a checksum, only the first chunk is read."""
+        stream = CountingBytesIO(b'x' * 100)
+        upload = File(stream, name='big.txt')
+        upload.size = 100
+        validator = UploadValidator(max_size=1000, content_types=['text/*'],
+                                    chunk_size=10)
+        validator(upload)
+        self.assertEqual(stream.reads, 1)
+
+    def test_checksum(self):
+        """The checksum of the file is stored on it."""
+        field = ClearableFileField(checksum='sha1')
+        upload = field.clean([SimpleUploadedFile('a.txt', b'Something'), '0'])
+        self.assertEqual(upload.checksum,
+                         hashlib.sha1(b'Something').hexdigest())
+        self.assertEqual(upload.read(), b'Something')
+
+    def test_rewound_on_failure(self):
+        """The file is rewound even if validation fails."""
+        upload = SimpleUploadedFile('fake.png', b'Not a PNG')
+        validator = UploadValidator(content_types=['image/*'])
+        self.assertRaises(forms.ValidationError, validator, upload)
+        self.assertEqual(upload.read(), b'Not a PNG')
+
+    def test_equality(self):
+        """Validators with the same options are equal and hash alike."""
+        validator = UploadValidator(max_size=5, content_types=['image/*'])
+        same = UploadValidator(max_size=5, content_types=['image/*'])
+        self.assertTrue(validator == same)
+        self.assertFalse(validator != same)
+        self.assertEqual(hash(validator), hash(same))
+        self.assertTrue(validator != UploadValidator(max_size=6))
+        self.assertEqual(len(set([validator, same])), 1)
+
+    def test_sniff_content_type(self):
+        """Known magic numbers and UTF-8 text are recognized."""
+        self.assertEqual(sniff_content_type(b'%PDF-1.4'), 'application/pdf')
+        self.assertEqual(sniff_content_type('caf\xe9'.encode('utf-8')[:4]),
+                         'text/plain')
+        self.assertEqual(sniff_content_type(b'\x00\x01\x02'),
+                         'application/octet-stream')
+
+
+def make_image(width, height, format='PNG', name='image.png'):
+    from PIL import Image
+    data = io.BytesIO()
+    Image.new('RGB', (width, height)).save(data, format)
+    return SimpleUploadedFile(name, data.getvalue())
+
+
+class ImageHeaderFieldTests(TestCase):
+    def test_valid(self):
+        """A valid image is accepted, and its content type set."""
+        field = ImageHeaderField()
+        upload = field.clean(make_image(10, 20))
+        self.assertEqual(upload.image.size, (10, 20))
+        self.assertEqual(upload.content_type, 'image/png')
+
+    def test_invalid(self):
+        """Something that is not an image is rejected."""
+        field = ImageHeaderField()
+        self.assertRaises(forms.ValidationError, field.clean,
+                          SimpleUploadedFile('a.png', b'Not an image'))
+
+    def test_max_size(self):
+        """Too large a file is rejected without opening it."""
+        field = ImageHeaderField(max_size=10)
+        with patch('PIL.Image.open') as image_open:
+            self.assertRaises(forms.ValidationError, field.clean,
+                              make_image(10, 10))
+        self.assertFalse(image_open.called)
+
+    def test_max_dimensions(self):
+        """Images over ``max_width`` or ``max_height`` are rejected."""
+        field = ImageHeaderField(max_width=20, max_height=20)
+        self.assertTrue(field.clean(make_image(20, 20)))
+        self.assertRaises(forms.ValidationError, field.clean,
+                          make_image(21, 10))
+        self.assertRaises(forms.ValidationError, field.clean,
+                          make_image(10, 21))
+
+    def test_max_pixels(self):
+        """Images with more than ``max_pixels`` pixels are rejected."""
+        field = ImageHeaderField(max_pixels=100)
+        self.assertTrue(field.clean(make_image(10, 10)))
+        try:
+            field.clean(make_image(11, 10))
+        except forms.ValidationError as e:
+            self.assertEqual(e.code, 'max_pixels')
+            self.assertTrue('100 pixels' in e.messages[0], e.messages)
+        else:
+            self.fail('no ValidationError raised')
+
+    def test_formats(self):
+        """Only images of the given ``formats`` are accepted."""
+        field = ImageHeaderField(formats=['JPEG'])
+        self.assertTrue(field.clean(make_image(5, 5, 'JPEG', 'a.jpg')))
+        self.assertRaises(forms.ValidationError, field.clean,
+                          make_image(5, 5))
+
+    def test_header_only(self):
+        """With ``verify=False`` the image data is never decoded."""
+        from PIL import Image, ImageFile
+        field = ImageHeaderField(max_pixels=100, verify=False)
+        image = make_image(10, 10)
+        with patch.object(Image.Image, 'verify') as verify:
+            with patch.object(ImageFile.ImageFile, 'load') as load:
+                upload = field.clean(image)
+        self.assertFalse(verify.called)
+        self.assertFalse(load.called)
+        self.assertEqual(upload.read(1), b'\x89')
+
+    def test_verify(self):
+        """
+        By default the whole image is verified; with ``verify=False`` a
+        corrupt image passes.
+
+        """
+        data = make_image(10, 10).read()
+        # a PNG with a corrupt image data checksum
+        corrupt = data[:-20] + b'\0' + data[-19:]
+        self.assertRaises(forms.ValidationError, ImageHeaderField().clean,
+                          SimpleUploadedFile('a.png', corrupt))
+        self.assertTrue(ImageHeaderField(verify=False).clean(
+            SimpleUploadedFile('a.png', corrupt)))
+
+    def test_limits_before_verify(self):
+        """Limits are checked before the image is verified."""
+        from PIL import PngImagePlugin
+        field = ImageHeaderField(max_width=5)
+        image = make_image(10, 10)
+        with patch.object(PngImagePlugin.PngImageFile, 'verify') as verify:
+            self.assertRaises(forms.ValidationError, field.clean, image)
+        self.assertFalse(verify.called)
+
+    def test_clearable_image_field(self):
+        """
+        ``ClearableImageField`` uses ``forms.ImageField`` by default, and
+        ``ImageHeaderField`` if given any of its options.
+
+        """
+        self.assertEqual(type(ClearableImageField().fields[0]),
+                         forms.ImageField)
+        field = ClearableImageField(max_width=5, verify=False,
+                                    required=False)
+        self.assertTrue(isinstance(field.fields[0], ImageHeaderField))
+        self.assertEqual(field.fields[0].max_width, 5)
+        self.assertFalse(field.fields[0].verify)
+        self.assertFalse(field.required)
+        self.assertRaises(forms.ValidationError, field.clean,
+                          [make_image(10, 10), '0'])
+
+
+class ThumbnailCacheTests(TestCase):
+    def setUp(self):
+        thumbnail_cache.clear()
+
+    def tearDown(self):
+        thumbnail_cache.clear()
+
+    def test_render_cached(self):
+        """``ImageWidget`` renders each thumbnail only once."""
+        widget = ImageWidget()
+        value = ImageFieldFile(None, ImageField(), 'tiny.png')
+        with patch('form_utils.widgets.thumbnail',
+                   return_value='<img />') as thumbnail:
+            widget.render('fieldname', value)
+            html = widget.render('fieldname', value)
+        self.assertEqual(thumbnail.call_count, 1)
+        self.assertTrue('<img />' in html)
+
+    def test_key_includes_size(self):
+        """Thumbnails of another size are rendered separately."""
+        value = ImageFieldFile(None, ImageField(), 'tiny.png')
+        with patch('form_utils.widgets.thumbnail',
+                   return_value='<img />') as thumbnail:
+            ImageWidget().render('fieldname', value)
+            ImageWidget(width=100).render('fieldname', value)
+        self.assertEqual(thumbnail.call_count, 2)
+
+    def test_lru_eviction(self):
+        """The least recently used entry is evicted."""
+        cache = ThumbnailCache(maxsize=2, backend=None)
+        cache.get('a', lambda: 'A')
+        cache.get('b', lambda: 'B')
+        cache.get('a', lambda: 'X')
+        cache.get('c', lambda: 'C')
+        self.assertEqual(cache.get('a', lambda: 'X'), 'A')
+        self.assertEqual(cache.get('b', lambda: 'Y'), 'Y')
+
+    def test_shared_cache(self):
+        """Entries are shared through the Django cache backend."""
+        one = ThumbnailCache(maxsize=0, backend='default')
+        two = ThumbnailCache(maxsize=0, backend='default')
+        one.shared_cache.delete(one.shared_key('a'))
+        self.assertEqual(one.get('a', lambda: 'A'), 'A')
+        self.assertEqual(two.get('a', lambda: 'X'), 'A')
+
+    def test_pending_not_cached(self):
+        """A placeholder for a pending thumbnail is not cached."""
+        cache = ThumbnailCache(maxsize=2, backend=None)
+        cache.get('a', lambda: PendingThumbnail('<img />'))
+        self.assertEqual(cache.get('a', lambda: 'A'), 'A')
+
+
+class ThumbnailEngineTests(TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.storage = FileSystemStorage(location=self.media,
+                                         base_url='/media/')
+        self.storage.save('pic.png', make_image(400, 300))
+        self.engine = ThumbnailEngine(storage=self.storage,
+                                      source_storage=self.storage, wait=5)
+
+    def tearDown(self):
+        shutil.rmtree(self.media)
+
+    def test_render(self):
+        """A thumbnail no larger than the given size is generated."""
+        from PIL import Image
+        html = self.engine.render('pic.png', 200, 200)
+        name = self.engine.thumbnail_name('pic.png', 200, 200)
+        self.assertEqual(html, '<img src="/media/%s" alt="pic.png" />' % name)
+        self.assertEqual(Image.open(self.storage.path(name)).size,
+                         (200, 150))
+
+    def test_generated_once(self):
+        """An existing thumbnail is not generated again."""
+        self.engine.render('pic.png', 200, 200)
+        with patch.object(self.engine, 'generate') as generate:
+            self.engine.render('pic.png', 200, 200)
+        self.assertFalse(generate.called)
+
+    def test_name_changes_with_source(self):
+        """Replacing the source image changes the thumbnail name."""
+        name = self.engine.thumbnail_name('pic.png', 200, 200)
+        path = self.storage.path('pic.png')
+        mtime = os.path.getmtime(path)
+        os.utime(path, (mtime + 10, mtime + 10))
+        self.assertNotEqual(
+            self.engine.thumbnail_name('pic.png', 200, 200), name)
+        self.assertNotEqual(
+            self.engine.thumbnail_name('pic.png', 100, 100), name)
+
+    @skipIf(ThreadPoolExecutor is None,
+            "background thumbnails require concurrent.futures")
+    def test_placeholder(self):
+        """A placeholder is rendered while the thumbnail is generated."""
+        import threading
+        started = threading.Event()
+        release = threading.Event()
+        generate = self.engine.generate
+
+        def slow_generate(*args):
+            started.set()
+            release.wait(5)
+            generate(*args)
+
+        self.engine.wait = 0
+        with patch.object(self.engine, 'generate', slow_generate):
+            html = self.engine.render('pic.png', 200, 200)
+            self.assertTrue(isinstance(html, PendingThumbnail))
+            self.assertTrue('width="200"' in html)
+            started.wait(5)
+            future = self.engine._pending[
+                self.engine.thumbnail_name('pic.png', 200, 200)]
+            release.set()
+            future.result(5)
+        self.assertFalse(isinstance(self.engine.render('pic.png', 200, 200),
+                                    PendingThumbnail))
+
+    def test_missing_source(self):
+        """The original's URL is used if a thumbnail can't be made."""
+        html = self.engine.render('missing.png', 200, 200)
+        self.assertEqual(html, '<img src="/media/missing.png" '
+                         'alt="missing.png" />')
+
+
+class ReplacedFileForm(BetterModelForm):
+    delete_replaced_files = True
+    myfile = ClearableFileField(required=False)
+
+    class Meta:
+        model = Document
+        fields = ['myfile']
+
+
+class DeleteReplacedFilesTests(TransactionTestCase):
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        self.storage = FileSystemStorage(location=media)
+        patcher = patch.object(Document._meta.get_field('myfile'),
+                               'storage', self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.queue = cleanup.LocalDeletionQueue(delay=60)
+        patcher = patch.object(cleanup, '_queue', self.queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.doc = Document.objects.create(
+            myfile=self.storage.save('uploads/old.txt', ContentFile(b'Old')))
+
+    def test_cleared(self):
+        """A cleared file is deleted when the queue is flushed."""
+        form = ReplacedFileForm({'myfile_1': 'on'}, {}, instance=self.doc)
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertTrue(self.storage.exists('uploads/old.txt'))
+        self.assertEqual(self.queue.flush(), 1)
+        self.assertFalse(self.storage.exists('uploads/old.txt'))
+
+    def test_replaced(self):
+        """A replaced file is deleted, and the new one kept."""
+        form = ReplacedFileForm(
+            {}, {'myfile_0': SimpleUploadedFile('new.txt', b'New')},
+            instance=self.doc)
+        self.assertTrue(form.is_valid())
+        doc = form.save()
+        self.queue.flush()
+        self.assertFalse(self.storage.exists('uploads/old.txt'))
+        self.assertTrue(self.storage.exists(doc.myfile.name))
+
+    def test_unchanged(self):
+        """Nothing is queued if the file didn't change."""
+        form = ReplacedFileForm({}, {}, instance=self.doc)
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual(self.queue.flush(), 0)
+        self.assertTrue(self.storage.exists('uploads/old.txt'))
+
+    @skipIf(django.VERSION < (1, 6), "atomic requires Django 1.6")
+    def test_not_queued_on_rollback(self):
+        """Nothing is queued if the transaction is rolled back."""
+        from django.db import transaction
+        form = ReplacedFileForm({'myfile_1': 'on'}, {}, instance=self.doc)
+        self.assertTrue(form.is_valid())
+        try:
+            with transaction.atomic():
+                form.save()
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.queue.flush(), 0)
+
+    @skipIf(django.VERSION < (1, 6), "atomic requires Django 1.6")
+    def test_no_on_commit(self):
+        """
+        Without ``transaction.on_commit`` (Django < 1.9), files saved in
+        an atomic block aren't queued.
+
+        """
+        from django.db import transaction
+        with patch.object(transaction, 'on_commit', None, create=True):
+            form = ReplacedFileForm({'myfile_1': 'on'}, {},
+                                    instance=self.doc)
+            self.assertTrue(form.is_valid())
+            with transaction.atomic():
+                form.save()
+            self.assertEqual(self.queue.flush(), 0)
+            self.doc.myfile = 'uploads/old.txt'
+            self.doc.save()
+            form = ReplacedFileForm({'myfile_1': 'on'}, {},
+                                    instance=self.doc)
+            self.assertTrue(form.is_valid())
+            form.save()
+            self.assertEqual(self.queue.flush(), 1)
+
+    def test_flushed_at_exit(self):
+        """The local queue is flushed when the process exits."""
+        queue = cleanup.LocalDeletionQueue(delay=60)
+        with patch.object(cleanup.atexit, 'register') as register:
+            queue.add(Document, 'myfile', 'uploads/old.txt')
+            queue.add(Document, 'myfile', 'uploads/other.txt')
+        register.assert_called_once_with(queue.flush)
+        queue.flush()
+
+    def test_thread_closes_connections(self):
+        """The timer thread closes its database connections."""
+        connection = Mock()
+        with patch.object(self.queue, 'flush') as flush:
+            with patch.object(cleanup, 'connections') as connections:
+                connections.all.return_value = [connection]
+                self.queue._flush_in_thread()
+        flush.assert_called_once_with()
+        connection.close.assert_called_once_with()
+
+    def test_still_referenced(self):
+        """A file another instance refers to isn't deleted."""
+        Document.objects.create(myfile='uploads/old.txt')
+        form = ReplacedFileForm({'myfile_1': 'on'}, {}, instance=self.doc)
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual(self.queue.flush(), 0)
+        self.assertTrue(self.storage.exists('uploads/old.txt'))
+
+    def test_default(self):
+        """The field's default file is never queued."""
+        with patch.object(Document._meta.get_field('myfile'), 'default',
+                          'uploads/old.txt'):
+            form = ReplacedFileForm({'myfile_1': 'on'}, {},
+                                    instance=self.doc)
+            self.assertTrue(form.is_valid())
+            self.assertEqual(cleanup.replaced_files(form), [])
+
+    def test_file_queue(self):
+        """
+        The file queue records files for a later ``flush`` (by the
+        management command).
+
+        """
+        self.doc.delete()
+        path = os.path.join(self.storage.location, 'queue')
+        queue = cleanup.FileDeletionQueue(path, batch_size=1)
+        queue.add(Document, 'myfile', 'uploads/old.txt')
+        queue.add(Document, 'myfile', 'uploads/missing.txt')
+        self.assertTrue(self.storage.exists('uploads/old.txt'))
+        self.assertEqual(queue.flush(), 2)
+        self.assertFalse(self.storage.exists('uploads/old.txt'))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(queue.flush(), 0)
+
+
+class AdminCacheTests(TestCase):
+    def setUp(self):
+        from django.contrib.admin import site
+        from form_utils.admin import ClearableFileFieldsAdmin
+        self.model_admin = ClearableFileFieldsAdmin(Document, site)
+        self.request = RequestFactory().get('/')
+
+    def test_wrapped_field_cached(self):
+        """The wrapped file field is built once per admin and field."""
+        db_field = Document._meta.get_field('myfile')
+        field = self.model_admin.formfield_for_dbfield(
+            db_field, request=self.request)
+        self.assertTrue(isinstance(field, ClearableFileField))
+        with patch('django.contrib.admin.ModelAdmin.formfield_for_dbfield'
+                   ) as formfield_for_dbfield:
+            self.assertTrue(self.model_admin.formfield_for_dbfield(
+                db_field, request=self.request) is field)
+        self.assertFalse(formfield_for_dbfield.called)
+
+    def test_other_kwargs_not_cached(self):
+        """Fields built with extra arguments are not cached."""
+        db_field = Document._meta.get_field('myfile')
+        field = self.model_admin.formfield_for_dbfield(
+            db_field, request=self.request, required=False)
+        self.assertFalse(field.required)
+        self.assertFalse(self.model_admin.formfield_for_dbfield(
+            db_field, request=self.request) is field)
+
+    def test_form_class_cached(self):
+        """With ``cache_forms``, form classes are cached per user."""
+        class User(object):
+            def __init__(self, pk):
+                self.pk = pk
+        self.model_admin.cache_forms = True
+        self.request.user = User(1)
+        form = self.model_admin.get_form(self.request)
+        self.assertTrue(self.model_admin.get_form(self.request) is form)
+        self.assertTrue(isinstance(form.base_fields['myfile'],
+                                   ClearableFileField))
+        self.request.user = User(2)
+        self.assertFalse(self.model_admin.get_form(self.request) is form)
+
+    def test_form_class_cached_per_object(self):
+        """Form classes are cached per edited object."""
+        self.model_admin.cache_forms = True
+        doc = Document.objects.create(myfile='uploads/a.txt')
+        form = self.model_admin.get_form(self.request, doc)
+        self.assertTrue(self.model_admin.get_form(self.request, doc) is form)
+        self.assertFalse(self.model_admin.get_form(self.request) is form)
+
+    def test_model_choice_form_not_cached(self):
+        """Forms with model choice fields are not cached."""
+        from django.contrib.admin import site
+        from form_utils.admin import ClearableFileFieldsAdmin
+        model_admin = ClearableFileFieldsAdmin(Player, site)
+        model_admin.cache_forms = True
+        form = model_admin.get_form(self.request)
+        self.assertTrue(
+            isinstance(form.base_fields['team'], forms.ModelChoiceField))
+        self.assertFalse(model_admin.get_form(self.request) is form)
+
+    def test_form_class_not_cached_by_default(self):
+        """Form classes are not cached by default."""
+        self.assertFalse(self.model_admin.get_form(self.request) is
+                         self.model_admin.get_form(self.request))
+
+
+class AutoResizeMediaTests(TestCase):
+    def test_default_media(self):
+        """By default the jQuery autogrow scripts are used."""
+        js = AutoResizeTextarea().media._js
+        self.assertEqual(len(js), 3)
+        self.assertTrue(js[1].endswith('form_utils/js/jquery.autogrow.js'))
+
+    def test_minified_up_to_date(self):
+        """autoresize.min.js is regenerated from its current source."""
+        import subprocess
+        script = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), 'minify_js.py')
+        self.assertEqual(
+            subprocess.call([sys.executable, script, '--check']), 0)
+
+    def _digest(self):
+        import form_utils
+        path = os.path.join(os.path.dirname(form_utils.__file__), 'media',
+                            'form_utils', 'js', 'autoresize.min.js')
+        with open(path, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()[:12]
+
+    @patch.dict('form_utils.widgets._fingerprinted', clear=True)
+    def test_fingerprinted(self):
+        """A shipped script's URL carries a hash of its contents."""
+        self.assertEqual(fingerprinted('form_utils/js/autoresize.min.js'),
+                         '/static/form_utils/js/autoresize.min.js?v=' +
+                         self._digest())
+
+    @patch.dict('form_utils.widgets._fingerprinted', clear=True)
+    def test_fingerprinted_staticfiles_storage(self):
+        """With staticfiles, the URL comes from its storage, once."""
+        apps = ['django.contrib.staticfiles'] + list(settings.INSTALLED_APPS)
+        with self.settings(INSTALLED_APPS=apps):
+            with patch('form_utils.widgets.staticfiles_storage') as storage:
+                storage.url.return_value = (
+                    'https://cdn.example.com/autoresize.min.js?x=1')
+                url = lazy(fingerprinted, six.text_type)(
+                    'form_utils/js/autoresize.min.js')
+                self.assertFalse(storage.url.called)
+                html = six.text_type(forms.Media(js=[url]))
+                self.assertTrue(
+                    'https://cdn.example.com/autoresize.min.js?x=1' in html)
+                self.assertEqual(
+                    fingerprinted('form_utils/js/autoresize.min.js'),
+                    'https://cdn.example.com/autoresize.min.js?x=1&v=' +
+                    self._digest())
+        self.assertEqual(storage.url.call_count, 1)
+
+
+class NotesForm(BetterForm):
+    title = forms.CharField()
+    summary = forms.CharField(widget=AutoResizeTextarea())
+    notes = forms.CharField(widget=AutoResizeTextarea())
+
+    class Media:
+        js = ('notes.js',)
+
+
+class MediaCacheTests(TestCase):
+    def test_media(self):
+        """The merged media is deduplicated and includes form Media."""
+        js = NotesForm().media._js
+        self.assertEqual(js, list(AutoResizeTextarea().media._js) +
+                         ['notes.js'])
+
+    @skipIf(django.VERSION < (1, 5),
+            "Django 1.4 computes the base media twice per form class")
+    def test_computed_once(self):
+        """The widgets' media is merged once per form class."""
+        NotesForm().media
+        with patch.object(forms.Media, '__add__',
+                          autospec=True, side_effect=forms.Media.__add__
+                          ) as add:
+            NotesForm().media
+        # copy the cached media, then add the form's own Media
+        self.assertEqual(add.call_count, 2)
+
+    def test_copy(self):
+        """Modifying a form's media doesn't affect other forms."""
+        NotesForm().media.add_js(['other.js'])
+        self.assertFalse('other.js' in NotesForm().media._js)
+
+    def test_media_key(self):
+        """Widgets with equal media have equal keys."""
+        self.assertEqual(media_key(AutoResizeTextarea()),
+                         media_key(AutoResizeTextarea(attrs={'rows': 3})))
+        self.assertEqual(media_key(ClearableFileInput()),
+                         media_key(ClearableFileInput()))
+        self.assertNotEqual(media_key(ClearableFileInput()),
+                            media_key(ClearableFileInput(upload_url='/u/')))
+
+        class DynamicWidget(forms.TextInput):
+            @property
+            def media(self):
+                return forms.Media()
+        self.assertEqual(media_key(DynamicWidget()), None)
+
+    @skipIf(django.VERSION < (1, 5),
+            "Django 1.4 computes the base media twice per form class")
+    def test_formset(self):
+        """A formset merges the media of its forms once."""
+        NotesFormSet = betterformset_factory(NotesForm, extra=3)
+        formset = NotesFormSet()
+        with patch.object(forms.Media, '__add__',
+                          autospec=True, side_effect=forms.Media.__add__
+                          ) as add:
+            media = formset.media
+        # one form's media (as above), added to the formset's once
+        self.assertEqual(add.call_count, 3)
+        self.assertEqual(media._js, NotesForm().media._js)
+
+
+class SerializerTests(TestCase):
+    def test_layout(self):
+        """The layout describes fieldsets and fields in order."""
+        data = layout_data(MudSlingerApplicationForm)
+        self.assertEqual([fs['name'] for fs in data['fieldsets']],
+                         ['main', 'Optional'])
+        main, optional = data['fieldsets']
+        self.assertEqual(main['legend'], 'basic info')
+        self.assertEqual(main['description'], 'Basic mudslinging info')
+        self.assertEqual([f['name'] for f in main['fields']],
+                         ['name', 'position', 'target'])
+        self.assertEqual(optional['legend'], 'Optional')
+        self.assertEqual(optional['classes'], ['optional'])
+        reference = optional['fields'][0]
+        self.assertEqual(reference['label'], 'Reference')
+        self.assertEqual(reference['widget'], 'TextInput')
+        self.assertEqual(reference['input_type'], 'text')
+        self.assertFalse(reference['required'])
+
+    def test_default_fieldset(self):
+        """A form without fieldsets is described as a single fieldset."""
+        data = layout_data(FeedbackForm)
+        self.assertEqual(len(data['fieldsets']), 1)
+        self.assertEqual([f['name'] for f in data['fieldsets'][0]['fields']],
+                         ['title', 'name'])
+
+    def test_row_attrs(self):
+        """The row_attrs of each field are included."""
+        fields = layout_data(HoneypotForm)['fieldsets'][0]['fields']
+        self.assertEqual(fields[0]['row_attrs'], {'style': 'display: none'})
+        self.assertEqual(fields[1]['row_attrs'], {})
+
+    def test_instance(self):
+        """A form instance is described by its own fields."""
+        form = ApplicationForm()
+        del form.fields['position']
+        data = layout_data(form)
+        self.assertEqual(
+            [f['name'] for f in data['fieldsets'][0]['fields']], ['name'])
+        self.assertEqual(data['fieldsets'][1],
+                         layout_data(ApplicationForm)['fieldsets'][1])
+
+    def test_json_cached(self):
+        """The JSON layout is built once per class, with an ETag."""
+        content, etag = layout_json(ApplicationForm)
+        self.assertEqual(json.loads(content), layout_data(ApplicationForm))
+        self.assertEqual(
+            etag, '"%s"' % hashlib.md5(content.encode('utf-8')).hexdigest())
+        with patch('form_utils.serializers.layout_data') as data:
+            self.assertEqual(layout_json(ApplicationForm), (content, etag))
+        self.assertFalse(data.called)
+        self.assertNotEqual(layout_json(MudSlingerApplicationForm)[1], etag)
+
+    def test_state(self):
+        """The state holds the values and errors of a form."""
+        form = HoneypotForm({'honeypot': 'spam'})
+        self.assertEqual(state_data(form), {
+            'values': {'honeypot': 'spam', 'name': None},
+            'errors': {'honeypot': ['Honeypot field must be empty.'],
+                       'name': ['This field is required.']}})
+        self.assertEqual(json.loads(state_json(ApplicationForm(
+            initial={'name': 'Joe'}))),
+            {'values': {'name': 'Joe', 'position': None,
+                        'reference': None},
+             'errors': {}})
+
+    def test_view(self):
+        """The layout view returns 304 for a matching ETag."""
+        request = RequestFactory().get('/layout/')
+        response = form_layout(request, ApplicationForm)
+        content, etag = layout_json(ApplicationForm)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.decode('utf-8'), content)
+        self.assertEqual(response['ETag'], etag)
+        request = RequestFactory().get('/layout/', HTTP_IF_NONE_MATCH=etag)
+        response = form_layout(request, ApplicationForm)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+
+class MisspelledForm(BetterForm):
+    name = forms.CharField()
+
+    class Meta:
+        fieldsets = [('main', {'fields': ['name', 'nmae']})]
+
+
+class WarmUpTests(TestCase):
+    def test_form_classes(self):
+        """All BetterForm and BetterModelForm subclasses are found."""
+        classes = form_classes()
+        for form_class in (ApplicationForm, MudSlingerApplicationForm,
+                           PersonForm, NotesForm):
+            self.assertTrue(form_class in classes)
+        self.assertFalse(BetterForm in classes)
+
+    def test_check_fieldsets(self):
+        """Fieldsets naming unknown fields are reported."""
+        self.assertEqual(check_fieldsets(ApplicationForm), [])
+        self.assertEqual(check_fieldsets(MisspelledForm), [
+            "tests.tests.MisspelledForm: fieldset 'main' includes "
+            "unknown field 'nmae'."])
+
+    def test_warm_up(self):
+        """The shared layout of each form class is filled."""
+        report = warm_up()
+        self.assertTrue(ApplicationForm in report.forms)
+        self.assertEqual(report.problems, check_fieldsets(MisspelledForm))
+        self.assertTrue(report.seconds > 0)
+        layout = ApplicationForm.get_layout()
+        self.assertTrue(tuple(ApplicationForm.base_fields) in
+                        layout._fieldset_specs)
+        self.assertTrue(('reference', False, True) in layout._flat_row_attrs)
+        self.assertTrue('form_utils/better_form.html,form_utils/form.html'
+                        in layout._templates)
+
+    def test_command(self):
+        """The command reports the time taken and fails on problems."""
+        stdout, stderr = six.StringIO(), six.StringIO()
+        # Django < 1.5 compatibility: execute() exits on a CommandError
+        with self.assertRaises((CommandError, SystemExit)):
+            call_command('warm_up_forms', stdout=stdout, stderr=stderr)
+        self.assertTrue(re.match(r'Warmed up \d+ form classes in [\d.]+ ms',
+                                 stdout.getvalue()))
+        self.assertTrue("unknown field 'nmae'" in stderr.getvalue())
+
+
+class CompactTemplateTests(TestCase):
+    def render(self, form, template_name):
+        tpl = template.Template(
+            '{%% load form_utils %%}{{ form|render:"%s" }}' % template_name)
+        return tpl.render(template.Context({'form': form}))
+
+    def assertCompact(self, form, template_name):
+        full = self.render(form, 'form_utils/' + template_name)
+        compact = self.render(form, 'form_utils/compact/' + template_name)
+        self.assertHTMLEqual(compact, full)
+        self.assertFalse('\n' in compact)
+        return full, compact
+
+    def test_form(self):
+        """The compact templates render the same markup."""
+        self.assertCompact(forms.Form(), 'form.html')
+        self.assertCompact(HoneypotForm({'honeypot': 'spam'}),
+                           'better_form.html')
+        full, compact = self.assertCompact(
+            MudSlingerApplicationForm({'name': 'Joe'}), 'better_form.html')
+        self.assertTrue('<legend>basic info</legend>' in compact)
+
+    def test_label_space(self):
+        """The space between a label and its widget is kept."""
+        full, compact = self.assertCompact(FeedbackForm(), 'better_form.html')
+        self.assertTrue('</label> <input' in compact)
+
+    def test_setting(self):
+        """``FORM_UTILS_COMPACT_TEMPLATES`` makes them the default."""
+        with patch('form_utils.templatetags.form_utils.BETTER_FORM_TEMPLATE',
+                   'form_utils/compact/better_form.html'):
+            self.assertEqual(
+                self.render(ApplicationForm(), ''),
+                self.render(ApplicationForm(),
+                            'form_utils/compact/better_form.html'))
+
+    def test_bytes_saved(self):
+        """A formset renders to much less markup."""
+        formset = betterformset_factory(ApplicationForm, extra=50)()
+        sizes = []
+        for template_name in ('form_utils/better_form.html',
+                              'form_utils/compact/better_form.html'):
+            sizes.append(sum(len(self.render(form, template_name))
+                             for form in formset))
+        full, compact = sizes
+        # about 42% of the default templates' output is whitespace
+        self.assertTrue(compact < full * 0.65, (full, compact))